@@ -0,0 +1,192 @@
+"""
+Микробенчмарк движков из chat_filters.py на синтетическом корпусе сообщений,
+похожих на реальный чат барахолки (объявления, болтовня, мат-фильтр).
+
+Запуск:  python bench_chat_filters.py [кол-во сообщений] [размеченный_корпус.jsonl]
+
+Размеченный корпус для классификатора объявлений — JSONL со строками
+{"text": "...", "is_ad": true/false} (например, выгрузка user_ads плюс
+обычные сообщения чата). Без него используется синтетическая разметка.
+"""
+
+import json
+import random
+import re
+import sys
+import time
+
+from chat_filters import AdClassifier, FloodDetector, TriggerMatcher, simhash
+
+# Копия базового списка из main.py (сам main.py без токена бота не импортируется)
+TRIGGER_WORDS = {
+    "кинг": ["кинг", "king", "кiнг", "к1нг", "кинг", "к!нг", "к@нг"],
+    "техас": ["техас", "texas", "т3хас", "теха$", "техас", "тexас"],
+    "чилл": ["чилл", "chill", "ч!лл", "чиll", "ч1лл", "чилl"],
+    "космонавт": ["космонавт", "косmonaut", "к0смонавт", "космонавт", "космонавт"],
+}
+
+CHATTER = [
+    "всем привет", "кто сегодня на районе?", "ахахах ну ты даёшь", "норм", "+",
+    "а где можно забрать заказ?", "ребят подскажите по испарителю",
+    "у кого есть зарядка type-c", "спс", "когда следующая поставка?",
+    "го гулять вечером", "жесть", "я тоже так думаю", "👍👍👍", "ок",
+]
+ADS = [
+    "Продам под систему, состояние 10/10, цена 1500₽, самовывоз Сосновка",
+    "Куплю жижу 30 мл, доставка по городу, пишите в лс @seller_01",
+    "ПРОДАЮ одноразки оптом и в розницу, цены ниже рынка, тг @vape_opt",
+    "Обмен картриджей на испарители, +7 900 123-45-67",
+]
+# Длинные обычные сообщения — прежний is_ad_message считал их объявлениями
+LONG_CHATTER = [
+    "ребят а кто знает где можно забрать заказ который я оформлял вчера вечером через сайт, "
+    "там написано что уже доставлено но в пункте говорят что ничего нет",
+    "короче вчера весь день провозился с испарителем, менял вату три раза и всё равно горчит, "
+    "может кто сталкивался и подскажет что делать",
+]
+# Обычные сообщения с числами, ценами и словами, похожими на ключевые, —
+# без них оценка точности классификатора ничего не стоит
+PRICE_CHATTER = [
+    "у меня 2к осталось до зарплаты, пипец",
+    "отдал за него 500р, норм испаритель",
+    "купил рубашку за 1500 руб, сидит отлично",
+    "меня тоже бесит что опять подняли цены в магазине у дома",
+    "вчера в кб было 3 по цене 2, успел взять",
+    "живу в 5 р-не, тут два магаза рядом",
+    "скинул ему 300р за такси, вернёт завтра",
+    "торговля нынче так себе, оптика и та дорожает",
+    "он продал мне его год назад, до сих пор живой",
+    "а доставка из магаза сколько шла? у меня 3 дня",
+    "у меня батарейка 3000 мАч, на день хватает",
+    "за 2 тыс руб взял бы, но уже не надо",
+]
+ADS += [
+    "продам за 2к руб, почти новый, торг",
+    "Отдам даром испаритель, самовывоз центр",
+    "Продаётся под, цена 900 р., пишите в тг",
+    "Куплю картриджи оптом, писать в лс",
+]
+TRIGGERED = [
+    "в кинге дешевле было", "заказывал в Texas вчера", "чиll лучше всех",
+    "к0смонавт норм магаз", "ну в к1нге то же самое",
+]
+
+
+def make_corpus(n: int, seed: int = 42) -> list:
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        roll = rnd.random()
+        if roll < 0.70:
+            corpus.append(" ".join(rnd.choices(CHATTER, k=rnd.randint(1, 3))))
+        elif roll < 0.97:
+            corpus.append(rnd.choice(ADS))
+        else:
+            corpus.append(rnd.choice(TRIGGERED))
+    return corpus
+
+
+def make_labelled_corpus(n: int, seed: int = 7) -> list:
+    """[(текст, это_объявление)] — синтетическая разметка для классификатора."""
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        roll = rnd.random()
+        if roll < 0.50:
+            corpus.append((" ".join(rnd.choices(CHATTER, k=rnd.randint(1, 3))), False))
+        elif roll < 0.60:
+            corpus.append((rnd.choice(LONG_CHATTER), False))
+        elif roll < 0.75:
+            corpus.append((rnd.choice(PRICE_CHATTER), False))
+        else:
+            corpus.append((rnd.choice(ADS), True))
+    return corpus
+
+
+def load_labelled_corpus(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [(row["text"], bool(row["is_ad"])) for row in map(json.loads, f) if row.get("text")]
+
+
+def legacy_is_ad(text: str) -> bool:
+    """Прежний is_ad_message: 17 проверок подстрок + «длинное — значит объявление»."""
+    ad_keywords = [
+        'продам', 'продаю', 'куплю', 'покупаю', 'обмен', 'меняю',
+        'отдам', 'даром', 'бесплатно', 'цена', 'стоимость', '₽', 'руб',
+        'тг', 'телеграм', 'доставка', 'забрать', 'самовывоз'
+    ]
+    text_lower = text.lower()
+    keyword_count = sum(1 for keyword in ad_keywords if keyword in text_lower)
+    return keyword_count >= 2 or len(text) > 100
+
+
+def bench_classifier(name: str, fn, corpus: list) -> float:
+    texts = [text for text, _ in corpus]
+    start = time.perf_counter()
+    predicted = [fn(text) for text in texts]
+    elapsed = time.perf_counter() - start
+    tp = sum(1 for p, (_, label) in zip(predicted, corpus) if p and label)
+    fp = sum(1 for p, (_, label) in zip(predicted, corpus) if p and not label)
+    fn_ = sum(1 for p, (_, label) in zip(predicted, corpus) if not p and label)
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn_) if tp + fn_ else 0.0
+    per_msg = elapsed / len(corpus) * 1e6
+    print(f"{name:<28} {per_msg:8.2f} мкс/сообщ.   точность: {precision:.3f}   полнота: {recall:.3f}")
+    return per_msg
+
+
+def legacy_find(text: str):
+    """Прежняя реализация из handle_message: regex на каждый вариант."""
+    text_lower = text.lower()
+    for variants in TRIGGER_WORDS.values():
+        for variant in variants:
+            if re.search(r"\b" + re.escape(variant) + r"\w*", text_lower):
+                return variant
+    return None
+
+
+def bench(name: str, fn, corpus: list) -> float:
+    start = time.perf_counter()
+    hits = sum(1 for text in corpus if fn(text))
+    elapsed = time.perf_counter() - start
+    per_msg = elapsed / len(corpus) * 1e6
+    print(f"{name:<28} {per_msg:8.2f} мкс/сообщ.   совпадений: {hits}")
+    return per_msg
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    corpus = make_corpus(n)
+    print(f"Корпус: {n} сообщений\n")
+
+    matcher = TriggerMatcher(TRIGGER_WORDS)
+    legacy = bench("триггеры: цикл по вариантам", legacy_find, corpus)
+    fast = bench("триггеры: TriggerMatcher", matcher.find, corpus)
+    print(f"\nУскорение: x{legacy / fast:.1f}")
+
+    labelled = load_labelled_corpus(sys.argv[2]) if len(sys.argv) > 2 else make_labelled_corpus(n)
+    print(f"\nОбъявления: {len(labelled)} размеченных сообщений\n")
+    classifier = AdClassifier()
+    bench_classifier("объявления: подстроки", legacy_is_ad, labelled)
+    bench_classifier("объявления: AdClassifier", classifier.is_ad, labelled)
+
+    ads = [text for text, is_ad in labelled if is_ad]
+    bench("отпечатки: simhash", simhash, ads)
+
+    # Поток сообщений от 500 пользователей, ~2 сообщения в секунду на весь чат
+    detector = FloodDetector()
+    clock = iter(range(len(corpus)))
+
+    def flood_check(text):
+        tick = next(clock)
+        return detector.check(tick % 500, text, tick * 0.5)
+
+    bench(
+        "флуд: FloodDetector",
+        flood_check,
+        corpus,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""
+VapeNeon — движки анализа текста сообщений группового чата.
+
+Здесь только чистая логика без обращений к Telegram и БД, чтобы её можно
+было гонять в бенчмарках (bench_chat_filters.py) без запуска бота.
+"""
+
+import hashlib
+import re
+import threading
+from array import array
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# ─── НОРМАЛИЗАЦИЯ ────────────────────────────────────────────────────────────
+# Латинские буквы, похожие на кириллические (гомоглифы), и типичные
+# leet-замены сводятся к одной кириллической букве. Нормализуются обе
+# стороны — и текст сообщения, и варианты триггерных слов, поэтому
+# конкретный выбор замены влияет только на то, какие написания считаются
+# одинаковыми, но никогда не ломает совпадение с исходным вариантом.
+HOMOGLYPHS: Dict[str, str] = {
+    # латиница → кириллица
+    "a": "а", "b": "в", "c": "с", "e": "е", "h": "н", "i": "и", "k": "к",
+    "l": "л", "m": "м", "o": "о", "p": "р", "t": "т", "x": "х", "y": "у",
+    # украинская/белорусская і и ё
+    "і": "и", "ї": "и", "ё": "е",
+    # leet
+    "0": "о", "1": "и", "3": "з", "4": "ч", "!": "и", "$": "с",
+}
+
+_HOMOGLYPH_TABLE = str.maketrans(HOMOGLYPHS)
+
+
+def normalize_text(text: str) -> str:
+    """Нижний регистр + свёртка гомоглифов и leet-замен (длина строки не меняется)."""
+    return text.lower().translate(_HOMOGLYPH_TABLE)
+
+
+# ─── ТРИГГЕРНЫЕ СЛОВА ────────────────────────────────────────────────────────
+
+class TriggerMatcher:
+    """Поиск триггерных слов за один проход по сообщению.
+
+    Все варианты всех слов собираются в одно регулярное выражение-альтернацию
+    (компилируется один раз), которое применяется к нормализованному тексту.
+    Семантика та же, что у прежнего цикла по вариантам: вариант должен
+    начинаться на границе слова, дальше допускается любое окончание
+    (r'\\b' + вариант + r'\\w*').
+
+    reload() пересобирает выражение и атомарно подменяет его — поиск в других
+    корутинах/потоках в этот момент продолжает работать со старой версией.
+    """
+
+    def __init__(self, words: Dict[str, Iterable[str]]):
+        self._lock = threading.Lock()
+        # (скомпилированное выражение, {нормализованный вариант → (слово, исходный вариант)})
+        # хранятся одним кортежем, чтобы find() никогда не увидел их вперемешку
+        self._compiled: Tuple[Optional["re.Pattern[str]"], Dict[str, Tuple[str, str]]] = (None, {})
+        self._words: Dict[str, List[str]] = {}
+        self.version = 0
+        self.reload(words)
+
+    @staticmethod
+    def _build(words: Dict[str, Iterable[str]]):
+        variants: Dict[str, Tuple[str, str]] = {}
+        for word, word_variants in words.items():
+            for variant in [word, *word_variants]:
+                variant = variant.strip()
+                if not variant:
+                    continue
+                variants.setdefault(normalize_text(variant), (word, variant))
+        if not variants:
+            return None, variants
+        # Длинные варианты — первыми, чтобы при общем префиксе в лог попадал
+        # самый точный вариант
+        alternation = "|".join(
+            re.escape(v) for v in sorted(variants, key=len, reverse=True)
+        )
+        return re.compile(r"\b(" + alternation + r")\w*"), variants
+
+    def reload(self, words: Dict[str, Iterable[str]]) -> int:
+        """Полностью заменяет словарь триггерных слов. Возвращает новую версию."""
+        normalized_words = {w: list(dict.fromkeys(v)) for w, v in words.items()}
+        pattern, variants = self._build(normalized_words)
+        with self._lock:
+            self._compiled = (pattern, variants)
+            self._words = normalized_words
+            self.version += 1
+            return self.version
+
+    def add(self, word: str, variants: Iterable[str] = ()) -> int:
+        """Добавляет слово (или новые варианты существующего) и пересобирает выражение."""
+        words = {w: list(v) for w, v in self._words.items()}
+        words.setdefault(word, [])
+        for variant in [word, *variants]:
+            if variant not in words[word]:
+                words[word].append(variant)
+        return self.reload(words)
+
+    def remove(self, word: str) -> bool:
+        """Удаляет слово со всеми вариантами. False — если такого слова не было."""
+        if word not in self._words:
+            return False
+        words = {w: list(v) for w, v in self._words.items() if w != word}
+        self.reload(words)
+        return True
+
+    @property
+    def words(self) -> Dict[str, List[str]]:
+        return {w: list(v) for w, v in self._words.items()}
+
+    def find(self, text: str) -> Optional[Tuple[str, str]]:
+        """Возвращает (слово, вариант) первого найденного триггера или None."""
+        pattern, variants = self._compiled
+        if pattern is None or not text:
+            return None
+        match = pattern.search(normalize_text(text))
+        if match is None:
+            return None
+        return variants[match.group(1)]
+
+
+# ─── ОБЪЯВЛЕНИЯ ──────────────────────────────────────────────────────────────
+
+# Группа ключевых слов → (вес, словоформы). Совпадение — только целым
+# словом: основы вроде «меня», «отда», «опт», «руб» цепляли обычную речь
+# («у меня», «отдал», «оптика», «рубашку»). Группа учитывается один раз,
+# сколько бы её форм ни встретилось.
+AD_KEYWORDS: Dict[str, Tuple[float, Tuple[str, ...]]] = {
+    "sell": (1.5, ("продам", "продаю", "продаётся", "продается", "продаются", "продажа")),
+    "buy": (1.5, ("куплю", "скуплю")),
+    "buying": (1.0, ("покупаю", "покупаем")),
+    "exchange": (1.0, ("обмен", "меняю", "обменяю", "обменяюсь")),
+    "giveaway": (0.7, ("отдам", "отдаю")),
+    "free": (0.5, ("даром", "бесплатно")),
+    "price": (1.0, ("цена", "цены", "ценник", "стоимость")),
+    "delivery": (0.7, ("доставка", "доставкой", "доставку")),
+    "pickup": (1.0, ("самовывоз", "самовывозом")),
+    "collect": (0.3, ("забрать",)),
+    "wholesale": (1.0, ("опт", "оптом")),
+    "in_stock": (1.0, ("в наличии",)),
+    "bargain": (0.7, ("торг", "торгуемся")),
+    "contact": (0.5, ("пишите", "писать в лс")),
+    "dm": (0.3, ("лс", "тг", "телеграм")),
+}
+
+# Признаки помимо ключевых слов: (регулярное выражение, вес, символы, с
+# которых может начинаться совпадение — для быстрого пропуска позиций).
+# Цена — только число с валютой: «2к осталось» или «5 р-н» ценой не считаются
+AD_FEATURES: Dict[str, Tuple[str, float, str]] = {
+    "price_value": (
+        r"(?<![\w.,])\d[\d\s.,]*(?:к|k|тыс\.?)?\s?(?:₽|руб(?:\.|лей|ля|ль)?(?![\w-])|р(?:\.|(?![\w-])))",
+        1.5, "0123456789",
+    ),
+    "phone": (r"(?:\+7|(?<!\d)8)[\s\-()]*\d{3}[\s\-()]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}", 1.0, "+8"),
+    "handle": (r"@[a-z0-9_]{4,}", 0.7, "@"),
+    "link": (r"t\.me/", 0.7, "t"),
+}
+
+AD_LONG_TEXT = 150          # символов — длинный текст чуть повышает оценку
+AD_LONG_TEXT_WEIGHT = 0.3
+AD_THRESHOLD = 2.0
+
+
+class AdScore(NamedTuple):
+    score: float
+    features: Tuple[str, ...]
+
+
+class AdClassifier:
+    """Оценка «похожести на объявление» за один проход по тексту.
+
+    Ключевые слова и признаки (цена, телефон, @username, ссылка t.me)
+    собраны в одно регулярное выражение с именованными группами (текст
+    приводится к нижнему регистру, гомоглифы не сворачиваются — иначе
+    испортились бы @username и ссылки). Каждое
+    ключевое слово и каждый признак учитываются один раз, сумма весов
+    сравнивается с порогом.
+    """
+
+    def __init__(
+        self,
+        keywords: Dict[str, Tuple[float, Tuple[str, ...]]] = None,
+        features: Dict[str, Tuple[str, float, str]] = None,
+        threshold: float = AD_THRESHOLD,
+    ):
+        self.keywords = dict(AD_KEYWORDS if keywords is None else keywords)
+        self.features = dict(AD_FEATURES if features is None else features)
+        self.threshold = threshold
+        # словоформа → группа
+        self._forms = {form: group for group, (_, forms) in self.keywords.items() for form in forms}
+        parts = [f"(?P<{name}>{pattern})" for name, (pattern, _, _) in self.features.items()]
+        # Длинные формы первыми — чтобы «обменяю» не проиграло «обмен»
+        alternation = "|".join(re.escape(k) for k in sorted(self._forms, key=len, reverse=True))
+        parts.append(rf"(?<!\w)(?P<kw>{alternation})(?!\w)")
+        # Опережающая проверка первого символа отсекает большинство позиций
+        # раньше, чем движок начнёт перебирать все альтернативы (~1.5x быстрее)
+        starts = {k[0] for k in self._forms}
+        for _, _, first_chars in self.features.values():
+            starts.update(first_chars)
+        lookahead = "(?=[" + re.escape("".join(sorted(starts))) + "])"
+        self._pattern = re.compile(lookahead + "(?:" + "|".join(parts) + ")")
+        self._feature_weights = {name: weight for name, (_, weight, _) in self.features.items()}
+
+    def score(self, text: str) -> AdScore:
+        if not text:
+            return AdScore(0.0, ())
+        seen: Dict[str, float] = {}
+        for match in self._pattern.finditer(text.lower()):
+            name = match.lastgroup
+            if name == "kw":
+                group = self._forms[match.group("kw")]
+                seen.setdefault(group, self.keywords[group][0])
+            else:
+                seen.setdefault(name, self._feature_weights[name])
+        if len(text) > AD_LONG_TEXT:
+            seen["long"] = AD_LONG_TEXT_WEIGHT
+        return AdScore(float(sum(seen.values())), tuple(seen))
+
+    def is_ad(self, text: str) -> bool:
+        return self.score(text).score >= self.threshold
+
+    def score_many(self, texts: Iterable[str]) -> List[AdScore]:
+        """Пакетная оценка (например, пересчёт истории user_ads)."""
+        score = self.score
+        return [score(text) for text in texts]
+
+
+# ─── ОТПЕЧАТКИ ОБЪЯВЛЕНИЙ (повторы и правки) ─────────────────────────────────
+
+SIMHASH_BITS = 64
+SIMHASH_SHINGLE = 4         # символьные 4-граммы
+# Порог подобран на примерах из чата: правка цены/пары слов в объявлении —
+# 4–9 бит, разные объявления одного продавца по общему шаблону — от 20 бит
+SIMHASH_MAX_DISTANCE = 12
+_WORD_RE = re.compile(r"\w+")
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def _shingle_hash(shingle: str) -> int:
+    # blake2b, а не hash(): встроенный hash солится при каждом запуске,
+    # а отпечатки хранятся в БД
+    return int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+
+
+def simhash(text: str) -> Optional[int]:
+    """64-битный SimHash текста по символьным 4-граммам.
+
+    Перед подсчётом текст нормализуется (регистр, гомоглифы), пунктуация
+    отбрасывается, числа сводятся к «0» — правка цены или состояния не
+    делает объявление новым. None — если текста слишком мало."""
+    words = _WORD_RE.findall(_DIGITS_RE.sub("0", normalize_text(text)))
+    if len(words) < 3:
+        return None
+    flat = " ".join(words)
+    shingles = {flat[i:i + SIMHASH_SHINGLE] for i in range(len(flat) - SIMHASH_SHINGLE + 1)}
+    # Голосование по битам: хэши как строки из 0/1, столбцы считает zip/count
+    # (в разы быстрее цикла по 64 битам на каждую 4-грамму)
+    rows = [format(_shingle_hash(shingle), "064b") for shingle in shingles]
+    half = len(rows) / 2
+    bits = "".join("1" if column.count("1") > half else "0" for column in map("".join, zip(*rows)))
+    return int(bits, 2)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class AdFingerprintIndex:
+    """Отпечатки объявлений каждого пользователя за окно времени.
+
+    Лимит объявлений держит историю пользователя за окно в пределах
+    нескольких записей, поэтому поиск — сравнение с ними по расстоянию
+    Хэмминга, без обращения ко всей истории user_ads.
+    """
+
+    def __init__(self, window: float, max_distance: int = SIMHASH_MAX_DISTANCE):
+        self.window = window
+        self.max_distance = max_distance
+        # user_id → [(отпечаток, время)] по возрастанию времени
+        self._entries: Dict[int, List[Tuple[int, float]]] = {}
+
+    def add(self, user_id: int, fingerprint: int, ts: float):
+        self._entries.setdefault(user_id, []).append((fingerprint, ts))
+
+    def find(self, user_id: int, fingerprint: int, now: float) -> Optional[Tuple[float, int]]:
+        """(время самого свежего похожего объявления, расстояние) или None."""
+        entries = self._entries.get(user_id)
+        if not entries:
+            return None
+        horizon = now - self.window
+        entries[:] = [entry for entry in entries if entry[1] >= horizon]
+        if not entries:
+            del self._entries[user_id]
+            return None
+        for other, ts in reversed(entries):
+            distance = hamming(fingerprint, other)
+            if distance <= self.max_distance:
+                return ts, distance
+        return None
+
+    def prune(self, now: float):
+        horizon = now - self.window
+        for user_id in list(self._entries):
+            entries = [entry for entry in self._entries[user_id] if entry[1] >= horizon]
+            if entries:
+                self._entries[user_id] = entries
+            else:
+                del self._entries[user_id]
+
+
+# ─── ФЛУД И СПАМ ─────────────────────────────────────────────────────────────
+
+_EMOJI_RE = re.compile("[\U0001F300-\U0001FAFF☀-➿⬀-⯿]")
+_CHAR_RUN_RE = re.compile(r"(.)\1{9,}")   # 10+ одинаковых символов подряд
+
+
+class _FloodState:
+    """Кольцевые буферы последних сообщений одного пользователя."""
+
+    __slots__ = ("times", "hashes", "pos", "seen", "last_seen", "flagged_at", "strikes", "strike_at")
+
+    def __init__(self, size: int):
+        self.times = array("d", bytes(8 * size))
+        self.hashes = array("q", bytes(8 * size))
+        self.pos = 0
+        self.seen = 0
+        self.last_seen = 0.0
+        self.flagged_at = float("-inf")
+        self.strikes = 0
+        self.strike_at = float("-inf")
+
+
+class FloodVerdict(NamedTuple):
+    reason: str     # "burst" | "repeat" | "chars" | "emoji"
+    strikes: int    # нарушений подряд (в пределах strike_window), включая это
+
+
+class FloodDetector:
+    """Потоковый детектор флуда: частота сообщений, повторы, флуд символами.
+
+    Состояние пользователя — объект со __slots__ и два массива фиксированного
+    размера (время и хэш текста последних size сообщений); на сообщение —
+    несколько сравнений без выделения новых структур.
+    """
+
+    def __init__(
+        self,
+        size: int = 8,
+        burst_count: int = 5,
+        burst_seconds: float = 4.0,
+        repeat_count: int = 3,
+        repeat_seconds: float = 60.0,
+        cooldown: float = 10.0,
+        strike_window: float = 600.0,
+    ):
+        self.size = size
+        self.burst_count = min(burst_count, size)
+        self.burst_seconds = burst_seconds
+        self.repeat_count = min(repeat_count, size)
+        self.repeat_seconds = repeat_seconds
+        self.cooldown = cooldown
+        self.strike_window = strike_window
+        self._states: Dict[int, _FloodState] = {}
+        self._calls = 0
+
+    @staticmethod
+    def _content_reason(text: str) -> Optional[str]:
+        length = len(text)
+        if length >= 12:
+            if _CHAR_RUN_RE.search(text):
+                return "chars"
+            emoji = len(_EMOJI_RE.findall(text))
+            if emoji >= 10 and emoji * 2 > length:
+                return "emoji"
+        return None
+
+    def check(self, user_id: int, text: str, now: float) -> Optional[FloodVerdict]:
+        state = self._states.get(user_id)
+        if state is None:
+            state = self._states[user_id] = _FloodState(self.size)
+        size = self.size
+        content_hash = hash(normalize_text(text).strip())
+        pos = state.pos
+        state.times[pos] = now
+        state.hashes[pos] = content_hash
+        state.pos = (pos + 1) % size
+        state.seen += 1
+        state.last_seen = now
+
+        self._calls += 1
+        if self._calls % 10000 == 0:
+            self.prune(now)
+
+        reason = self._content_reason(text)
+        if reason is None:
+            # Сообщение, отправленное burst_count сообщений назад, — слишком недавно?
+            if (state.seen >= self.burst_count
+                    and now - state.times[(pos - self.burst_count + 1) % size] <= self.burst_seconds):
+                reason = "burst"
+        if reason is None:
+            repeats = 0
+            for i in range(min(state.seen, size)):
+                if state.hashes[i] == content_hash and now - state.times[i] <= self.repeat_seconds:
+                    repeats += 1
+            if repeats >= self.repeat_count:
+                reason = "repeat"
+        if reason is None or now - state.flagged_at < self.cooldown:
+            return None
+
+        state.flagged_at = now
+        state.strikes = state.strikes + 1 if now - state.strike_at <= self.strike_window else 1
+        state.strike_at = now
+        return FloodVerdict(reason, state.strikes)
+
+    def prune(self, now: float):
+        """Убирает состояние пользователей, молчащих дольше strike_window."""
+        horizon = now - self.strike_window
+        for user_id in [u for u, s in self._states.items() if s.last_seen < horizon]:
+            del self._states[user_id]
@@ -4,12 +4,19 @@ import asyncio
 import logging
 import random
 import secrets
-import psycopg2
-import psycopg2.pool
-import psycopg2.extras
-import psycopg2.extensions
+import time
+import gzip
+import html
+import math
+import heapq
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager, asynccontextmanager
+import psycopg
+import psycopg.conninfo
+import psycopg_pool
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Set, Tuple, Any
+from typing import Optional, Dict, Iterable, List, Set, Tuple, Any, Union
 import pytz
 
 from aiogram import Bot, Dispatcher, types, F
@@ -26,13 +33,22 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
+    Update,
 )
 from aiogram.enums import ChatMemberStatus, ChatType
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter, TelegramForbiddenError
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods.base import Request, TelegramMethod
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
 from logging.handlers import RotatingFileHandler
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from psycopg.types.json import Jsonb
+
+from chat_filters import AD_THRESHOLD, AdClassifier, AdFingerprintIndex, FloodDetector, TriggerMatcher, simhash
 
 class AdminComplaintStates(StatesGroup):
     waiting_for_username = State()
@@ -98,7 +114,7 @@ def get_moscow_time():
 
 def format_moscow_time(db_time_str):
     """Конвертирует время из БД в московское время и форматирует.
-    Принимает и строку (как отдавал sqlite3), и datetime (как отдаёт psycopg2 —
+    Принимает и строку (как отдавал sqlite3), и datetime (как отдаёт psycopg —
     для колонок TIMESTAMP значения приходят уже готовыми объектами datetime,
     без необходимости парсить их из строки)."""
     if not db_time_str:
@@ -130,41 +146,41 @@ MIN_AD_INTERVAL_HOURS = float(os.getenv("MIN_AD_INTERVAL_HOURS", "1.5"))
 MUTE_DURATION_DAYS = int(os.getenv("MUTE_DURATION_DAYS", "1"))
 
 MIN_AD_INTERVAL = timedelta(hours=MIN_AD_INTERVAL_HOURS)
+# Санкции за лимит объявлений: "log" — нарушение только пишется в журнал
+# (пока классификатор не проверен на реальной переписке), "enforce" — удаление и мут
+AD_ENFORCE_MODE = os.getenv("AD_ENFORCE_MODE", "log").strip().lower()
+# То же для антифлуда: "log" — только журнал, "enforce" — удаление, варн и мут
+FLOOD_ENFORCE_MODE = os.getenv("FLOOD_ENFORCE_MODE", "log").strip().lower()
+# В лимиты засчитываются только сообщения с оценкой не ниже этой — строже
+# AD_SCORE_THRESHOLD, чтобы пограничные сообщения не приводили к муту
+AD_ENFORCE_SCORE = float(os.getenv("AD_ENFORCE_SCORE", "3.0"))
 MUTE_DURATION = timedelta(days=MUTE_DURATION_DAYS)
 
 # ID чата для журнала модерации
 MOD_LOG_CHAT_ID = -1003838979861
 
-# Функции для работы с базой данных (должны быть определены ДО init_db(),
-# так как init_db() вызывается на верхнем уровне модуля при импорте —
-# порядок объявлений в файле здесь важен)
-_DB_POOL: "psycopg2.pool.ThreadedConnectionPool" = None
+# Функции для работы с базой данных.
+# Весь доступ к PostgreSQL идёт через асинхронный пул psycopg 3: запросы
+# выполняются без блокировки event loop, так что медленный SELECT больше
+# не задерживает обработку остальных апдейтов. SQL при этом остался прежним
+# (плейсхолдеры %s поддерживаются psycopg 3 так же, как psycopg2).
+_DB_POOL: "psycopg_pool.AsyncConnectionPool" = None
 
-def _get_pg_pool():
-    global _DB_POOL
-    if _DB_POOL is None:
-        _DB_POOL = psycopg2.pool.ThreadedConnectionPool(
-            minconn=1, maxconn=20,
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432"),
-            user=os.getenv("POSTGRES_USER", "vapeneon"),
-            password=os.getenv("POSTGRES_PASSWORD", ""),
-            dbname=os.getenv("POSTGRES_DB", "vapeneon"),
-        )
-    return _DB_POOL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
 
 
 class HybridRow(dict):
     """Строка результата запроса, ведущая себя как sqlite3.Row:
     поддерживает и доступ по имени колонки (row["username"]), и по числовому
-    индексу (row[0]), и dict(row). Обычный psycopg2.extras.RealDictRow
+    индексу (row[0]), и dict(row). Обычный dict_row из psycopg
     поддерживает только доступ по имени — этого гибрида не хватало бы
     для кода, написанного изначально под sqlite3.Row.
 
     ВАЖНО: обычный dict при переборе (for x in row / for a, b in row)
     отдаёт КЛЮЧИ. sqlite3.Row вместо этого отдаёт ЗНАЧЕНИЯ по порядку
     колонок (как обычный tuple) — именно на это рассчитан весь код вида
-    `for user_id, chat_id in cursor.fetchall():`. Поэтому __iter__ здесь
+    `for user_id, chat_id in await cursor.fetchall():`. Поэтому __iter__ здесь
     обязательно переопределён — без этого такой код молча получает вместо
     значений имена столбцов ("user_id" вместо, например, 123456789)."""
 
@@ -177,78 +193,103 @@ class HybridRow(dict):
         return iter(self.values())
 
 
-class HybridCursor(psycopg2.extensions.cursor):
-    """Обычный psycopg2-курсор (строки — plain tuples), но fetch-методы
-    оборачивают каждую строку в HybridRow, используя cursor.description
-    для имён колонок. Не зависит от приватных методов RealDictCursor."""
+def hybrid_row_factory(cursor):
+    """row_factory для psycopg 3: каждая строка оборачивается в HybridRow,
+    имена колонок берутся из cursor.description."""
+    cols = [d.name for d in cursor.description] if cursor.description else []
 
-    def _wrap(self, raw_row):
-        if raw_row is None:
-            return None
-        cols = [d[0] for d in self.description]
-        return HybridRow(zip(cols, raw_row))
+    def make_row(values):
+        return HybridRow(zip(cols, values))
 
-    def fetchone(self):
-        return self._wrap(super().fetchone())
+    return make_row
 
-    def fetchall(self):
-        return [self._wrap(r) for r in super().fetchall()]
 
-    def fetchmany(self, size=None):
-        rows = super().fetchmany(size) if size is not None else super().fetchmany()
-        return [self._wrap(r) for r in rows]
+def _pg_conninfo() -> str:
+    return psycopg.conninfo.make_conninfo(
+        host=os.getenv("POSTGRES_HOST", "localhost"),
+        port=os.getenv("POSTGRES_PORT", "5432"),
+        user=os.getenv("POSTGRES_USER", "vapeneon"),
+        password=os.getenv("POSTGRES_PASSWORD", ""),
+        dbname=os.getenv("POSTGRES_DB", "vapeneon"),
+    )
 
-    def __iter__(self):
-        for raw_row in super().__iter__():
-            yield self._wrap(raw_row)
+
+async def _get_pg_pool() -> "psycopg_pool.AsyncConnectionPool":
+    global _DB_POOL
+    if _DB_POOL is None:
+        pool = psycopg_pool.AsyncConnectionPool(
+            _pg_conninfo(),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            kwargs={"row_factory": hybrid_row_factory},
+            open=False,
+        )
+        await pool.open()
+        _DB_POOL = pool
+    return _DB_POOL
+
+
+async def close_db_pool():
+    """Закрывает пул соединений (при остановке бота)."""
+    global _DB_POOL
+    if _DB_POOL is not None:
+        await _DB_POOL.close()
+        _DB_POOL = None
 
 
 class _PooledConn:
-    """Обёртка над соединением из пула psycopg2: даёт тот же интерфейс,
-    которым пользовался весь остальной код бота при работе со sqlite3
-    (conn.cursor(), conn.execute(), conn.commit(), conn.close()),
-    но close() возвращает соединение в пул вместо разрыва TCP-сессии."""
+    """Обёртка над асинхронным соединением из пула: тот же интерфейс,
+    которым пользуется весь остальной код бота (conn.cursor(), conn.execute(),
+    conn.commit(), conn.close()), только execute/fetch*/commit/close —
+    корутины. close() возвращает соединение в пул вместо разрыва TCP-сессии."""
 
-    def __init__(self, raw):
+    def __init__(self, pool, raw):
+        self._pool = pool
         self._raw = raw
-        raw.cursor_factory = HybridCursor
 
     def cursor(self):
         return self._raw.cursor()
 
-    def execute(self, sql, params=()):
-        cur = self._raw.cursor()
-        cur.execute(sql, params)
-        return cur
+    async def execute(self, sql, params=None):
+        return await self._raw.execute(sql, params)
 
-    def executemany(self, sql, seq_of_params):
+    async def executemany(self, sql, seq_of_params):
         cur = self._raw.cursor()
-        cur.executemany(sql, seq_of_params)
+        await cur.executemany(sql, seq_of_params)
         return cur
 
-    def commit(self):
-        self._raw.commit()
+    async def commit(self):
+        await self._raw.commit()
 
-    def rollback(self):
-        self._raw.rollback()
+    async def rollback(self):
+        await self._raw.rollback()
 
-    def close(self):
-        _get_pg_pool().putconn(self._raw)
+    async def close(self):
+        # Незакоммиченная транзакция (обычно — просто SELECT) откатывается
+        # здесь, а не внутри пула: иначе psycopg_pool пишет warning
+        # на каждый возврат соединения после чтения
+        if self._raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            try:
+                await self._raw.rollback()
+            except Exception:
+                pass
+        await self._pool.putconn(self._raw)
 
 
-def get_db_connection():
-    """Возвращает соединение с базой данных (из пула PostgreSQL)."""
-    raw = _get_pg_pool().getconn()
-    return _PooledConn(raw)
+async def get_db_connection() -> _PooledConn:
+    """Возвращает соединение с базой данных (из асинхронного пула PostgreSQL)."""
+    pool = await _get_pg_pool()
+    raw = await pool.getconn()
+    return _PooledConn(pool, raw)
 
 
 # Инициализация базы данных
-def init_db():
-    conn = get_db_connection()
+async def init_db():
+    conn = await get_db_connection()
     cursor = conn.cursor()
 
     # Таблица для варнов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS warns (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -261,7 +302,7 @@ def init_db():
     )
 
     # Таблица для мутов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS mutes (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -275,7 +316,7 @@ def init_db():
     )
 
     # Таблица для банов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS bans (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -289,7 +330,7 @@ def init_db():
     )
 
     # Таблица для предупреждений администраторов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS admin_warns (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -301,7 +342,7 @@ def init_db():
     )
 
     # Таблица для администраторов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS admins (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL UNIQUE,
@@ -312,11 +353,28 @@ def init_db():
     )"""
     )
     
-    cursor.execute("ALTER TABLE admins ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'moderator'")
-    cursor.execute("ALTER TABLE admins ADD COLUMN IF NOT EXISTS display_name TEXT")
+    await cursor.execute("ALTER TABLE admins ADD COLUMN IF NOT EXISTS role TEXT DEFAULT 'moderator'")
+    await cursor.execute("ALTER TABLE admins ADD COLUMN IF NOT EXISTS display_name TEXT")
+
+    # Любое изменение таблицы admins (в том числе не из бота — руками, миграцией,
+    # другим экземпляром) рассылает NOTIFY admins_changed, по которому бот
+    # перечитывает кэш администраторов (см. AdminRegistry)
+    await cursor.execute(
+        """CREATE OR REPLACE FUNCTION notify_admins_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('admins_changed', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql"""
+    )
+    await cursor.execute("DROP TRIGGER IF EXISTS admins_changed ON admins")
+    await cursor.execute(
+        """CREATE TRIGGER admins_changed AFTER INSERT OR UPDATE OR DELETE ON admins
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_admins_changed()"""
+    )
 
     # Таблица для истории объявлений
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS user_ads (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -326,7 +384,7 @@ def init_db():
     )
 
     # Таблица для нарушений лимита объявлений
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS ad_limit_violations (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -337,7 +395,7 @@ def init_db():
     )
 
     # Таблица для донатов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS donations (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -350,7 +408,7 @@ def init_db():
     )
 
     # Таблица для жалоб на администраторов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS admin_complaints (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -368,7 +426,7 @@ def init_db():
     )
     
     # Таблица для блокировок доступа к боту
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS bot_blocks (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL UNIQUE,
@@ -380,7 +438,7 @@ def init_db():
     )
 
     # Таблица для предупреждений в боте
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS bot_warns (
         id SERIAL PRIMARY KEY,
         user_id INTEGER NOT NULL,
@@ -392,7 +450,7 @@ def init_db():
     )
 
     # Таблица для отзывов о пользователях
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS user_reviews (
         id SERIAL PRIMARY KEY,
         from_user_id INTEGER NOT NULL,
@@ -408,7 +466,7 @@ def init_db():
     # ============================================================
     
     # Таблица сделок
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS safe_deals (
             id TEXT PRIMARY KEY,
             creator_id INTEGER,
@@ -436,7 +494,7 @@ def init_db():
     ''')
     
     # Таблица отзывов о сделках
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS safe_deal_reviews (
             id SERIAL PRIMARY KEY,
             deal_id TEXT,
@@ -449,7 +507,7 @@ def init_db():
     ''')
     
     # Таблица балансов пользователей
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS safe_deal_balances (
             user_id INTEGER PRIMARY KEY,
             balance REAL DEFAULT 0.0
@@ -457,7 +515,7 @@ def init_db():
     ''')
     
     # Таблица заявок на вывод
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS safe_deal_withdrawals (
             id SERIAL PRIMARY KEY,
             user_id INTEGER,
@@ -469,7 +527,7 @@ def init_db():
     ''')
     
     # Таблица отзывов о сервисе
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS safe_deal_service_reviews (
             id SERIAL PRIMARY KEY,
             reviewer_id INTEGER,
@@ -480,7 +538,7 @@ def init_db():
     ''')
 
     # Таблица для хранения ID периодических сообщений (правил/заказов/жалоб)
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS periodic_messages (
             id SERIAL PRIMARY KEY,
             message_id INTEGER NOT NULL,
@@ -490,7 +548,7 @@ def init_db():
     ''')
 
     # Таблица пользователей, запустивших бота (реестр для поиска по username)
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS bot_users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -499,33 +557,167 @@ def init_db():
             last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_users_username ON bot_users(username)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_users_username ON bot_users(username)")
+    # Отложенные удаления сообщений бота (см. DeferredDeletions)
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_deletions (
+            id SERIAL PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            message_id BIGINT NOT NULL,
+            delete_at TIMESTAMP NOT NULL,
+            UNIQUE (chat_id, message_id)
+        )
+    ''')
+
+    # Состояния FSM (см. PostgresStorage)
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage(expires_at)")
+
+    # Пользователь заблокировал бота — пропускаем его в рассылках
+    await cursor.execute("ALTER TABLE bot_users ADD COLUMN IF NOT EXISTS is_blocked BOOLEAN DEFAULT FALSE")
+
+    # Рассылки в боте: задание и статус доставки каждому получателю
+    # (позволяет продолжить рассылку после перезапуска)
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            created_by BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'running',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            progress_chat_id BIGINT,
+            progress_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            error TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (job_id, user_id)
+        )
+    ''')
+    await cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_pending "
+        "ON broadcast_deliveries(job_id, user_id) WHERE status = 'pending'"
+    )
+
+    # Единый журнал наказаний (пишет MODERATION и сайт); записи не удаляются
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS moderation_events (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            issued_by BIGINT,
+            issued_by_name TEXT,
+            reason TEXT,
+            expires_at TIMESTAMP,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_moderation_events_created ON moderation_events(created_at DESC, id DESC)"
+    )
+    await cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_moderation_events_kind ON moderation_events(kind, created_at DESC, id DESC)"
+    )
+    await cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_moderation_events_user ON moderation_events(user_id, created_at DESC, id DESC)"
+    )
+    # Первый запуск: переносим историю из таблиц наказаний
+    await cursor.execute('''
+        INSERT INTO moderation_events (kind, user_id, chat_id, issued_by, reason, expires_at, created_at)
+        SELECT kind, user_id, chat_id, issued_by, reason, expires_at, COALESCE(issued_at, CURRENT_TIMESTAMP) AS created_at
+        FROM (
+            SELECT 'warn' AS kind, user_id, chat_id, issued_by, reason, expires_at, issued_at FROM warns
+            UNION ALL
+            SELECT 'mute', user_id, chat_id, issued_by, reason, expires_at, issued_at FROM mutes
+            UNION ALL
+            SELECT 'ban', user_id, chat_id, issued_by, reason, expires_at, issued_at FROM bans
+            UNION ALL
+            SELECT 'admin_warn', user_id, NULL, issued_by, reason, NULL, issued_at FROM admin_warns
+            UNION ALL
+            SELECT 'bot_warn', user_id, NULL, issued_by, reason, NULL, issued_at FROM bot_warns
+        ) history
+        WHERE NOT EXISTS (SELECT 1 FROM moderation_events)
+        ORDER BY created_at
+    ''')
+
+    # Журнал модерации: каждое событие, ушедшее в MOD_LOG_CHAT_ID
+    await cursor.execute('''
+        CREATE TABLE IF NOT EXISTS mod_events (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            user_id BIGINT,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_mod_events_created ON mod_events(created_at)")
+    await cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_mod_events_user ON mod_events(user_id, created_at) WHERE user_id IS NOT NULL"
+    )
 
     # Индексы
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_warns_user_chat ON warns(user_id, chat_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_warns_expires ON warns(expires_at)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mutes_user_chat ON mutes(user_id, chat_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_mutes_expires ON mutes(expires_at)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_user_chat ON bans(user_id, chat_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_expires ON bans(expires_at)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_ads_user_date ON user_ads(user_id, sent_at)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_status ON admin_complaints(status)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_user ON admin_complaints(user_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_created ON admin_complaints(created_at)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_blocks_user ON bot_blocks(user_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_blocks_active ON bot_blocks(is_active)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_warns_user ON bot_warns(user_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_warns_active ON bot_warns(is_active)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_reviews_to_user ON user_reviews(to_user_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_reviews_from_user ON user_reviews(from_user_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_warns_user_chat ON warns(user_id, chat_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_warns_expires ON warns(expires_at)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_mutes_user_chat ON mutes(user_id, chat_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_mutes_expires ON mutes(expires_at)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_user_chat ON bans(user_id, chat_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bans_expires ON bans(expires_at)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_ads_user_date ON user_ads(user_id, sent_at)")
+    # SimHash-отпечаток текста объявления (см. AD_FINGERPRINTS)
+    await cursor.execute("ALTER TABLE user_ads ADD COLUMN IF NOT EXISTS fingerprint BIGINT")
+    # Одна строка нарушений на пользователя в день — для upsert в add_ad_violation.
+    # Дубли (от прежней проверки SELECT-then-INSERT) сворачиваем в одну строку.
+    await cursor.execute('''
+        UPDATE ad_limit_violations v SET violation_count = d.total
+        FROM (
+            SELECT MIN(id) AS keep_id, SUM(violation_count) AS total
+            FROM ad_limit_violations GROUP BY user_id, violation_date HAVING COUNT(*) > 1
+        ) d
+        WHERE v.id = d.keep_id
+    ''')
+    await cursor.execute('''
+        DELETE FROM ad_limit_violations a USING ad_limit_violations b
+        WHERE a.user_id = b.user_id AND a.violation_date = b.violation_date AND a.id > b.id
+    ''')
+    await cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_ad_limit_violations_user_day "
+        "ON ad_limit_violations(user_id, violation_date)"
+    )
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_status ON admin_complaints(status)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_user ON admin_complaints(user_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_admin_complaints_created ON admin_complaints(created_at)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_blocks_user ON bot_blocks(user_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_blocks_active ON bot_blocks(is_active)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_warns_user ON bot_warns(user_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_bot_warns_active ON bot_warns(is_active)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_reviews_to_user ON user_reviews(to_user_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_reviews_from_user ON user_reviews(from_user_id)")
     
     # Индексы для безопасных сделок
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_buyer ON safe_deals(buyer_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_seller ON safe_deals(seller_id)")
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_status ON safe_deals(status)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_buyer ON safe_deals(buyer_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_seller ON safe_deals(seller_id)")
+    await cursor.execute("CREATE INDEX IF NOT EXISTS idx_safe_deals_status ON safe_deals(status)")
 
     # Таблица для хранения пользователей, принявших пользовательское соглашение
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS tos_accepted (
             user_id INTEGER PRIMARY KEY,
             accepted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
@@ -533,7 +725,7 @@ def init_db():
     ''')
 
     # Таблица товаров для магазина
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS shop_products (
             id SERIAL PRIMARY KEY,
             category TEXT NOT NULL,
@@ -547,7 +739,7 @@ def init_db():
     ''')
 
     # Таблица для нескольких фото товара
-    cursor.execute('''
+    await cursor.execute('''
         CREATE TABLE IF NOT EXISTS shop_product_photos (
             id SERIAL PRIMARY KEY,
             product_id INTEGER NOT NULL,
@@ -557,8 +749,21 @@ def init_db():
         )
     ''')
 
+    # Дополнительные триггерные слова, добавленные владельцами через бота
+    # (базовый список — TRIGGER_WORDS в коде)
+    await cursor.execute(
+        """CREATE TABLE IF NOT EXISTS trigger_words (
+        id SERIAL PRIMARY KEY,
+        word TEXT NOT NULL,
+        variant TEXT NOT NULL,
+        added_by BIGINT NOT NULL,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (word, variant)
+    )"""
+    )
+
     # Таблица состояния набора администраторов
-    cursor.execute(
+    await cursor.execute(
         """CREATE TABLE IF NOT EXISTS admin_quest_state (
         id INTEGER PRIMARY KEY CHECK (id = 1),
         is_open BOOLEAN DEFAULT FALSE,
@@ -566,66 +771,128 @@ def init_db():
         applications_count INTEGER DEFAULT 0
     )"""
     )
-    cursor.execute(
+    await cursor.execute(
         "INSERT INTO admin_quest_state (id, is_open, max_applications, applications_count) "
         "VALUES (1, FALSE, NULL, 0) ON CONFLICT (id) DO NOTHING"
     )
 
-    conn.commit()
-    conn.close()
+    # Миграция для существующих БД: добавляем group_chat_id если ещё нет
+    await cursor.execute("ALTER TABLE safe_deals ADD COLUMN IF NOT EXISTS group_chat_id INTEGER DEFAULT NULL")
 
-init_db()
+    # Помесячное секционирование журналов (см. RETENTION_POLICIES)
+    for policy in RETENTION_POLICIES:
+        if policy.partitioned:
+            await ensure_partitioned(cursor, policy.table, policy.column)
 
-# Миграция для существующих БД: добавляем group_chat_id если ещё нет
-try:
-    _conn = get_db_connection()
+    await conn.commit()
+    await conn.close()
 
-    _conn.execute("ALTER TABLE safe_deals ADD COLUMN group_chat_id INTEGER DEFAULT NULL")
-    _conn.commit()
-    _conn.close()
-except Exception:
-    pass  # Колонка уже существует
-
-def register_bot_user(user):
-    """Сохраняет/обновляет запись о пользователе, запустившем бота.
-    Принимает объект types.User из aiogram."""
-    try:
-        conn = get_db_connection()
-
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO bot_users (user_id, username, first_name, last_name, last_seen)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username   = excluded.username,
-                first_name = excluded.first_name,
-                last_name  = excluded.last_name,
-                last_seen  = excluded.last_seen
-        ''', (
-            user.id,
-            (user.username or "").lower() if user.username else None,
+# ============================================================
+#          ЗАПИСЬ В bot_users С ОТЛОЖЕННЫМ СБРОСОМ
+# ============================================================
+# register_bot_user только кладёт пользователя в буфер (последняя запись
+# по user_id побеждает); буфер сбрасывается одним многострочным
+# INSERT ... ON CONFLICT раз в BOT_USERS_FLUSH_INTERVAL. Если имя и username
+# не менялись, а last_seen обновлялся недавно, запись не нужна вовсе.
+
+BOT_USERS_FLUSH_INTERVAL = 0.3            # секунд
+BOT_USERS_LAST_SEEN_REFRESH = 3600        # секунд — как часто обновлять last_seen без изменений
+
+
+class BotUserWriter:
+    def __init__(self):
+        # user_id → (username, first_name, last_name, last_seen)
+        self._pending: Dict[int, Tuple[Optional[str], Optional[str], Optional[str], datetime]] = {}
+        # user_id → ((username, first_name, last_name), когда записано)
+        self._written: "OrderedDict[int, Tuple[tuple, float]]" = OrderedDict()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def add(self, user):
+        profile = (
+            user.username.lower() if user.username else None,
             user.first_name,
             user.last_name,
-            datetime.now()
-        ))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logger.error(f"Ошибка регистрации пользователя {user.id}: {e}")
+        )
+        written = self._written.get(user.id)
+        if (
+            written and written[0] == profile
+            and time.monotonic() - written[1] < BOT_USERS_LAST_SEEN_REFRESH
+        ):
+            return
+        self._pending[user.id] = (*profile, datetime.now())
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    def forget(self, user_ids):
+        """Сбрасывает кэш записанных профилей (строка в БД изменилась в обход буфера)."""
+        for user_id in user_ids:
+            self._written.pop(user_id, None)
+
+    async def _flush_later(self):
+        await asyncio.sleep(BOT_USERS_FLUSH_INTERVAL)
+        await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            rows = [(user_id, *values) for user_id, values in batch.items()]
+            try:
+                conn = await get_db_connection()
+                cursor = conn.cursor()
+                await cursor.execute(
+                    "INSERT INTO bot_users (user_id, username, first_name, last_name, last_seen) VALUES "
+                    + ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows)) +
+                    """
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username   = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name  = excluded.last_name,
+                        last_seen  = excluded.last_seen,
+                        is_blocked = FALSE
+                    """,
+                    [value for row in rows for value in row]
+                )
+                await conn.commit()
+                await conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка записи пользователей бота ({len(rows)}): {e}")
+                for user_id, values in batch.items():
+                    self._pending.setdefault(user_id, values)
+                return
+            now = time.monotonic()
+            for user_id, username, first_name, last_name, _ in rows:
+                self._written[user_id] = ((username, first_name, last_name), now)
+                self._written.move_to_end(user_id)
+            while len(self._written) > 50000:
+                self._written.popitem(last=False)
+
+
+BOT_USER_WRITER = BotUserWriter()
+
+
+async def register_bot_user(user):
+    """Сохраняет/обновляет запись о пользователе, запустившем бота.
+    Принимает объект types.User из aiogram. Запись в БД — отложенная (BOT_USER_WRITER)."""
+    BOT_USER_WRITER.add(user)
 
 
-def find_bot_user_by_username(username: str) -> Optional[dict]:
+async def find_bot_user_by_username(username: str) -> Optional[dict]:
     """Ищет пользователя в реестре по username (без учёта регистра)."""
     try:
-        conn = get_db_connection()
+        # Только что запустившие бота могут быть ещё в буфере записи
+        await BOT_USER_WRITER.flush()
+        conn = await get_db_connection()
 
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "SELECT * FROM bot_users WHERE username = %s",
             (username.lower().lstrip('@'),)
         )
-        row = cursor.fetchone()
-        conn.close()
+        row = await cursor.fetchone()
+        await conn.close()
         return dict(row) if row else None
     except Exception as e:
         logger.error(f"Ошибка поиска пользователя {username}: {e}")
@@ -642,13 +909,13 @@ def generate_deal_id() -> str:
     """Генерация 6-значного номера сделки"""
     return str(random.randint(100000, 999999))
 
-def save_safe_deal(deal: dict) -> bool:
+async def save_safe_deal(deal: dict) -> bool:
     """Сохранение сделки в БД"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
     try:
-        cursor.execute('''
+        await cursor.execute('''
             INSERT INTO safe_deals 
             (id, creator_id, creator_role, buyer_id, seller_id, buyer_username, seller_username,
              amount, description, deadline_days, created_at, status, total_amount, guarantor_fee, group_link)
@@ -662,242 +929,299 @@ def save_safe_deal(deal: dict) -> bool:
             deal['amount'] * (1 + GUARANTOR_FEE), deal['amount'] * GUARANTOR_FEE,
             deal.get('group_link', '')
         ))
-        conn.commit()
+        await conn.commit()
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения сделки: {e}")
         return False
     finally:
-        conn.close()
+        await conn.close()
 
-def get_safe_deal(deal_id: str) -> Optional[dict]:
+async def get_safe_deal(deal_id: str) -> Optional[dict]:
     """Получение сделки по ID"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM safe_deals WHERE id = %s", (deal_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT * FROM safe_deals WHERE id = %s", (deal_id,))
+    row = await cursor.fetchone()
+    await conn.close()
     return dict(row) if row else None
 
-def get_user_safe_deals(user_id: int) -> List[dict]:
+async def get_user_safe_deals(user_id: int) -> List[dict]:
     """Получение всех сделок пользователя"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute('''
+    await cursor.execute('''
         SELECT * FROM safe_deals 
         WHERE buyer_id = %s OR seller_id = %s 
         ORDER BY created_at DESC
     ''', (user_id, user_id))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await cursor.fetchall()
+    await conn.close()
     return [dict(row) for row in rows]
 
-def update_safe_deal_status(deal_id: str, status: str):
+async def update_safe_deal_status(deal_id: str, status: str):
     """Обновление статуса сделки"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("UPDATE safe_deals SET status = %s WHERE id = %s", (status, deal_id))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE safe_deals SET status = %s WHERE id = %s", (status, deal_id))
+    await conn.commit()
+    await conn.close()
 
-def set_user_safe_confirmed(deal_id: str, user_type: str):
+async def set_user_safe_confirmed(deal_id: str, user_type: str):
     """Подтверждение сделки пользователем"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
     if user_type == 'buyer':
-        cursor.execute("UPDATE safe_deals SET buyer_confirmed = TRUE WHERE id = %s", (deal_id,))
+        await cursor.execute("UPDATE safe_deals SET buyer_confirmed = TRUE WHERE id = %s", (deal_id,))
     else:
-        cursor.execute("UPDATE safe_deals SET seller_confirmed = TRUE WHERE id = %s", (deal_id,))
-    conn.commit()
-    conn.close()
+        await cursor.execute("UPDATE safe_deals SET seller_confirmed = TRUE WHERE id = %s", (deal_id,))
+    await conn.commit()
+    await conn.close()
 
 
 
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "10"))
+RESTORE_PROGRESS_EVERY = 500
+
+MUTE_PERMISSIONS = ChatPermissions(
+    can_send_messages=False,
+    can_send_media_messages=False,
+    can_send_polls=False,
+    can_send_other_messages=False,
+    can_add_web_page_previews=False,
+    can_change_info=False,
+    can_invite_users=False,
+    can_pin_messages=False,
+)
+
+
 async def restore_active_punishments():
-    """Восстанавливает активные наказания при запуске бота"""
-    conn = None
+    """Восстанавливает активные наказания при запуске бота.
+
+    Запускается фоновой задачей (polling стартует сразу): муты и баны
+    восстанавливаются параллельно, не более RESTORE_CONCURRENCY запросов
+    одновременно и с массовым приоритетом в OUTBOX. Записи, которые
+    восстановить нельзя (администратор, пользователь не в чате),
+    деактивируются одним UPDATE на таблицу в конце."""
+    started = time.monotonic()
     try:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        
         current_time = datetime.now()
-        
-        # Восстанавливаем активные муты
-        cursor.execute("""
-            SELECT user_id, chat_id, expires_at, reason 
-            FROM mutes 
+        await cursor.execute("""
+            SELECT id, user_id, chat_id, expires_at
+            FROM mutes
             WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)
         """, (current_time,))
-        
-        active_mutes = cursor.fetchall()
-        restored_count = 0
-        
-        for row in active_mutes:
-            user_id, chat_id, expires_at, reason = row["user_id"], row["chat_id"], row["expires_at"], row["reason"]
-            try:
-                # Проверяем, не является ли пользователь администратором
-                member = await bot.get_chat_member(chat_id, user_id)
-                if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]:
-                    # Если администратор - деактивируем мут
-                    cursor.execute(
-                        "UPDATE mutes SET is_active = FALSE WHERE user_id = %s AND chat_id = %s",
-                        (user_id, chat_id)
-                    )
-                    logger.info(f"Мут администратора {user_id} деактивирован")
-                    continue
-                
-                # expires_at из Postgres уже приходит как datetime (или None),
-                # а не строкой, как было в sqlite — парсить не нужно
-                until_date = expires_at
-                
-                permissions = ChatPermissions(
-                    can_send_messages=False,
-                    can_send_media_messages=False,
-                    can_send_polls=False,
-                    can_send_other_messages=False,
-                    can_add_web_page_previews=False,
-                    can_change_info=False,
-                    can_invite_users=False,
-                    can_pin_messages=False,
-                )
-                
-                await bot.restrict_chat_member(chat_id, user_id, permissions, until_date=until_date)
-                restored_count += 1
-                logger.info(f"Восстановлен мут для пользователя {user_id} в чате {chat_id}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка восстановления мута для {user_id}: {e}")
-                # Если не удалось восстановить - возможно пользователь уже не в чате
-                cursor.execute(
-                    "UPDATE mutes SET is_active = FALSE WHERE user_id = %s AND chat_id = %s",
-                    (user_id, chat_id)
-                )
-        
-        # Восстанавливаем активные баны
-        cursor.execute("""
-            SELECT user_id, chat_id, expires_at, reason 
-            FROM bans 
+        active_mutes = await cursor.fetchall()
+        await cursor.execute("""
+            SELECT id, user_id, chat_id, expires_at
+            FROM bans
             WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)
         """, (current_time,))
-        
-        active_bans = cursor.fetchall()
-        restored_bans = 0
-        
-        for row in active_bans:
-            user_id, chat_id, expires_at, reason = row["user_id"], row["chat_id"], row["expires_at"], row["reason"]
-            try:
-                until_date = expires_at
-                await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
-                restored_bans += 1
-                logger.info(f"Восстановлен бан для пользователя {user_id} в чате {chat_id}")
-            except Exception as e:
-                logger.error(f"Ошибка восстановления бана для {user_id}: {e}")
-                cursor.execute(
-                    "UPDATE bans SET is_active = FALSE WHERE user_id = %s AND chat_id = %s",
-                    (user_id, chat_id)
-                )
-        
-        conn.commit()
-        
-        logger.info(f"Восстановлено наказаний: {restored_count} мутов, {restored_bans} банов")
-        
+        active_bans = await cursor.fetchall()
+        await conn.close()
     except Exception as e:
         logger.error(f"Ошибка восстановления наказаний: {e}")
-    finally:
-        # Соединение обязательно возвращается в пул при любом исходе —
-        # иначе при повторяющихся ошибках пул постепенно пустеет
-        if conn is not None:
-            conn.close()
+        return
 
-async def monitor_expired_punishments():
-    """Мониторит и автоматически снимает истекшие наказания"""
-    while True:
-        conn = None
-        try:
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            
-            current_time = datetime.now()
-            
-            # Находим истекшие муты
-            cursor.execute("""
-                SELECT user_id, chat_id, id 
-                FROM mutes 
-                WHERE is_active = TRUE AND expires_at <= %s
-            """, (current_time,))
-            
-            expired_mutes = cursor.fetchall()
-            
-            for row in expired_mutes:
-                user_id, chat_id, mute_id = row["user_id"], row["chat_id"], row["id"]
-                try:
-                    # Снимаем мут
-                    permissions = ChatPermissions(
-                        can_send_messages=True,
-                        can_send_media_messages=True,
-                        can_send_polls=True,
-                        can_send_other_messages=True,
-                        can_add_web_page_previews=True,
-                        can_change_info=False,
-                        can_invite_users=False,
-                        can_pin_messages=False,
-                    )
-                    
-                    await bot.restrict_chat_member(chat_id, user_id, permissions)
-                    
-                    # Деактивируем в БД
-                    cursor.execute(
-                        "UPDATE mutes SET is_active = FALSE WHERE id = %s",
-                        (mute_id,)
+    total = len(active_mutes) + len(active_bans)
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+    restored = {"mutes": 0, "bans": 0}
+    deactivate: Dict[str, List[int]] = {"mutes": [], "bans": []}
+    processed = 0
+
+    async def restore(kind: str, row):
+        nonlocal processed
+        user_id, chat_id = row["user_id"], row["chat_id"]
+        async with semaphore:
+            try:
+                if kind == "mutes":
+                    # Мут администратора не восстанавливаем — деактивируем
+                    status = await CHAT_MEMBERS.get_status(chat_id, user_id)
+                    if status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]:
+                        deactivate[kind].append(row["id"])
+                        logger.info(f"Мут администратора {user_id} деактивирован")
+                        return
+                    await bot.restrict_chat_member(
+                        chat_id, user_id, MUTE_PERMISSIONS, until_date=row["expires_at"]
                     )
-                    
-                    logger.info(f"Автоматически снят мут с пользователя {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка снятия мута {mute_id}: {e}")
-            
-            # Находим истекшие баны
-            cursor.execute("""
-                SELECT user_id, chat_id, id 
-                FROM bans 
-                WHERE is_active = TRUE AND expires_at <= %s
-            """, (current_time,))
-            
-            expired_bans = cursor.fetchall()
-            
-            for row in expired_bans:
-                user_id, chat_id, ban_id = row["user_id"], row["chat_id"], row["id"]
-                try:
-                    # Разбаниваем
-                    await bot.unban_chat_member(chat_id, user_id)
-                    
-                    # Деактивируем в БД
-                    cursor.execute(
-                        "UPDATE bans SET is_active = FALSE WHERE id = %s",
-                        (ban_id,)
+                else:
+                    await bot.ban_chat_member(chat_id, user_id, until_date=row["expires_at"])
+                restored[kind] += 1
+            except Exception as e:
+                # Скорее всего пользователь уже не в чате
+                logger.error(f"Ошибка восстановления {kind} #{row['id']} для {user_id}: {e}")
+                deactivate[kind].append(row["id"])
+            finally:
+                processed += 1
+                if processed % RESTORE_PROGRESS_EVERY == 0:
+                    logger.info(f"Восстановление наказаний: {processed}/{total}")
+
+    with outbound_priority(PRIORITY_BULK):
+        await asyncio.gather(
+            *(restore("mutes", row) for row in active_mutes),
+            *(restore("bans", row) for row in active_bans),
+        )
+
+    try:
+        if deactivate["mutes"] or deactivate["bans"]:
+            conn = await get_db_connection()
+            cursor = conn.cursor()
+            for kind, ids in deactivate.items():
+                if ids:
+                    await cursor.execute(
+                        f"UPDATE {kind} SET is_active = FALSE WHERE id = ANY(%s)", (ids,)
                     )
-                    
-                    logger.info(f"Автоматически снят бан с пользователя {user_id}")
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка снятия бана {ban_id}: {e}")
-            
-            conn.commit()
-            
-        except Exception as e:
-            logger.error(f"Ошибка в мониторинге наказаний: {e}")
-        finally:
-            # Соединение обязательно возвращается в пул при любом исходе —
-            # именно отсутствие этого раньше приводило к постепенному
-            # исчерпанию пула (после чего требовался перезапуск бота)
-            if conn is not None:
-                conn.close()
+            await conn.commit()
+            await conn.close()
+    except Exception as e:
+        logger.error(f"Ошибка деактивации невосстановленных наказаний: {e}")
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Восстановлено наказаний: {restored['mutes']} мутов, {restored['bans']} банов "
+        f"из {total}; деактивировано {len(deactivate['mutes'])} мутов и "
+        f"{len(deactivate['bans'])} банов; {elapsed:.1f} с "
+        f"({total / elapsed if elapsed else 0:.1f} записей/с)"
+    )
+
+# ============================================================
+#        СНЯТИЕ ИСТЁКШИХ НАКАЗАНИЙ (куча сроков в памяти)
+# ============================================================
+# Сроки активных мутов/банов держатся в min-куче; фоновая задача спит ровно
+# до ближайшего срока. При срабатывании все наступившие сроки одного типа
+# деактивируются одним UPDATE ... RETURNING (вернутся только ещё активные
+# записи — снятые вручную раньше срока просто пропускаются), после чего
+# ограничения снимаются в Telegram параллельно. Новые наказания попадают в
+# кучу из MODERATION (mute/ban и *_many); раз в EXPIRY_RECONCILE_INTERVAL куча
+# пересобирается из БД (наказания, выданные с сайта, ручные правки).
+
+EXPIRY_RECONCILE_INTERVAL = 900  # секунд
+EXPIRY_BATCH_WINDOW = 1.0        # сроки в пределах секунды снимаются одной пачкой
+
+UNMUTE_PERMISSIONS = ChatPermissions(
+    can_send_messages=True,
+    can_send_media_messages=True,
+    can_send_polls=True,
+    can_send_other_messages=True,
+    can_add_web_page_previews=True,
+    can_change_info=False,
+    can_invite_users=False,
+    can_pin_messages=False,
+)
+
+
+class PunishmentExpiryScheduler:
+    KINDS = ("mutes", "bans")
 
-        await asyncio.sleep(60)  # Проверяем каждую минуту
+    def __init__(self):
+        # (срок, тип, id записи)
+        self._heap: List[Tuple[datetime, str, int]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _notify(self):
+        if self._wakeup:
+            self._wakeup.set()
+
+    def schedule(self, kind: str, punishment_id: int, expires_at: Optional[datetime]):
+        if expires_at is None:
+            return
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (expires_at, kind, punishment_id))
+        if earliest is None or expires_at < earliest:
+            self._notify()
+
+    async def reload(self) -> int:
+        """Пересобирает кучу из всех активных наказаний со сроком."""
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        heap = []
+        for kind in self.KINDS:
+            await cursor.execute(
+                f"SELECT id, expires_at FROM {kind} WHERE is_active = TRUE AND expires_at IS NOT NULL"
+            )
+            heap.extend((row[1], kind, row[0]) for row in await cursor.fetchall())
+        await conn.close()
+        heapq.heapify(heap)
+        self._heap = heap
+        self._notify()
+        return len(heap)
+
+    def _pop_due(self) -> Dict[str, List[int]]:
+        limit = datetime.now() + timedelta(seconds=EXPIRY_BATCH_WINDOW)
+        due: Dict[str, List[int]] = {kind: [] for kind in self.KINDS}
+        while self._heap and self._heap[0][0] <= limit:
+            _, kind, punishment_id = heapq.heappop(self._heap)
+            due[kind].append(punishment_id)
+        return due
+
+    async def _expire(self, due: Dict[str, List[int]]):
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        expired: Dict[str, list] = {}
+        for kind, ids in due.items():
+            if not ids:
+                continue
+            await cursor.execute(
+                f"UPDATE {kind} SET is_active = FALSE "
+                f"WHERE id = ANY(%s) AND is_active = TRUE AND expires_at <= %s "
+                f"RETURNING id, user_id, chat_id",
+                (ids, datetime.now() + timedelta(seconds=EXPIRY_BATCH_WINDOW))
+            )
+            expired[kind] = await cursor.fetchall()
+        await conn.commit()
+        await conn.close()
+
+        async def lift(kind: str, row):
+            try:
+                if kind == "mutes":
+                    await bot.restrict_chat_member(row["chat_id"], row["user_id"], UNMUTE_PERMISSIONS)
+                    logger.info(f"Автоматически снят мут с пользователя {row['user_id']}")
+                else:
+                    await bot.unban_chat_member(row["chat_id"], row["user_id"], only_if_banned=True)
+                    logger.info(f"Автоматически снят бан с пользователя {row['user_id']}")
+            except Exception as e:
+                logger.error(f"Ошибка снятия наказания {kind} #{row['id']}: {e}")
+
+        await asyncio.gather(*(lift(kind, row) for kind, rows in expired.items() for row in rows))
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            try:
+                due = self._pop_due()
+                if any(due.values()):
+                    await self._expire(due)
+                    continue
+            except Exception as e:
+                logger.error(f"Ошибка в снятии истёкших наказаний: {e}")
+                # Сроки не потеряются — их вернёт ближайшая сверка с БД
+                await asyncio.sleep(5)
+                continue
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, (self._heap[0][0] - datetime.now()).total_seconds())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def reconcile_periodically(self):
+        while True:
+            await asyncio.sleep(EXPIRY_RECONCILE_INTERVAL)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Ошибка сверки сроков наказаний с БД: {e}")
+
+
+EXPIRIES = PunishmentExpiryScheduler()
 
 # Триггерные слова
 TRIGGER_WORDS = {
@@ -907,9 +1231,462 @@ TRIGGER_WORDS = {
     "космонавт": ["космонавт", "косmonaut", "к0смонавт", "космонавт", "космонавт"],
 }
 
+# Движок поиска триггерных слов: одно скомпилированное выражение на все
+# варианты + нормализация гомоглифов/leet. Пересобирается на лету при
+# добавлении/удалении слов владельцами (/trigger_add, /trigger_del).
+TRIGGER_MATCHER = TriggerMatcher(TRIGGER_WORDS)
+
+
+async def load_trigger_words():
+    """Подмешивает к TRIGGER_WORDS слова из таблицы trigger_words и пересобирает движок."""
+    words = {w: list(v) for w, v in TRIGGER_WORDS.items()}
+    try:
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute("SELECT word, variant FROM trigger_words ORDER BY id")
+        for word, variant in await cursor.fetchall():
+            words.setdefault(word, [])
+            if variant not in words[word]:
+                words[word].append(variant)
+        await conn.close()
+    except Exception as e:
+        logger.error(f"Ошибка загрузки триггерных слов: {e}")
+    version = TRIGGER_MATCHER.reload(words)
+    logger.info(f"Триггерные слова загружены: {len(words)} слов (версия {version})")
+
+
+async def add_trigger_word(word: str, variants: List[str], added_by: int):
+    conn = await get_db_connection()
+    cursor = conn.cursor()
+    for variant in [word, *variants]:
+        await cursor.execute(
+            "INSERT INTO trigger_words (word, variant, added_by) VALUES (%s, %s, %s) "
+            "ON CONFLICT (word, variant) DO NOTHING",
+            (word, variant, added_by)
+        )
+    await conn.commit()
+    await conn.close()
+    TRIGGER_MATCHER.add(word, variants)
+
+
+async def remove_trigger_word(word: str) -> bool:
+    # Слова из TRIGGER_WORDS (в коде) не удаляем: после перезапуска они
+    # вернулись бы — /trigger_del отказывает в этом случае заранее
+    if word in TRIGGER_WORDS:
+        return False
+    conn = await get_db_connection()
+    cursor = conn.cursor()
+    await cursor.execute("DELETE FROM trigger_words WHERE word = %s", (word,))
+    await conn.commit()
+    await conn.close()
+    return TRIGGER_MATCHER.remove(word)
+
+# ============================================================
+#        ХРАНИЛИЩЕ FSM В POSTGRES (переживает перезапуск)
+# ============================================================
+# Состояния диалогов (сделки, жалобы, отзывы, анкеты, товары) хранятся в
+# таблице fsm_storage: состояние + данные в JSONB + срок жизни. Чтение и
+# запись идут прямо в таблицу, без локального кэша, — несколько экземпляров
+# бота (webhook за балансировщиком) видят одно и то же состояние. Запись
+# завершается до возврата из set_state/update_data; записи, пришедшие, пока
+# идёт предыдущая, уходят вместе следующим пакетом. Если БД недоступна,
+# изменение остаётся в буфере процесса (читается оттуда же) и повторяется
+# раз в FSM_RETRY_INTERVAL. Чтение по первичному ключу — один быстрый запрос
+# на апдейт (FSM-middleware запрашивает состояние на каждый апдейт).
+# FSM_STORAGE=memory возвращает прежний MemoryStorage (например, для отладки).
+
+FSM_STORAGE_BACKEND = os.getenv("FSM_STORAGE", "postgres")
+FSM_TTL = timedelta(hours=int(os.getenv("FSM_TTL_HOURS", "48")))
+FSM_RETRY_INTERVAL = 5.0     # секунд до повтора неудавшейся записи
+FSM_SWEEP_INTERVAL = 3600    # секунд
+
+
+class PostgresStorage(BaseStorage):
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+        # key → (state, data); изменения, ещё не записанные в таблицу
+        self._dirty: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._lock = asyncio.Lock()
+        self._retry_task: Optional[asyncio.Task] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{getattr(key, 'destiny', 'default')}"
+
+    @staticmethod
+    def _args(args, kwargs, name: str, default=None):
+        """(key, значение) из аргументов вызова. Бета-версии aiogram 3 передают
+        ещё и bot (первым или по имени), релизные — нет; FSMContext передаёт
+        всё по именам."""
+        positional = [a for a in args if not isinstance(a, Bot)]
+        key = kwargs.get("key") or positional.pop(0)
+        value = kwargs.get(name, positional[0] if positional else default)
+        return key, value
+
+    async def _load(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        # Незаписанное (БД была недоступна) новее того, что лежит в таблице
+        if key in self._dirty:
+            return self._dirty[key]
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(
+                "SELECT state, data FROM fsm_storage WHERE key = %s AND expires_at > %s",
+                (key, datetime.now())
+            )
+            row = await cursor.fetchone()
+        finally:
+            await conn.close()
+        return (row[0], dict(row[1] or {})) if row else (None, {})
+
+    async def _write(self, key: str, state: Optional[str], data: Dict[str, Any]):
+        self._dirty[key] = (state, data)
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_periodically())
+        await self.flush()
+        if self._dirty and (self._retry_task is None or self._retry_task.done()):
+            self._retry_task = asyncio.create_task(self._retry_later())
+
+    async def _retry_later(self):
+        while self._dirty:
+            await asyncio.sleep(FSM_RETRY_INTERVAL)
+            await self.flush()
+
+    async def _store(self, batch: Dict[str, Tuple[Optional[str], Dict[str, Any]]]):
+        expires_at = datetime.now() + self.ttl
+        upserts = [
+            (key, state, Jsonb(data), expires_at)
+            for key, (state, data) in batch.items() if state is not None or data
+        ]
+        deletes = [key for key, (state, data) in batch.items() if state is None and not data]
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if upserts:
+                await cursor.executemany(
+                    "INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (%s, %s, %s, %s) "
+                    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                    "expires_at = excluded.expires_at",
+                    upserts
+                )
+            if deletes:
+                await cursor.execute("DELETE FROM fsm_storage WHERE key = ANY(%s)", (deletes,))
+            await conn.commit()
+        finally:
+            await conn.close()
+
+    async def flush(self):
+        """Записывает накопленные изменения одним пакетом; если пакет не
+        принят — по ключам, чтобы одно плохое значение не блокировало остальных."""
+        async with self._lock:
+            if not self._dirty:
+                return
+            batch, self._dirty = self._dirty, {}
+            if len(batch) > 1:
+                try:
+                    await self._store(batch)
+                    return
+                except Exception as e:
+                    logger.warning(f"Пакет FSM ({len(batch)}) не записан, пишу по ключам: {e}")
+            await self._store_each(batch)
+
+    async def _store_each(self, batch: Dict[str, Tuple[Optional[str], Dict[str, Any]]]):
+        for key, record in batch.items():
+            try:
+                await self._store({key: record})
+            except (psycopg.DataError, TypeError, ValueError) as e:
+                # Значение, которое Postgres не примет никогда (NaN в JSON,
+                # несериализуемый объект): повтор бесполезен
+                logger.error(f"FSM: состояние {key} не сохранить, отброшено: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка записи FSM в БД ({key}): {e}")
+                # Возвращаем в буфер, если ключ не перезаписан новыми изменениями
+                self._dirty.setdefault(key, record)
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(FSM_SWEEP_INTERVAL)
+            try:
+                conn = await get_db_connection()
+                cursor = conn.cursor()
+                await cursor.execute("DELETE FROM fsm_storage WHERE expires_at <= %s", (datetime.now(),))
+                removed = cursor.rowcount
+                await conn.commit()
+                await conn.close()
+                if removed:
+                    logger.info(f"FSM: удалено просроченных состояний: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки FSM: {e}")
+
+    async def set_state(self, *args, **kwargs) -> None:
+        key, state = self._args(args, kwargs, "state")
+        state = state.state if isinstance(state, State) else state
+        skey = self._key(key)
+        _, data = await self._load(skey)
+        await self._write(skey, state, data)
+
+    async def get_state(self, *args, **kwargs) -> Optional[str]:
+        key, _ = self._args(args, kwargs, "state")
+        state, _ = await self._load(self._key(key))
+        return state
+
+    async def set_data(self, *args, **kwargs) -> None:
+        key, data = self._args(args, kwargs, "data", {})
+        skey = self._key(key)
+        state, _ = await self._load(skey)
+        await self._write(skey, state, dict(data))
+
+    async def get_data(self, *args, **kwargs) -> Dict[str, Any]:
+        key, _ = self._args(args, kwargs, "data")
+        _, data = await self._load(self._key(key))
+        return dict(data)
+
+    async def update_data(self, *args, **kwargs) -> Dict[str, Any]:
+        key, data = self._args(args, kwargs, "data", {})
+        skey = self._key(key)
+        state, current = await self._load(skey)
+        current = {**current, **data}
+        await self._write(skey, state, current)
+        return dict(current)
+
+    async def close(self) -> None:
+        for task in (self._sweep_task, self._retry_task):
+            if task:
+                task.cancel()
+        self._sweep_task = self._retry_task = None
+        await self.flush()
+
+
+FSM_STORAGE = PostgresStorage(FSM_TTL) if FSM_STORAGE_BACKEND == "postgres" else MemoryStorage()
+
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+
+
+class OrderedDispatcher(Dispatcher):
+    """Апдейты одного (чат, пользователь) — строго по очереди (UPDATE_SERIALIZER).
+
+    Блокировка берётся в feed_update, до outer-middleware aiogram:
+    FSMContextMiddleware читает состояние раньше обработчиков, и второй
+    апдейт пользователя должен увидеть состояние, записанное первым."""
+
+    async def feed_update(self, bot: Bot, update: Update, **kwargs: Any) -> Any:
+        async with UPDATE_SERIALIZER.hold(update_key(update)):
+            return await super().feed_update(bot, update, **kwargs)
+
+
+dp = OrderedDispatcher(storage=FSM_STORAGE)
+
+# ============================================================
+#      ПЛАНИРОВЩИК ИСХОДЯЩИХ ЗАПРОСОВ (лимиты Telegram Bot API)
+# ============================================================
+# Все вызовы Bot API, которые что-то отправляют в чат или модерируют,
+# проходят через request-middleware сессии бота и ждут токен:
+#   • глобальное ведро — OUTBOUND_GLOBAL_RATE запросов/сек на всего бота;
+#   • ведро чата — 1 сообщение/сек в личке и OUTBOUND_GROUP_PER_MINUTE
+#     сообщений/мин в группе (только отправка сообщений, не правки).
+# Ожидающие запросы обслуживаются по приоритету: модерация (баны, муты,
+# удаление) → обычные ответы → массовые операции (рассылки, амнистия).
+# TelegramRetryAfter обрабатывается здесь же: чат (или весь бот) ставится
+# на паузу на retry_after секунд, запрос повторяется автоматически.
+
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1"))
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "20"))
+OUTBOUND_MAX_RETRIES = 3
+
+PRIORITY_MODERATION = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+# Приоритет, заданный вызывающим кодом (см. outbound_priority)
+_OUTBOUND_PRIORITY: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    "outbound_priority", default=None
+)
+
+# Методы, которые расходуют лимит чата (отправка новых сообщений)
+_CHAT_LIMITED_PREFIXES = ("Send", "Copy", "Forward")
+# Правки — только глобальный лимит
+_GLOBAL_LIMITED_PREFIXES = ("Edit",)
+# Модерация — только глобальный лимит, но с наивысшим приоритетом
+_MODERATION_METHODS = {
+    "BanChatMember", "UnbanChatMember", "RestrictChatMember",
+    "PromoteChatMember", "DeleteMessage", "DeleteMessages",
+}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления токена (0 — можно сейчас)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class OutboundScheduler:
+    """Очередь ожидающих запросов с приоритетами поверх token bucket'ов."""
+
+    def __init__(self, global_rate: float, private_rate: float, group_per_minute: float):
+        self.private_rate = private_rate
+        self.group_rate = group_per_minute / 60
+        self.group_burst = max(1.0, min(group_per_minute, 5.0))
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, TokenBucket] = {}
+        # (приоритет, порядковый номер, chat_id или None, future)
+        self._waiters: List[Tuple[int, int, Optional[int], asyncio.Future]] = []
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.private_rate, max(1.0, self.private_rate))
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def acquire(self, chat_id: Optional[int], priority: int):
+        """Ждёт разрешения на запрос. chat_id=None — только глобальный лимит."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._seq += 1
+        heapq.heappush(self._waiters, (priority, self._seq, chat_id, future))
+        self._wakeup.set()
+        await future
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def penalize(self, chat_id: Optional[int], seconds: float):
+        """Пауза после TelegramRetryAfter: для чата или (chat_id=None) для всего бота."""
+        bucket = self._global if chat_id is None else self._chat_bucket(chat_id)
+        bucket.block(seconds)
+        if self._wakeup:
+            self._wakeup.set()
+
+    def _gc(self, now: float):
+        if len(self._chats) > 5000:
+            for chat_id in [c for c, b in self._chats.items() if b.idle(now)]:
+                del self._chats[chat_id]
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            # Отменённые ожидания выкидываем сразу
+            if any(w[3].done() for w in self._waiters):
+                self._waiters = [w for w in self._waiters if not w[3].done()]
+                heapq.heapify(self._waiters)
+            global_delay = self._global.delay(now)
+            if self._waiters and global_delay > 0:
+                wait = global_delay
+            elif self._waiters:
+                # Первый по приоритету запрос, чей чат не упёрся в лимит
+                for waiter in sorted(self._waiters):
+                    chat_id = waiter[2]
+                    chat_delay = self._chat_bucket(chat_id).delay(now) if chat_id is not None else 0.0
+                    if chat_delay == 0:
+                        self._waiters.remove(waiter)
+                        heapq.heapify(self._waiters)
+                        self._global.take(now)
+                        if chat_id is not None:
+                            self._chats[chat_id].take(now)
+                        waiter[3].set_result(None)
+                        wait = 0
+                        break
+                    wait = chat_delay if wait is None else min(wait, chat_delay)
+                self._gc(now)
+            if wait == 0:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+            except asyncio.TimeoutError:
+                pass
+
+
+@contextmanager
+def outbound_priority(priority: int):
+    """Задаёт приоритет исходящих запросов внутри блока (например, PRIORITY_BULK для рассылок)."""
+    token = _OUTBOUND_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _OUTBOUND_PRIORITY.reset(token)
+
+
+class OutboundRateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(self, scheduler: OutboundScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        if name.startswith(_CHAT_LIMITED_PREFIXES):
+            chat_id = getattr(method, "chat_id", None)
+            chat_id = chat_id if isinstance(chat_id, int) else None
+        elif name.startswith(_GLOBAL_LIMITED_PREFIXES) or name in _MODERATION_METHODS:
+            chat_id = None
+        else:
+            # Чтение (getChat, getChatMember, getUpdates...) не ограничиваем
+            return await make_request(bot, method)
+
+        priority = _OUTBOUND_PRIORITY.get()
+        if priority is None:
+            priority = PRIORITY_MODERATION if name in _MODERATION_METHODS else PRIORITY_NORMAL
+
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            await self.scheduler.acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+                # Сообщения самого бота в группах — тоже кандидаты для /cc
+                sent = getattr(response, "result", None)
+                if isinstance(sent, Message) and sent.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+                    RECENT_MESSAGES.add(sent.chat.id, sent.message_id)
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                logger.warning(f"{name}: Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                self.scheduler.penalize(chat_id, e.retry_after)
+
+
+OUTBOX = OutboundScheduler(OUTBOUND_GLOBAL_RATE, OUTBOUND_PRIVATE_RATE, OUTBOUND_GROUP_PER_MINUTE)
+bot.session.middleware(OutboundRateLimitMiddleware(OUTBOX))
 
 # Режим технических работ
 MAINTENANCE_MODE = False
@@ -970,165 +1747,311 @@ async def set_bot_username():
     bot_info = await bot.get_me()
     bot.username = bot_info.username
 
-def add_warn(user_id: int, chat_id: int, reason: str, issued_by: int):
-    conn = get_db_connection()
+async def get_user_warns(user_id: int, chat_id: int) -> List[Dict[str, Any]]:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    expires_at = datetime.now() + timedelta(days=WARN_EXPIRE_DAYS)
-    cursor.execute(
-        "INSERT INTO warns (user_id, chat_id, reason, issued_by, expires_at) VALUES (%s, %s, %s, %s, %s)",
-        (user_id, chat_id, reason, issued_by, expires_at),
-    )
-    conn.commit()
-    conn.close()
-
-def get_user_warns(user_id: int, chat_id: int) -> List[Dict[str, Any]]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id, reason, issued_at, expires_at FROM warns WHERE user_id = %s AND chat_id = %s AND expires_at > %s",
         (user_id, chat_id, datetime.now()),
     )
     warns = [
         {"id": row[0], "reason": row[1], "issued_at": row[2], "expires_at": row[3]}
-        for row in cursor.fetchall()
+        for row in await cursor.fetchall()
     ]
-    conn.close()
+    await conn.close()
     return warns
 
-def remove_warn(warn_id: int):
-    conn = get_db_connection()
+async def remove_warn(warn_id: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM warns WHERE id = %s", (warn_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("DELETE FROM warns WHERE id = %s", (warn_id,))
+    await conn.commit()
+    await conn.close()
 
-def clear_user_warns(user_id: int, chat_id: int):
-    conn = get_db_connection()
+async def clear_user_warns(user_id: int, chat_id: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "DELETE FROM warns WHERE user_id = %s AND chat_id = %s", (user_id, chat_id)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
-def add_mute(user_id: int, chat_id: int, reason: str, issued_by: int, duration: timedelta = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    expires_at = datetime.now() + duration if duration else None
-    cursor.execute(
-        "INSERT INTO mutes (user_id, chat_id, reason, issued_by, expires_at, is_active) VALUES (%s, %s, %s, %s, %s, TRUE)",
-        (user_id, chat_id, reason, issued_by, expires_at),
-    )
-    conn.commit()
-    conn.close()
+# ============================================================
+#         РЕПОЗИТОРИЙ НАКАЗАНИЙ (ОДНА ТРАНЗАКЦИЯ НА ДЕЙСТВИЕ)
+# ============================================================
+# Варн, мут и бан пишутся одним соединением и одним-двумя запросами:
+# вставка варна сразу возвращает число активных варнов, деактивация
+# прежнего мута/бана идёт CTE в том же INSERT. Массовые варианты
+# (*_many) обрабатывают весь список ID одним запросом через unnest —
+# для рейдов.
+#
+# Каждое действие тем же запросом дописывается в moderation_events —
+# единый неизменяемый журнал (варны из warns удаляются по сроку, а
+# история остаётся). Журнал, история пользователя и выборки сайта
+# читаются из него одним индексным сканом с keyset-пагинацией
+# (created_at, id) вместо UNION по нескольким таблицам.
+
+WARN_LIMIT = 3  # варнов до автоматического бана
+
+
+class ModerationRepository:
+    async def warn(self, user_id: int, chat_id: int, reason: str, issued_by: int,
+                   limit: int = WARN_LIMIT) -> int:
+        """Выдаёт варн и возвращает число активных варнов с учётом нового.
+        При достижении limit варны пользователя сбрасываются в той же транзакции."""
+        counts = await self.warn_many([user_id], chat_id, reason, issued_by, limit)
+        return counts[user_id]
+
+    async def warn_many(self, user_ids: Iterable[int], chat_id: int, reason: str, issued_by: int,
+                        limit: int = WARN_LIMIT) -> Dict[int, int]:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        now = datetime.now()
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            # Варны одного пользователя в чате выдаются по очереди: без блокировки
+            # две параллельные транзакции видят только свою вставку, обе
+            # возвращают N + 1 и ни одна не доходит до limit. Блокировка —
+            # отдельным запросом, чтобы снимок следующего видел чужой COMMIT
+            await cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtextextended(%s::text || ':' || u::text, 0)) "
+                "FROM unnest(%s::bigint[]) AS u ORDER BY u",
+                (chat_id, sorted(user_ids))
+            )
+            # Снимок запроса не видит вставленные CTE строки — отсюда «+ 1»
+            expires_at = now + timedelta(days=WARN_EXPIRE_DAYS)
+            await cursor.execute(
+                """WITH new_warns AS (
+                       INSERT INTO warns (user_id, chat_id, reason, issued_by, expires_at)
+                       SELECT u, %s, %s, %s, %s FROM unnest(%s::bigint[]) AS u
+                   ), events AS (
+                       INSERT INTO moderation_events (kind, user_id, chat_id, issued_by, reason, expires_at)
+                       SELECT 'warn', u, %s, %s, %s, %s FROM unnest(%s::bigint[]) AS u
+                   )
+                   SELECT u, (SELECT COUNT(*) FROM warns w
+                              WHERE w.user_id = u AND w.chat_id = %s AND w.expires_at > %s) + 1
+                   FROM unnest(%s::bigint[]) AS u""",
+                (chat_id, reason, issued_by, expires_at, user_ids,
+                 chat_id, issued_by, reason, expires_at, user_ids,
+                 chat_id, now, user_ids)
+            )
+            counts = {row[0]: row[1] for row in await cursor.fetchall()}
+            over_limit = [uid for uid, count in counts.items() if count >= limit]
+            if over_limit:
+                await cursor.execute(
+                    "DELETE FROM warns WHERE chat_id = %s AND user_id = ANY(%s)",
+                    (chat_id, over_limit)
+                )
+            await conn.commit()
+        finally:
+            await conn.close()
+        return counts
+
+    async def mute(self, user_id: int, chat_id: int, reason: str, issued_by: int,
+                   duration: timedelta = None) -> int:
+        """Деактивирует прежний мут и записывает новый; возвращает ID записи."""
+        ids = await self._punish_many("mutes", [user_id], chat_id, reason, issued_by, duration)
+        return ids[user_id]
+
+    async def mute_many(self, user_ids: Iterable[int], chat_id: int, reason: str, issued_by: int,
+                        duration: timedelta = None) -> Dict[int, int]:
+        return await self._punish_many("mutes", user_ids, chat_id, reason, issued_by, duration)
+
+    async def ban(self, user_id: int, chat_id: int, reason: str, issued_by: int,
+                  duration: timedelta = None) -> int:
+        ids = await self._punish_many("bans", [user_id], chat_id, reason, issued_by, duration)
+        return ids[user_id]
+
+    async def ban_many(self, user_ids: Iterable[int], chat_id: int, reason: str, issued_by: int,
+                       duration: timedelta = None) -> Dict[int, int]:
+        return await self._punish_many("bans", user_ids, chat_id, reason, issued_by, duration)
+
+    async def _punish_many(self, table: str, user_ids: Iterable[int], chat_id: int, reason: str,
+                           issued_by: int, duration: timedelta = None) -> Dict[int, int]:
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        expires_at = datetime.now() + duration if duration else None
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(
+                f"""WITH closed AS (
+                        UPDATE {table} SET is_active = FALSE
+                        WHERE chat_id = %s AND user_id = ANY(%s) AND is_active = TRUE
+                    ), events AS (
+                        INSERT INTO moderation_events (kind, user_id, chat_id, issued_by, reason, expires_at)
+                        SELECT %s, u, %s, %s, %s, %s FROM unnest(%s::bigint[]) AS u
+                    )
+                    INSERT INTO {table} (user_id, chat_id, reason, issued_by, expires_at, is_active)
+                    SELECT u, %s, %s, %s, %s, TRUE FROM unnest(%s::bigint[]) AS u
+                    RETURNING user_id, id""",
+                (chat_id, user_ids,
+                 table[:-1], chat_id, issued_by, reason, expires_at, user_ids,
+                 chat_id, reason, issued_by, expires_at, user_ids)
+            )
+            ids = {row[0]: row[1] for row in await cursor.fetchall()}
+            await conn.commit()
+        finally:
+            await conn.close()
+        for punishment_id in ids.values():
+            EXPIRIES.schedule(table, punishment_id, expires_at)
+        return ids
+
+    async def record(self, kind: str, user_id: int, chat_id: int = None, issued_by: int = None,
+                     reason: str = None, expires_at: datetime = None, cursor=None):
+        """Дописывает событие в moderation_events (для действий вне warn/mute/ban).
+        С cursor — в транзакции вызывающего кода."""
+        sql = (
+            "INSERT INTO moderation_events (kind, user_id, chat_id, issued_by, reason, expires_at) "
+            "VALUES (%s, %s, %s, %s, %s, %s)"
+        )
+        params = (kind, user_id, chat_id, issued_by, reason, expires_at)
+        if cursor is not None:
+            await cursor.execute(sql, params)
+            return
+        conn = await get_db_connection()
+        try:
+            await conn.cursor().execute(sql, params)
+            await conn.commit()
+        finally:
+            await conn.close()
+
+    async def history(self, user_id: int = None, kinds: Iterable[str] = None, limit: int = 50,
+                      before: Optional[Tuple[datetime, int]] = None,
+                      chat_id: int = None) -> List[Dict[str, Any]]:
+        """События от новых к старым. before=(created_at, id) последней строки
+        предыдущей страницы — следующая страница (keyset, без OFFSET)."""
+        conditions, params = [], []
+        if user_id is not None:
+            conditions.append("user_id = %s")
+            params.append(user_id)
+        if chat_id is not None:
+            conditions.append("chat_id = %s")
+            params.append(chat_id)
+        if kinds:
+            conditions.append("kind = ANY(%s)")
+            params.append(list(kinds))
+        if before:
+            conditions.append("(created_at, id) < (%s, %s)")
+            params.extend(before)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(
+                "SELECT id, kind, user_id, chat_id, issued_by, reason, expires_at, created_at "
+                f"FROM moderation_events {where} ORDER BY created_at DESC, id DESC LIMIT %s",
+                (*params, limit)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+        finally:
+            await conn.close()
 
-def add_ban(user_id: int, chat_id: int, reason: str, issued_by: int, duration: timedelta = None):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    expires_at = datetime.now() + duration if duration else None
-    cursor.execute(
-        "INSERT INTO bans (user_id, chat_id, reason, issued_by, expires_at, is_active) VALUES (%s, %s, %s, %s, %s, TRUE)",
-        (user_id, chat_id, reason, issued_by, expires_at),
-    )
-    conn.commit()
-    conn.close()
 
-def add_admin_warn(user_id: int, reason: str, issued_by: int):
-    conn = get_db_connection()
+MODERATION = ModerationRepository()
+
+async def add_admin_warn(user_id: int, reason: str, issued_by: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "INSERT INTO admin_warns (user_id, reason, issued_by) VALUES (%s, %s, %s)",
         (user_id, reason, issued_by),
     )
-    conn.commit()
-    conn.close()
+    await MODERATION.record("admin_warn", user_id, issued_by=issued_by, reason=reason, cursor=cursor)
+    await conn.commit()
+    await conn.close()
 
-def get_admin_warns(user_id: int) -> List[Dict[str, Any]]:
-    conn = get_db_connection()
+async def get_admin_warns(user_id: int) -> List[Dict[str, Any]]:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id, reason, issued_at, issued_by FROM admin_warns WHERE user_id = %s AND is_active = TRUE",
         (user_id,),
     )
     warns = [
         {"id": row[0], "reason": row[1], "issued_at": row[2], "issued_by": row[3]}
-        for row in cursor.fetchall()
+        for row in await cursor.fetchall()
     ]
-    conn.close()
+    await conn.close()
     return warns
 
-def remove_admin_warn(warn_id: int):
-    conn = get_db_connection()
+async def remove_admin_warn(warn_id: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE id = %s", (warn_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE id = %s", (warn_id,))
+    await conn.commit()
+    await conn.close()
 
-def remove_last_admin_warn(user_id: int):
+async def remove_last_admin_warn(user_id: int):
     """Удаляет последнее предупреждение администратора"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id FROM admin_warns WHERE user_id = %s AND is_active = TRUE ORDER BY id DESC LIMIT 1",
         (user_id,)
     )
-    result = cursor.fetchone()
+    result = await cursor.fetchone()
     if result:
-        cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE id = %s", (result[0],))
-    conn.commit()
-    conn.close()
+        await cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE id = %s", (result[0],))
+    await conn.commit()
+    await conn.close()
     return result[0] if result else None
 
-def clear_admin_warns(user_id: int):
-    conn = get_db_connection()
+async def clear_admin_warns(user_id: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE user_id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE admin_warns SET is_active = FALSE WHERE user_id = %s", (user_id,))
+    await conn.commit()
+    await conn.close()
 
 # Новые функции для работы с варнами в боте
-def add_bot_warn(user_id: int, reason: str, issued_by: int):
+async def add_bot_warn(user_id: int, reason: str, issued_by: int):
     """Добавляет предупреждение в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "INSERT INTO bot_warns (user_id, reason, issued_by) VALUES (%s, %s, %s)",
         (user_id, reason, issued_by),
     )
-    conn.commit()
-    conn.close()
+    await MODERATION.record("bot_warn", user_id, issued_by=issued_by, reason=reason, cursor=cursor)
+    await conn.commit()
+    await conn.close()
 
-def get_bot_warns(user_id: int) -> List[Dict[str, Any]]:
+async def get_bot_warns(user_id: int) -> List[Dict[str, Any]]:
     """Получает активные предупреждения в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id, reason, issued_at, issued_by FROM bot_warns WHERE user_id = %s AND is_active = TRUE",
         (user_id,),
     )
     warns = [
         {"id": row[0], "reason": row[1], "issued_at": row[2], "issued_by": row[3]}
-        for row in cursor.fetchall()
+        for row in await cursor.fetchall()
     ]
-    conn.close()
+    await conn.close()
     return warns
 
 # Функции для работы с блокировками объявлений
-def remove_bot_warn(warn_id: int):
+async def remove_bot_warn(warn_id: int):
     """Удаляет предупреждение в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE bot_warns SET is_active = FALSE WHERE id = %s", (warn_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE bot_warns SET is_active = FALSE WHERE id = %s", (warn_id,))
+    await conn.commit()
+    await conn.close()
 
-def clear_bot_warns(user_id: int):
+async def clear_bot_warns(user_id: int):
     """Очищает все предупреждения в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE bot_warns SET is_active = FALSE WHERE user_id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE bot_warns SET is_active = FALSE WHERE user_id = %s", (user_id,))
+    await conn.commit()
+    await conn.close()
 
 
 # ============================================================
@@ -1255,202 +2178,456 @@ ADMIN_ROLES = {
     },
 }
 
-def add_admin(user_id: int, added_by: int, role: str = "moderator", display_name: str = None):
-    conn = get_db_connection()
+class AdminRegistry:
+    """Кэш таблицы admins в памяти процесса.
+
+    Проверки прав (is_admin, get_admin_role, admin_can, is_bot_admin...)
+    вызываются на каждую команду и callback, поэтому читаются из словаря,
+    а не из БД. Таблица перечитывается целиком:
+      • при первом обращении;
+      • сразу после add_admin/remove_admin в этом процессе;
+      • по NOTIFY admins_changed (изменения из других процессов/вручную);
+      • раз в ADMIN_REGISTRY_REFRESH секунд — на случай потери LISTEN-соединения.
+    version растёт при каждой перезагрузке."""
+
+    def __init__(self):
+        self._admins: Dict[int, Dict[str, Any]] = {}
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self.version = 0
+
+    async def reload(self):
+        async with self._lock:
+            conn = await get_db_connection()
+            cursor = conn.cursor()
+            await cursor.execute("SELECT user_id, role, display_name, added_at FROM admins ORDER BY added_at")
+            rows = await cursor.fetchall()
+            await conn.close()
+            self._admins = {
+                r[0]: {"user_id": r[0], "role": r[1], "display_name": r[2], "added_at": r[3]}
+                for r in rows
+            }
+            self._loaded = True
+            self.version += 1
+        logger.info(f"Кэш администраторов обновлён: {len(self._admins)} записей (версия {self.version})")
+
+    async def _ensure_loaded(self):
+        if not self._loaded:
+            await self.reload()
+
+    async def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        await self._ensure_loaded()
+        return self._admins.get(user_id)
+
+    async def all(self) -> List[Dict[str, Any]]:
+        await self._ensure_loaded()
+        return list(self._admins.values())
+
+
+ADMIN_REGISTRY = AdminRegistry()
+ADMIN_REGISTRY_REFRESH = 600
+
+
+async def listen_admin_changes():
+    """Фоновая задача: LISTEN admins_changed на отдельном соединении (не из пула —
+    оно занято постоянно) и перечитывание кэша администраторов по каждому NOTIFY."""
+    while True:
+        try:
+            conn = await psycopg.AsyncConnection.connect(_pg_conninfo(), autocommit=True)
+            async with conn:
+                await conn.execute("LISTEN admins_changed")
+                # Всё, что могло измениться, пока соединения не было
+                await ADMIN_REGISTRY.reload()
+                async for _ in conn.notifies():
+                    await ADMIN_REGISTRY.reload()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка LISTEN admins_changed: {e}")
+        await asyncio.sleep(30)
+
+
+async def refresh_admin_registry_periodically():
+    """Страховка на случай, если NOTIFY потерялся."""
+    while True:
+        await asyncio.sleep(ADMIN_REGISTRY_REFRESH)
+        try:
+            await ADMIN_REGISTRY.reload()
+        except Exception as e:
+            logger.error(f"Ошибка обновления кэша администраторов: {e}")
+
+
+async def add_admin(user_id: int, added_by: int, role: str = "moderator", display_name: str = None):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         """INSERT INTO admins (user_id, added_by, role, display_name) VALUES (%s, %s, %s, %s)
            ON CONFLICT (user_id) DO UPDATE SET
                added_by=excluded.added_by, role=excluded.role, display_name=excluded.display_name""",
         (user_id, added_by, role, display_name),
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
+    await ADMIN_REGISTRY.reload()
 
-def remove_admin(user_id: int):
-    conn = get_db_connection()
+async def remove_admin(user_id: int):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("DELETE FROM admins WHERE user_id = %s", (user_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("DELETE FROM admins WHERE user_id = %s", (user_id,))
+    await conn.commit()
+    await conn.close()
+    await ADMIN_REGISTRY.reload()
 
-def is_admin(user_id: int) -> bool:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id FROM admins WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+async def is_admin(user_id: int) -> bool:
+    return await ADMIN_REGISTRY.get(user_id) is not None
 
-def get_admin_role(user_id: int) -> Optional[str]:
+async def get_admin_role(user_id: int) -> Optional[str]:
     """Возвращает роль администратора или None если не администратор БД"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT role FROM admins WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    info = await ADMIN_REGISTRY.get(user_id)
+    return info["role"] if info else None
 
-def get_admin_info(user_id: int) -> Optional[Dict[str, Any]]:
+async def get_admin_info(user_id: int) -> Optional[Dict[str, Any]]:
     """Возвращает полную информацию об администраторе"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, role, display_name, added_at FROM admins WHERE user_id = %s", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if result:
-        return {"user_id": result[0], "role": result[1], "display_name": result[2], "added_at": result[3]}
-    return None
+    info = await ADMIN_REGISTRY.get(user_id)
+    return dict(info) if info else None
 
-def get_all_admins() -> List[int]:
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM admins")
-    admins = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return admins
+async def get_all_admins() -> List[int]:
+    return [a["user_id"] for a in await ADMIN_REGISTRY.all()]
 
-def get_admin_quest_state() -> Dict[str, Any]:
-    conn = get_db_connection()
+async def get_admin_quest_state() -> Dict[str, Any]:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT is_open, max_applications, applications_count FROM admin_quest_state WHERE id = 1")
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT is_open, max_applications, applications_count FROM admin_quest_state WHERE id = 1")
+    row = await cursor.fetchone()
+    await conn.close()
     if not row:
         return {"is_open": False, "max_applications": None, "applications_count": 0}
     return {"is_open": bool(row[0]), "max_applications": row[1], "applications_count": row[2]}
 
-def set_admin_quest_open(max_applications: Optional[int] = None):
-    conn = get_db_connection()
+async def set_admin_quest_open(max_applications: Optional[int] = None):
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE admin_quest_state SET is_open = TRUE, max_applications = %s, applications_count = 0 WHERE id = 1",
         (max_applications,)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
-def set_admin_quest_closed():
-    conn = get_db_connection()
+async def set_admin_quest_closed():
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE admin_quest_state SET is_open = FALSE WHERE id = 1")
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE admin_quest_state SET is_open = FALSE WHERE id = 1")
+    await conn.commit()
+    await conn.close()
 
-def increment_admin_quest_applications() -> int:
-    conn = get_db_connection()
+async def increment_admin_quest_applications() -> int:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE admin_quest_state SET applications_count = applications_count + 1 WHERE id = 1")
-    conn.commit()
-    cursor.execute("SELECT applications_count FROM admin_quest_state WHERE id = 1")
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("UPDATE admin_quest_state SET applications_count = applications_count + 1 WHERE id = 1")
+    await conn.commit()
+    await cursor.execute("SELECT applications_count FROM admin_quest_state WHERE id = 1")
+    row = await cursor.fetchone()
+    await conn.close()
     return row[0] if row else 0
 
-def get_all_admins_with_info() -> List[Dict[str, Any]]:
+async def get_all_admins_with_info() -> List[Dict[str, Any]]:
     """Возвращает список всех администраторов с их ролями"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, role, display_name, added_at FROM admins ORDER BY added_at")
-    rows = cursor.fetchall()
-    conn.close()
-    return [{"user_id": r[0], "role": r[1] or "moderator", "display_name": r[2], "added_at": r[3]} for r in rows]
+    return [dict(a, role=a["role"] or "moderator") for a in await ADMIN_REGISTRY.all()]
 
-def admin_can(user_id: int, permission: str) -> bool:
+async def admin_can(user_id: int, permission: str) -> bool:
     """Проверяет, есть ли у администратора конкретное право по роли.
     Если user_id в ADMIN_IDS — разрешено всё.
     permission: 'can_mute', 'can_warn', 'can_ban', 'can_adblock'
     """
     if user_id in ADMIN_IDS:
         return True
-    role = get_admin_role(user_id)
+    role = await get_admin_role(user_id)
     if not role:
         return False
     role_data = ADMIN_ROLES.get(role, ADMIN_ROLES["moderator"])
     return role_data.get(permission, False)
 
-def add_user_ad(user_id: int, message_text: str):
-    conn = get_db_connection()
+async def add_user_ad(user_id: int, message_text: str, fingerprint: Optional[int] = None):
+    if fingerprint is None:
+        fingerprint = simhash(message_text)
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO user_ads (user_id, message_text) VALUES (%s, %s)",
-        (user_id, message_text),
+    await cursor.execute(
+        "INSERT INTO user_ads (user_id, message_text, fingerprint) VALUES (%s, %s, %s)",
+        (user_id, message_text, _to_signed64(fingerprint) if fingerprint is not None else None),
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
-def get_today_ads_count(user_id: int) -> int:
-    conn = get_db_connection()
+async def get_today_ads_count(user_id: int) -> int:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT COUNT(*) AS c FROM user_ads WHERE user_id = %s AND DATE(sent_at) = CURRENT_DATE",
+    await cursor.execute(
+        # Диапазон вместо DATE(sent_at) — использует idx_user_ads_user_date
+        "SELECT COUNT(*) AS c FROM user_ads WHERE user_id = %s AND sent_at >= CURRENT_DATE",
         (user_id,),
     )
-    count = cursor.fetchone()["c"]
-    conn.close()
+    count = (await cursor.fetchone())["c"]
+    await conn.close()
     return count
 
-def get_last_ad_time(user_id: int) -> Optional[datetime]:
-    conn = get_db_connection()
+async def get_last_ad_time(user_id: int) -> Optional[datetime]:
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT sent_at FROM user_ads WHERE user_id = %s ORDER BY sent_at DESC LIMIT 1",
         (user_id,),
     )
-    result = cursor.fetchone()
-    conn.close()
+    result = await cursor.fetchone()
+    await conn.close()
     return result["sent_at"] if result else None
 
-def add_ad_violation(user_id: int):
-    """Добавляет запись о нарушении лимита объявлений"""
-    conn = get_db_connection()
+async def add_ad_violation(user_id: int) -> int:
+    """Добавляет запись о нарушении лимита объявлений. Возвращает число нарушений за сегодня."""
+    conn = await get_db_connection()
+    cursor = conn.cursor()
+    await cursor.execute(
+        """
+        INSERT INTO ad_limit_violations (user_id, violation_date) VALUES (%s, %s)
+        ON CONFLICT (user_id, violation_date)
+        DO UPDATE SET violation_count = ad_limit_violations.violation_count + 1
+        RETURNING violation_count
+        """,
+        (user_id, datetime.now().date())
+    )
+    count = (await cursor.fetchone())[0]
+    await conn.commit()
+    await conn.close()
+    return count
+
+async def get_today_violations_count(user_id: int) -> int:
+    """Получает количество нарушений лимита объявлений сегодня"""
+    conn = await get_db_connection()
     cursor = conn.cursor()
     today = datetime.now().date()
     
-    # Проверяем, есть ли уже нарушение сегодня
-    cursor.execute(
-        "SELECT id, violation_count FROM ad_limit_violations WHERE user_id = %s AND violation_date = %s",
+    await cursor.execute(
+        "SELECT violation_count FROM ad_limit_violations WHERE user_id = %s AND violation_date = %s",
         (user_id, today)
     )
-    result = cursor.fetchone()
+    result = await cursor.fetchone()
+    await conn.close()
     
-    if result:
-        # Увеличиваем счетчик нарушений
-        violation_id, count = result
-        cursor.execute(
-            "UPDATE ad_limit_violations SET violation_count = %s WHERE id = %s",
-            (count + 1, violation_id)
+    return result[0] if result else 0
+
+# ============================================================
+#       ЛИМИТ ОБЪЯВЛЕНИЙ (MAX_ADS_PER_DAY / MIN_AD_INTERVAL)
+# ============================================================
+# Время объявлений за последние сутки держится в памяти по каждому
+# пользователю (при запуске — из user_ads), поэтому проверка лимитов в
+# handle_message не ходит в БД. Само объявление записывается в user_ads
+# фоновой задачей; в БД обращается только нарушение (один upsert).
+
+class AdRateLimiter:
+    def __init__(self, max_per_day: int, min_interval: timedelta):
+        self.max_per_day = max_per_day
+        self.min_interval = min_interval
+        self._ads: Dict[int, deque] = {}
+
+    async def load(self) -> int:
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute(
+            "SELECT user_id, sent_at FROM user_ads WHERE sent_at >= %s ORDER BY sent_at",
+            (datetime.now() - timedelta(days=1),)
+        )
+        rows = await cursor.fetchall()
+        await conn.close()
+        self._ads = {}
+        for user_id, sent_at in rows:
+            self._ads.setdefault(user_id, deque()).append(sent_at)
+        return len(rows)
+
+    def _recent(self, user_id: int, now: datetime) -> deque:
+        ads = self._ads.get(user_id)
+        if ads is None:
+            return deque()
+        horizon = now - timedelta(days=1)
+        while ads and ads[0] < horizon:
+            ads.popleft()
+        if not ads:
+            del self._ads[user_id]
+        return ads
+
+    def check(self, user_id: int, now: datetime = None) -> Optional[str]:
+        """Проверяет объявление. None — можно (и объявление учтено),
+        иначе причина: 'interval' или 'daily'."""
+        now = now or datetime.now()
+        ads = self._recent(user_id, now)
+        if ads and now - ads[-1] < self.min_interval:
+            return "interval"
+        today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if sum(1 for sent_at in ads if sent_at >= today) >= self.max_per_day:
+            return "daily"
+        self._ads.setdefault(user_id, ads).append(now)
+        return None
+
+    def last_ad(self, user_id: int) -> Optional[datetime]:
+        ads = self._ads.get(user_id)
+        return ads[-1] if ads else None
+
+
+AD_LIMITER = AdRateLimiter(MAX_ADS_PER_DAY, MIN_AD_INTERVAL)
+
+# Повторы объявлений (в т. ч. с правками) — по SimHash-отпечаткам за окно
+AD_DUPLICATE_WINDOW = timedelta(hours=float(os.getenv("AD_DUPLICATE_WINDOW_HOURS", "24")))
+AD_FINGERPRINTS = AdFingerprintIndex(AD_DUPLICATE_WINDOW.total_seconds())
+
+
+def _to_signed64(value: int) -> int:
+    # BIGINT в Postgres знаковый, отпечаток — беззнаковые 64 бита
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+async def load_ad_fingerprints() -> int:
+    """Заполняет AD_FINGERPRINTS из user_ads (старые записи без отпечатка досчитываются)."""
+    conn = await get_db_connection()
+    cursor = conn.cursor()
+    await cursor.execute(
+        "SELECT user_id, message_text, sent_at, fingerprint FROM user_ads WHERE sent_at >= %s ORDER BY sent_at",
+        (datetime.now() - AD_DUPLICATE_WINDOW,)
+    )
+    rows = await cursor.fetchall()
+    await conn.close()
+    loaded = 0
+    for user_id, text, sent_at, fingerprint in rows:
+        fingerprint = fingerprint % (1 << 64) if fingerprint is not None else simhash(text)
+        if fingerprint is not None:
+            AD_FINGERPRINTS.add(user_id, fingerprint, sent_at.timestamp())
+            loaded += 1
+    return loaded
+
+
+# Ссылки на фоновые записи объявлений: цикл событий держит задачи слабо
+AD_RECORD_TASKS: Set[asyncio.Task] = set()
+
+
+async def _record_ad(user_id: int, text: str, fingerprint: Optional[int] = None):
+    try:
+        await add_user_ad(user_id, text, fingerprint)
+    except Exception as e:
+        logger.error(f"Ошибка записи объявления {user_id}: {e}")
+
+
+async def enforce_ad_limits(message: Message, text: str) -> bool:
+    """Проверяет лимиты и повторы объявлений. True — сообщение нарушает правила и обработано."""
+    user_id = message.from_user.id
+    now = datetime.now()
+    fingerprint = simhash(text)
+    duplicate = (
+        AD_FINGERPRINTS.find(user_id, fingerprint, now.timestamp()) if fingerprint is not None else None
+    )
+    violation = "duplicate" if duplicate else AD_LIMITER.check(user_id, now)
+    if violation is None:
+        if fingerprint is not None:
+            AD_FINGERPRINTS.add(user_id, fingerprint, now.timestamp())
+        task = asyncio.create_task(_record_ad(user_id, text, fingerprint))
+        AD_RECORD_TASKS.add(task)
+        task.add_done_callback(AD_RECORD_TASKS.discard)
+        return False
+    if await is_chat_admin_or_bot_admin(user_id, message.chat.id):
+        return False
+
+    if AD_ENFORCE_MODE != "enforce":
+        # Пробный режим: нарушение видно в журнале, сообщение остаётся, мута нет
+        logger.info(f"Лимит объявлений {user_id}: {violation} (режим {AD_ENFORCE_MODE}, без санкций)")
+        await send_to_mod_log(
+            f"🧪 Лимит объявлений (без санкций)\n\n"
+            f"👤 <b>Пользователь:</b> {await get_user_mention(user_id)}\n"
+            f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
+            f"📝 <b>Нарушение:</b> {violation}\n"
+            f"💬 <b>Текст:</b> {html.escape(text[:200])}",
+            kind="ad_dry_run", user_id=user_id
         )
+        return False
+
+    await delete_message(message.chat.id, message.message_id)
+    try:
+        violations_today = await add_ad_violation(user_id)
+    except Exception as e:
+        logger.error(f"Ошибка записи нарушения лимита объявлений {user_id}: {e}")
+        violations_today = 1
+    # Правило 1: мут на 1–3 дня, растёт с числом нарушений за день
+    days = min(violations_today, 3)
+    if violation == "duplicate":
+        posted_at = datetime.fromtimestamp(duplicate[0])
+        reason = f"НПОО (повтор объявления от {posted_at.strftime('%d.%m %H:%M')})"
+    elif violation == "interval":
+        next_at = AD_LIMITER.last_ad(user_id) + MIN_AD_INTERVAL
+        reason = f"НПОО (следующее объявление — после {next_at.strftime('%H:%M')})"
     else:
-        # Создаем новую запись
-        cursor.execute(
-            "INSERT INTO ad_limit_violations (user_id, violation_date) VALUES (%s, %s)",
-            (user_id, today)
+        reason = f"НПОО (не более {MAX_ADS_PER_DAY} объявлений в день)"
+    await mute_user(
+        message.chat.id, user_id, timedelta(days=days), reason,
+        is_auto=True, message_thread_id=message.message_thread_id
+    )
+    return True
+
+
+# Флуд: состояние в памяти (кольцевые буферы на пользователя), без запросов к БД
+FLOOD_DETECTOR = FloodDetector(
+    burst_count=int(os.getenv("FLOOD_BURST_COUNT", "5")),
+    burst_seconds=float(os.getenv("FLOOD_BURST_SECONDS", "4")),
+    repeat_count=int(os.getenv("FLOOD_REPEAT_COUNT", "3")),
+)
+FLOOD_REASONS = {
+    "burst": "Флуд (слишком частые сообщения)",
+    "repeat": "Флуд (повтор одного и того же сообщения)",
+    "chars": "Флуд (повтор символов)",
+    "emoji": "Флуд (эмодзи)",
+}
+
+
+async def enforce_flood(message: Message, text: str) -> bool:
+    """Проверяет сообщение на флуд. True — нарушение найдено и обработано."""
+    verdict = FLOOD_DETECTOR.check(message.from_user.id, text, time.monotonic())
+    if verdict is None:
+        return False
+    user_id = message.from_user.id
+    if await is_chat_admin_or_bot_admin(user_id, message.chat.id):
+        return False
+
+    reason = FLOOD_REASONS[verdict.reason]
+    if FLOOD_ENFORCE_MODE != "enforce":
+        # Пробный режим: сообщение остаётся, в рейд-список пользователь не попадает
+        logger.info(f"Флуд {user_id}: {verdict.reason}, нарушение {verdict.strikes} (режим {FLOOD_ENFORCE_MODE}, без санкций)")
+        await send_to_mod_log(
+            f"🧪 Флуд (без санкций)\n\n"
+            f"👤 <b>Пользователь:</b> {await get_user_mention(user_id)}\n"
+            f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
+            f"📝 <b>Нарушение:</b> {reason}, {verdict.strikes}-е за окно\n"
+            f"💬 <b>Текст:</b> {html.escape(text[:200])}",
+            kind="flood_dry_run", user_id=user_id
+        )
+        return False
+
+    await delete_message(message.chat.id, message.message_id)
+    RAID.flag(user_id)
+    if RAID.active:
+        # Во время рейда флудеры мутятся пачкой (raid_auto_loop), без варнов
+        return True
+    # Правило 8: предупреждение → мут от 1 до 7 дней при повторе
+    if verdict.strikes == 1:
+        await warn_user(message.chat.id, user_id, reason, message_thread_id=message.message_thread_id)
+    else:
+        await mute_user(
+            message.chat.id, user_id, timedelta(days=min(verdict.strikes - 1, 7)), reason,
+            is_auto=True, message_thread_id=message.message_thread_id
         )
-    
-    conn.commit()
-    conn.close()
+    return True
 
-def get_today_violations_count(user_id: int) -> int:
-    """Получает количество нарушений лимита объявлений сегодня"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    today = datetime.now().date()
-    
-    cursor.execute(
-        "SELECT violation_count FROM ad_limit_violations WHERE user_id = %s AND violation_date = %s",
-        (user_id, today)
-    )
-    result = cursor.fetchone()
-    conn.close()
-    
-    return result[0] if result else 0
 
-def get_active_complaints() -> List[Dict[str, Any]]:
+async def get_active_complaints() -> List[Dict[str, Any]]:
     """Получает активные жалобы из базы данных"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         """SELECT id, user_id, username, admin_username, description, complaint_text, evidence, 
                   created_at, status, handled_by, handling_result
            FROM admin_complaints 
@@ -1471,24 +2648,24 @@ def get_active_complaints() -> List[Dict[str, Any]]:
             "handled_by": row[9],
             "handling_result": row[10]
         }
-        for row in cursor.fetchall()
+        for row in await cursor.fetchall()
     ]
-    conn.close()
+    await conn.close()
     return complaints
 
-def get_complaint_by_id(complaint_id: int) -> Optional[Dict[str, Any]]:
+async def get_complaint_by_id(complaint_id: int) -> Optional[Dict[str, Any]]:
     """Получает жалобу по ID"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         """SELECT id, user_id, username, admin_username, description, complaint_text, evidence, 
                   created_at, status, handled_by, handling_result
            FROM admin_complaints 
            WHERE id = %s""",
         (complaint_id,)
     )
-    result = cursor.fetchone()
-    conn.close()
+    result = await cursor.fetchone()
+    await conn.close()
     
     if result:
         return {
@@ -1506,22 +2683,22 @@ def get_complaint_by_id(complaint_id: int) -> Optional[Dict[str, Any]]:
         }
     return None
 
-def update_complaint_status(complaint_id: int, status: str, handled_by: int = None, handling_result: str = None):
+async def update_complaint_status(complaint_id: int, status: str, handled_by: int = None, handling_result: str = None):
     """Обновляет статус жалобы"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         """UPDATE admin_complaints 
            SET status = %s, handled_by = %s, handling_result = %s, handled_at = CURRENT_TIMESTAMP
            WHERE id = %s""",
         (status, handled_by, handling_result, complaint_id)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
-def save_admin_complaint(user_id: int, username: str, admin_username: str, description: str, complaint_text: str, evidence: str = None) -> int:
+async def save_admin_complaint(user_id: int, username: str, admin_username: str, description: str, complaint_text: str, evidence: str = None) -> int:
     """Сохраняет жалобу на администратора в базу данных и возвращает ID жалобы"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
     # Обеспечиваем, что обязательные поля не NULL
@@ -1530,54 +2707,54 @@ def save_admin_complaint(user_id: int, username: str, admin_username: str, descr
     description = description or "Не указано"
     complaint_text = complaint_text or "Не указано"
     
-    cursor.execute(
+    await cursor.execute(
         """INSERT INTO admin_complaints 
            (user_id, username, admin_username, description, complaint_text, evidence) 
            VALUES (%s, %s, %s, %s, %s, %s) RETURNING id""",
         (user_id, username, admin_username, description, complaint_text, evidence)
     )
-    complaint_id = cursor.fetchone()["id"]
-    conn.commit()
-    conn.close()
+    complaint_id = (await cursor.fetchone())["id"]
+    await conn.commit()
+    await conn.close()
     return complaint_id
 
-def has_accepted_tos(user_id: int) -> bool:
+async def has_accepted_tos(user_id: int) -> bool:
     """Проверяет, принял ли пользователь пользовательское соглашение"""
     try:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM tos_accepted WHERE user_id = %s", (user_id,))
-        result = cursor.fetchone()
-        conn.close()
+        await cursor.execute("SELECT user_id FROM tos_accepted WHERE user_id = %s", (user_id,))
+        result = await cursor.fetchone()
+        await conn.close()
         return result is not None
     except Exception as e:
         logger.error(f"Ошибка проверки TOS для {user_id}: {e}")
         return False
 
 
-def save_tos_acceptance(user_id: int):
+async def save_tos_acceptance(user_id: int):
     """Сохраняет факт принятия соглашения пользователем"""
     try:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "INSERT INTO tos_accepted (user_id, accepted_at) VALUES (%s, %s) ON CONFLICT (user_id) DO NOTHING",
             (user_id, datetime.now())
         )
-        conn.commit()
-        conn.close()
+        await conn.commit()
+        await conn.close()
     except Exception as e:
         logger.error(f"Ошибка сохранения TOS для {user_id}: {e}")
 
 
-def get_all_bot_users() -> List[int]:
-    """Возвращает список всех user_id, запустивших бота"""
+async def get_all_bot_users() -> List[int]:
+    """Возвращает список всех user_id, запустивших бота (кроме заблокировавших его)"""
     try:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT user_id FROM bot_users")
-        rows = cursor.fetchall()
-        conn.close()
+        await cursor.execute("SELECT user_id FROM bot_users WHERE NOT COALESCE(is_blocked, FALSE)")
+        rows = await cursor.fetchall()
+        await conn.close()
         return [row[0] for row in rows]
     except Exception as e:
         logger.error(f"Ошибка получения списка пользователей: {e}")
@@ -1599,65 +2776,65 @@ class ProductStates(StatesGroup):
     waiting_for_photo = State()
     waiting_for_more_photos = State()
 
-def is_user_blocked(user_id: int) -> bool:
+async def is_user_blocked(user_id: int) -> bool:
     """Проверяет, заблокирован ли пользователь в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id FROM bot_blocks WHERE user_id = %s AND is_active = TRUE",
         (user_id,)
     )
-    result = cursor.fetchone()
-    conn.close()
+    result = await cursor.fetchone()
+    await conn.close()
     return result is not None
 
-def block_user(user_id: int, reason: str, blocked_by: int):
+async def block_user(user_id: int, reason: str, blocked_by: int):
     """Блокирует пользователя в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         """INSERT INTO bot_blocks (user_id, reason, blocked_by) VALUES (%s, %s, %s)
            ON CONFLICT (user_id) DO UPDATE SET
                reason=excluded.reason, blocked_by=excluded.blocked_by,
                blocked_at=CURRENT_TIMESTAMP, is_active=TRUE""",
         (user_id, reason, blocked_by)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
-def unblock_user(user_id: int):
+async def unblock_user(user_id: int):
     """Разблокирует пользователя в боте"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE bot_blocks SET is_active = FALSE WHERE user_id = %s",
         (user_id,)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
 # Функции для работы с отзывами о пользователях
-def add_user_review(from_user_id: int, to_user_id: int, rating: int, review_text: str) -> int:
+async def add_user_review(from_user_id: int, to_user_id: int, rating: int, review_text: str) -> int:
     """Добавляет отзыв о пользователе"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute(
+    await cursor.execute(
         "INSERT INTO user_reviews (from_user_id, to_user_id, rating, review_text) VALUES (%s, %s, %s, %s) RETURNING id",
         (from_user_id, to_user_id, rating, review_text)
     )
-    review_id = cursor.fetchone()["id"]
-    conn.commit()
-    conn.close()
+    review_id = (await cursor.fetchone())["id"]
+    await conn.commit()
+    await conn.close()
     
     return review_id
 
-def get_user_reviews(user_id: int) -> List[Dict[str, Any]]:
+async def get_user_reviews(user_id: int) -> List[Dict[str, Any]]:
     """Получает все отзывы о пользователе"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute(
+    await cursor.execute(
         """SELECT id, from_user_id, rating, review_text, created_at 
            FROM user_reviews 
            WHERE to_user_id = %s 
@@ -1666,7 +2843,7 @@ def get_user_reviews(user_id: int) -> List[Dict[str, Any]]:
     )
     
     reviews = []
-    for row in cursor.fetchall():
+    for row in await cursor.fetchall():
         reviews.append({
             "id": row[0],
             "from_user_id": row[1],
@@ -1675,37 +2852,37 @@ def get_user_reviews(user_id: int) -> List[Dict[str, Any]]:
             "created_at": row[4]
         })
     
-    conn.close()
+    await conn.close()
     return reviews
 
-def get_user_rating_stats(user_id: int) -> Tuple[float, int]:
+async def get_user_rating_stats(user_id: int) -> Tuple[float, int]:
     """Получает средний рейтинг и количество отзывов пользователя"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute(
+    await cursor.execute(
         "SELECT AVG(rating), COUNT(*) FROM user_reviews WHERE to_user_id = %s",
         (user_id,)
     )
-    row = cursor.fetchone()
-    conn.close()
+    row = await cursor.fetchone()
+    await conn.close()
     
     avg_rating = row[0] if row[0] else 0
     review_count = row[1] if row[1] else 0
     
     return round(avg_rating, 1), review_count
 
-def get_user_review_from_user(from_user_id: int, to_user_id: int) -> Optional[Dict[str, Any]]:
+async def get_user_review_from_user(from_user_id: int, to_user_id: int) -> Optional[Dict[str, Any]]:
     """Проверяет, оставлял ли пользователь отзыв о другом пользователе"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
-    cursor.execute(
+    await cursor.execute(
         "SELECT id, rating, review_text, created_at FROM user_reviews WHERE from_user_id = %s AND to_user_id = %s",
         (from_user_id, to_user_id)
     )
-    row = cursor.fetchone()
-    conn.close()
+    row = await cursor.fetchone()
+    await conn.close()
     
     if row:
         return {
@@ -1716,9 +2893,9 @@ def get_user_review_from_user(from_user_id: int, to_user_id: int) -> Optional[Di
         }
     return None
 
-def get_complaints_keyboard() -> InlineKeyboardMarkup:
+async def get_complaints_keyboard() -> InlineKeyboardMarkup:
     """Создает инлайн-клавиатуру со списком активных жалоб"""
-    complaints = get_active_complaints()
+    complaints = await get_active_complaints()
     keyboard = InlineKeyboardBuilder()
     
     if not complaints:
@@ -1804,12 +2981,12 @@ def get_public_menu_keyboard():
     keyboard.row(InlineKeyboardButton(text="👤 Мой профиль", callback_data="my_profile"))
     return keyboard.as_markup()
 
-def get_user_reviews_keyboard(user_id: int, viewer_id: int):
+async def get_user_reviews_keyboard(user_id: int, viewer_id: int):
     """Клавиатура для отзывов пользователя"""
     keyboard = InlineKeyboardBuilder()
     
     # Проверяем, оставлял ли уже пользователь отзыв
-    existing_review = get_user_review_from_user(viewer_id, user_id)
+    existing_review = await get_user_review_from_user(viewer_id, user_id)
     
     if not existing_review and viewer_id != user_id:
         keyboard.row(InlineKeyboardButton(text="✏️ Оставить отзыв", callback_data=f"leave_review:{user_id}"))
@@ -1834,16 +3011,150 @@ def get_rating_keyboard():
     keyboard.row(InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_review"))
     return keyboard.as_markup()
 
+# ============================================================
+#         КЭШ ПРОФИЛЕЙ ПОЛЬЗОВАТЕЛЕЙ (имена для упоминаний)
+# ============================================================
+
+class UserProfile:
+    __slots__ = ("user_id", "username", "first_name", "last_name")
+
+    def __init__(self, user_id: int, username: Optional[str], first_name: Optional[str], last_name: Optional[str]):
+        self.user_id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+
+    @property
+    def display_name(self) -> str:
+        return self.first_name or self.username or str(self.user_id)
+
+
+class UserProfileCache:
+    """Кэш имён пользователей перед bot.get_chat.
+
+    Порядок поиска: LRU в памяти (с TTL) → таблица bot_users (если запись
+    свежая) → bot.get_chat. Кэш дополнительно пополняется бесплатно из
+    входящих апдейтов (ProfileCacheMiddleware), поэтому упоминание того,
+    кто только что написал в чат, вообще не требует запросов.
+    get_many() резолвит список одним SELECT ... ANY(%s) и параллельными
+    (но ограниченными семафором) запросами get_chat для оставшихся."""
+
+    def __init__(self, ttl: float, db_max_age: timedelta, max_size: int = 20000, concurrency: int = 5):
+        self.ttl = ttl
+        self.db_max_age = db_max_age
+        self.max_size = max_size
+        self._entries: "OrderedDict[int, Tuple[UserProfile, float]]" = OrderedDict()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def _put(self, profile: UserProfile):
+        self._entries[profile.user_id] = (profile, time.monotonic() + self.ttl)
+        self._entries.move_to_end(profile.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def remember(self, user) -> None:
+        """Сохраняет профиль из объекта User/Chat aiogram."""
+        if user is None or not getattr(user, "id", None):
+            return
+        self._put(UserProfile(user.id, user.username, user.first_name, user.last_name))
+
+    def _cached(self, user_id: int) -> Optional[UserProfile]:
+        entry = self._entries.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            return entry[0]
+        return None
+
+    async def _load_from_db(self, user_ids: List[int]) -> Dict[int, UserProfile]:
+        if not user_ids:
+            return {}
+        try:
+            conn = await get_db_connection()
+            cursor = conn.cursor()
+            await cursor.execute(
+                "SELECT user_id, username, first_name, last_name FROM bot_users "
+                "WHERE user_id = ANY(%s) AND last_seen > %s",
+                (list(user_ids), datetime.now() - self.db_max_age)
+            )
+            rows = await cursor.fetchall()
+            await conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка чтения профилей из bot_users: {e}")
+            return {}
+        found = {}
+        for user_id, username, first_name, last_name in rows:
+            profile = UserProfile(user_id, username, first_name, last_name)
+            self._put(profile)
+            found[user_id] = profile
+        return found
+
+    async def _fetch(self, user_id: int) -> Optional[UserProfile]:
+        async with self._semaphore:
+            try:
+                chat = await bot.get_chat(user_id)
+            except Exception:
+                return None
+        self.remember(chat)
+        return self._cached(user_id)
+
+    async def get(self, user_id: int) -> Optional[UserProfile]:
+        profile = self._cached(user_id)
+        if profile:
+            return profile
+        profile = (await self._load_from_db([user_id])).get(user_id)
+        if profile:
+            return profile
+        return await self._fetch(user_id)
+
+    async def get_many(self, user_ids) -> Dict[int, UserProfile]:
+        result: Dict[int, UserProfile] = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            profile = self._cached(user_id)
+            if profile:
+                result[user_id] = profile
+            else:
+                missing.append(user_id)
+        if missing:
+            result.update(await self._load_from_db(missing))
+            missing = [u for u in missing if u not in result]
+        if missing:
+            fetched = await asyncio.gather(*(self._fetch(u) for u in missing))
+            result.update({u: p for u, p in zip(missing, fetched) if p})
+        return result
+
+
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "3600"))
+PROFILES = UserProfileCache(ttl=PROFILE_CACHE_TTL, db_max_age=timedelta(days=1))
+
+
+def profile_name(profiles: Dict[int, UserProfile], user_id: int) -> str:
+    """Имя пользователя из результата PROFILES.get_many (или ID, если не найден)."""
+    profile = profiles.get(user_id)
+    return profile.display_name if profile else str(user_id)
+
+
+class ProfileCacheMiddleware(BaseMiddleware):
+    """Outer-middleware: запоминает from_user каждого входящего сообщения/callback."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict,
+    ) -> Any:
+        PROFILES.remember(getattr(event, "from_user", None))
+        return await handler(event, data)
+
+
 # Вспомогательные функции
 async def get_user_mention(user_id: int) -> str:
-    try:
-        user = await bot.get_chat(user_id)
-        name = user.first_name or user.username or str(user_id)
-        # Экранируем HTML-спецсимволы в имени, чтобы не ломать parse_mode="HTML"
-        name = name.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-        return f'<a href="tg://user?id={user_id}">{name}</a>'
-    except Exception:
+    profile = await PROFILES.get(user_id)
+    if not profile:
         return str(user_id)
+    # Экранируем HTML-спецсимволы в имени, чтобы не ломать parse_mode="HTML"
+    name = profile.display_name.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    return f'<a href="tg://user?id={user_id}">{name}</a>'
 
 async def format_duration(duration: timedelta) -> str:
     if not duration:
@@ -1868,7 +3179,80 @@ async def is_owner(user_id: int) -> bool:
 
 async def is_admin_user(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором бота (из ADMIN_IDS или базы данных)"""
-    return user_id in ADMIN_IDS or is_admin(user_id)
+    return user_id in ADMIN_IDS or await is_admin(user_id)
+
+class ChatMemberCache:
+    """Кэш статусов участников чата перед bot.get_chat_member.
+
+    Ключ — (chat_id, user_id), значение — статус и момент устаревания.
+    Записи обновляются из апдейтов chat_member (на них бот подписан
+    в start_polling), список администраторов предзагружается через
+    getChatAdministrators при старте. Запрос к Telegram уходит только
+    при промахе или по истечении TTL; одновременные промахи по одному
+    ключу склеиваются в один запрос."""
+
+    def __init__(self, ttl: float, max_size: int = 50000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[Tuple[int, int], Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set(self, chat_id: int, user_id: int, status: str, ttl: float = None):
+        key = (chat_id, user_id)
+        self._entries[key] = (status, time.monotonic() + (ttl if ttl is not None else self.ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, chat_id: int, user_id: int):
+        self._entries.pop((chat_id, user_id), None)
+
+    async def get_status(self, chat_id: int, user_id: int) -> str:
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        future = self._inflight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            member = await bot.get_chat_member(chat_id, user_id)
+            self.set(chat_id, user_id, member.status)
+            future.set_result(member.status)
+            return member.status
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже возвращается вызывающему — помечаем его
+            # полученным, чтобы asyncio не ругался при отсутствии ожидающих
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            if not future.done():
+                # Ведущий запрос отменён (CancelledError минует except Exception):
+                # ожидающие получают обычную ошибку, а не висят или отменяются сами
+                future.set_exception(RuntimeError(f"Запрос статуса {key} отменён"))
+                future.exception()
+
+    async def preload_admins(self, chat_id: int) -> int:
+        """Заполняет кэш администраторами чата одним запросом getChatAdministrators."""
+        admins = await bot.get_chat_administrators(chat_id)
+        for member in admins:
+            self.set(chat_id, member.user.id, member.status)
+        return len(admins)
+
+
+CHAT_MEMBER_CACHE_TTL = float(os.getenv("CHAT_MEMBER_CACHE_TTL", "300"))
+CHAT_MEMBERS = ChatMemberCache(ttl=CHAT_MEMBER_CACHE_TTL)
+
 
 async def is_chat_admin(user_id: int, chat_id: int = None) -> bool:
     """Проверяет, является ли пользователь администратором чата"""
@@ -1876,15 +3260,15 @@ async def is_chat_admin(user_id: int, chat_id: int = None) -> bool:
         return False
         
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
+        status = await CHAT_MEMBERS.get_status(chat_id, user_id)
+        return status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
     except Exception as e:
         logger.error(f"Ошибка проверки прав администратора чата: {e}")
         return False
 
 async def is_bot_admin(user_id: int) -> bool:
     """Проверяет, является ли пользователь администратором бота (не чата)"""
-    return user_id in ADMIN_IDS or is_admin(user_id)
+    return user_id in ADMIN_IDS or await is_admin(user_id)
 
 def parse_time(time_str: str) -> Optional[timedelta]:
     """
@@ -1943,18 +3327,55 @@ async def get_user_id_from_message(text: str) -> Optional[int]:
         logger.error(f"Ошибка получения пользователя по юзернейму @{text}: {e}")
         return None
 
+AD_CLASSIFIER = AdClassifier(threshold=float(os.getenv("AD_SCORE_THRESHOLD", str(AD_THRESHOLD))))
+
+
 def is_ad_message(text: str) -> bool:
-    """Определяет, является ли сообщение объявлением"""
-    ad_keywords = [
-        'продам', 'продаю', 'куплю', 'покупаю', 'обмен', 'меняю', 
-        'отдам', 'даром', 'бесплатно', 'цена', 'стоимость', '₽', 'руб',
-        'тг', 'телеграм', 'доставка', 'забрать', 'самовывоз'
-    ]
-    
-    text_lower = text.lower()
-    # Если сообщение содержит несколько ключевых слов, считаем его объявлением
-    keyword_count = sum(1 for keyword in ad_keywords if keyword in text_lower)
-    return keyword_count >= 2 or len(text) > 100  # Длинные сообщения тоже считаем объявлениями
+    """Определяет, является ли сообщение объявлением (см. AdClassifier)"""
+    return AD_CLASSIFIER.is_ad(text)
+
+
+def counts_toward_ad_limits(text: str) -> bool:
+    """Засчитывается ли сообщение в лимиты объявлений (оценка не ниже AD_ENFORCE_SCORE)"""
+    return AD_CLASSIFIER.score(text).score >= max(AD_CLASSIFIER.threshold, AD_ENFORCE_SCORE)
+
+
+async def rescore_user_ads(days: int = 30, batch_size: int = 1000) -> Dict[str, Any]:
+    """Пересчитывает оценку классификатора для объявлений из user_ads за days дней.
+    Читает пачками по id (keyset), ничего не изменяет — только статистика."""
+    since = datetime.now() - timedelta(days=days)
+    total = flagged = enforced = 0
+    features: Dict[str, int] = {}
+    low_scored: List[Tuple[float, str]] = []
+    last_id = 0
+    conn = await get_db_connection()
+    cursor = conn.cursor()
+    try:
+        while True:
+            await cursor.execute(
+                "SELECT id, message_text FROM user_ads WHERE id > %s AND sent_at >= %s "
+                "ORDER BY id LIMIT %s",
+                (last_id, since, batch_size)
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            texts = [row[1] for row in rows]
+            for text, result in zip(texts, AD_CLASSIFIER.score_many(texts)):
+                total += 1
+                if result.score >= AD_CLASSIFIER.threshold:
+                    flagged += 1
+                    if result.score >= AD_ENFORCE_SCORE:
+                        enforced += 1
+                elif len(low_scored) < 5:
+                    low_scored.append((result.score, text))
+                for feature in result.features:
+                    features[feature] = features.get(feature, 0) + 1
+    finally:
+        await conn.close()
+    return {"total": total, "flagged": flagged, "enforced": enforced, "features": features, "low_scored": low_scored}
+
 
 async def is_chat_admin_or_bot_admin(user_id: int, chat_id: int = None) -> bool:
     """Проверяет, является ли пользователь администратором чата или бота"""
@@ -1963,9 +3384,9 @@ async def is_chat_admin_or_bot_admin(user_id: int, chat_id: int = None) -> bool:
         
     # Проверяем права администратора в чате
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        is_chat_admin = member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
-        is_bot_admin = user_id in ADMIN_IDS or is_admin(user_id)
+        status = await CHAT_MEMBERS.get_status(chat_id, user_id)
+        is_chat_admin = status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
+        is_bot_admin = user_id in ADMIN_IDS or await is_admin(user_id)
         
         return is_chat_admin or is_bot_admin
     except Exception as e:
@@ -2002,18 +3423,8 @@ async def mute_user(chat_id: int, user_id: int, duration: timedelta = None, reas
         reason_str = f"\n📝 <b>Причина:</b> {reason}" if reason else ""
         user_mention = await get_user_mention(user_id)
 
-        # Деактивируем предыдущие активные муты
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE mutes SET is_active = FALSE WHERE user_id = %s AND chat_id = %s AND is_active = TRUE",
-            (user_id, chat_id)
-        )
-        conn.commit()
-        conn.close()
-
-        # Добавляем новый мут
-        add_mute(user_id, chat_id, reason, 0 if is_auto else chat_id, duration)
+        # Прежний активный мут деактивируется в той же транзакции
+        await MODERATION.mute(user_id, chat_id, reason, 0 if is_auto else chat_id, duration)
 
         if is_auto:
             message_text = (
@@ -2051,7 +3462,8 @@ async def mute_user(chat_id: int, user_id: int, duration: timedelta = None, reas
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
             f"⏳ <b>Срок:</b> {duration_str}"
             + (f"\n📝 <b>Причина:</b> {reason}" if reason else "") +
-            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="automute" if is_auto else "mute", user_id=user_id
         )
 
         return True
@@ -2072,6 +3484,7 @@ async def unmute_user(chat_id: int, user_id: int, message_thread_id: int = None)
             can_pin_messages=False,
         )
         await bot.restrict_chat_member(chat_id, user_id, permissions)
+        await MODERATION.record("unmute", user_id, chat_id)
 
         user_mention = await get_user_mention(user_id)
         await bot.send_message(
@@ -2088,7 +3501,8 @@ async def unmute_user(chat_id: int, user_id: int, message_thread_id: int = None)
             f"🔊 Размут\n\n"
             f"👤 <b>Пользователь:</b> {user_mention}\n"
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
-            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="unmute", user_id=user_id
         )
 
         return True
@@ -2105,18 +3519,8 @@ async def ban_user(chat_id: int, user_id: int, duration: timedelta = None, reaso
         reason_str = f"\n📝 <b>Причина:</b> {reason}" if reason else ""
         user_mention = await get_user_mention(user_id)
 
-        # Деактивируем предыдущие активные баны
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE bans SET is_active = FALSE WHERE user_id = %s AND chat_id = %s AND is_active = TRUE",
-            (user_id, chat_id)
-        )
-        conn.commit()
-        conn.close()
-
-        # Добавляем новый бан
-        add_ban(user_id, chat_id, reason, chat_id, duration)
+        # Прежний активный бан деактивируется в той же транзакции
+        await MODERATION.ban(user_id, chat_id, reason, chat_id, duration)
 
         ban_appeal_builder = InlineKeyboardBuilder()
         ban_appeal_builder.row(InlineKeyboardButton(
@@ -2140,7 +3544,8 @@ async def ban_user(chat_id: int, user_id: int, duration: timedelta = None, reaso
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
             f"⏳ <b>Срок:</b> {duration_str}"
             + (f"\n📝 <b>Причина:</b> {reason}" if reason else "") +
-            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="ban", user_id=user_id
         )
 
         return True
@@ -2152,6 +3557,7 @@ async def unban_user(chat_id: int, user_id: int, message_thread_id: int = None)
     try:
         # only_if_banned=True — не кикает пользователя, если он уже в чате
         await bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
+        await MODERATION.record("unban", user_id, chat_id)
 
         user_mention = await get_user_mention(user_id)
         await bot.send_message(
@@ -2168,7 +3574,8 @@ async def unban_user(chat_id: int, user_id: int, message_thread_id: int = None)
             f"✅ Разбан\n\n"
             f"👤 <b>Пользователь:</b> {user_mention}\n"
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
-            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="unban", user_id=user_id
         )
 
         return True
@@ -2184,10 +3591,389 @@ async def delete_message(chat_id: int, message_id: int) -> bool:
         logger.error(f"Ошибка удаления сообщения: {e}")
         return False
 
+
+# ============================================================
+#          МАССОВОЕ УДАЛЕНИЕ СООБЩЕНИЙ (/cc)
+# ============================================================
+# ID сообщений в группах не сплошные (удалённые, служебные, чужие
+# обсуждения), поэтому последние ID каждого чата запоминаются по входящим
+# апдейтам и ответам бота — /cc удаляет именно их, а не перебирает
+# диапазон наугад. Удаление идёт пачками deleteMessages (до 100 ID за
+# запрос; в aiogram 3.0.0b7 метода нет — см. DeleteMessages); если запрос
+# отклонён — пачка удаляется по одному сообщению параллельно (темп задаёт OUTBOX).
+
+RECENT_MESSAGES_PER_CHAT = 1000
+DELETE_BATCH_SIZE = 100
+CLEAR_PROGRESS_INTERVAL = 2  # секунд между правками сообщения с прогрессом
+
+
+class RecentMessages:
+    def __init__(self, per_chat: int):
+        self.per_chat = per_chat
+        self._chats: Dict[int, deque] = {}
+
+    def add(self, chat_id: int, message_id: int):
+        ids = self._chats.get(chat_id)
+        if ids is None:
+            ids = self._chats[chat_id] = deque(maxlen=self.per_chat)
+        ids.append(message_id)
+
+    def discard(self, chat_id: int, message_ids):
+        ids = self._chats.get(chat_id)
+        if ids:
+            gone = set(message_ids)
+            self._chats[chat_id] = deque((i for i in ids if i not in gone), maxlen=self.per_chat)
+
+    def before(self, chat_id: int, message_id: int, limit: int, exclude=()) -> List[int]:
+        """До limit последних известных ID меньше message_id, от новых к старым."""
+        excluded = set(exclude)
+        ids = sorted({i for i in self._chats.get(chat_id, ()) if i < message_id and i not in excluded}, reverse=True)
+        return ids[:limit]
+
+
+RECENT_MESSAGES = RecentMessages(RECENT_MESSAGES_PER_CHAT)
+
+
+class RecentMessagesMiddleware(BaseMiddleware):
+    """Outer-middleware: запоминает ID сообщений групповых чатов для /cc и рейд-режима."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict,
+    ) -> Any:
+        if isinstance(event, Message) and event.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+            RECENT_MESSAGES.add(event.chat.id, event.message_id)
+            if event.chat.id == CHAT_ID and event.from_user and not event.from_user.is_bot:
+                RAID.on_message(event.from_user.id, event.message_id)
+        return await handler(event, data)
+
+
+class DeleteMessages(TelegramMethod[bool]):
+    """Метод Bot API deleteMessages (до 100 сообщений за запрос).
+
+    В aiogram 3.0.0b7 его нет, поэтому запрос собираем сами; отправка идёт
+    через bot.session, как у встроенных методов, — с OutboundRateLimitMiddleware."""
+
+    __returning__ = bool
+
+    chat_id: Union[int, str]
+    message_ids: List[int]
+
+    def build_request(self, bot: Bot) -> Request:
+        return Request(method="deleteMessages", data=self.dict())
+
+
+async def bulk_delete_messages(chat_id: int, message_ids: List[int], on_progress=None) -> int:
+    """Удаляет сообщения пачками. Возвращает число удалённых.
+
+    on_progress(обработано, удалено) — корутина, вызывается после каждой пачки."""
+    deleted = 0
+    processed = 0
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        chunk = message_ids[start:start + DELETE_BATCH_SIZE]
+        bulk_ok = False
+        try:
+            # Недоступные сообщения Telegram пропускает молча
+            await bot(DeleteMessages(chat_id=chat_id, message_ids=chunk))
+            bulk_ok = True
+            deleted += len(chunk)
+        except Exception as e:
+            logger.warning(f"deleteMessages не сработал для чата {chat_id}, удаляю по одному: {e}")
+        if not bulk_ok:
+            results = await asyncio.gather(*(_delete_quietly(chat_id, mid) for mid in chunk))
+            deleted += sum(results)
+        processed += len(chunk)
+        RECENT_MESSAGES.discard(chat_id, chunk)
+        if on_progress:
+            await on_progress(processed, deleted)
+    return deleted
+
+
+async def _delete_quietly(chat_id: int, message_id: int) -> bool:
+    # При очистке чата отсутствующие сообщения — норма, в лог не пишем
+    try:
+        await bot.delete_message(chat_id, message_id)
+        return True
+    except Exception:
+        return False
+
+# ============================================================
+#                 РЕЙД-РЕЖИМ (МАССОВАЯ МОДЕРАЦИЯ)
+# ============================================================
+# RAID держит в памяти входы в CHAT_ID и последние сообщения с авторами.
+# Всплеск входов (RAID_JOIN_LIMIT за RAID_JOIN_WINDOW) включает рейд-режим:
+# флудеры не получают варн, а копятся и раз в RAID_AUTO_INTERVAL мутятся
+# одной пачкой. Команда /raid собирает нарушителей за окно (вошли и
+# написали, либо пойманы детектором флуда) и наказывает всех разом:
+# вызовы Telegram идут параллельно через OUTBOX, запись в БД — один
+# запрос MODERATION.*_many, в журнал модерации — одна сводка вместо N.
+
+RAID_JOIN_LIMIT = int(os.getenv("RAID_JOIN_LIMIT", "10"))
+RAID_JOIN_WINDOW = 60               # секунд
+RAID_MODE_DURATION = 15 * 60        # секунд рейд-режима после всплеска
+RAID_LOOKBACK = 10 * 60             # окно /raid по умолчанию, секунд
+RAID_AUTO_INTERVAL = 2              # секунд между автоматическими пачками
+RAID_AUTO_MUTE = timedelta(days=1)
+RAID_CONCURRENCY = 20
+RAID_MESSAGES_KEPT = 5000
+
+
+class RaidMonitor:
+    def __init__(self):
+        self._joins: deque = deque()                                # (ts, user_id)
+        self._messages: deque = deque(maxlen=RAID_MESSAGES_KEPT)   # (ts, user_id, message_id)
+        self._flagged: Dict[int, float] = {}
+        self._pending: Set[int] = set()
+        self.active_until = 0.0
+
+    @property
+    def active(self) -> bool:
+        return time.monotonic() < self.active_until
+
+    def on_join(self, user_id: int) -> bool:
+        """Учитывает вход. True — вход включил рейд-режим."""
+        now = time.monotonic()
+        self._joins.append((now, user_id))
+        while self._joins and self._joins[0][0] < now - RAID_LOOKBACK:
+            self._joins.popleft()
+        recent = sum(1 for ts, _ in reversed(self._joins) if ts >= now - RAID_JOIN_WINDOW)
+        if recent >= RAID_JOIN_LIMIT and not self.active:
+            self.active_until = now + RAID_MODE_DURATION
+            return True
+        return False
+
+    def on_message(self, user_id: int, message_id: int):
+        self._messages.append((time.monotonic(), user_id, message_id))
+
+    def flag(self, user_id: int):
+        """Нарушитель, пойманный автоматикой; в рейд-режиме — в очередь на мут."""
+        self._flagged[user_id] = time.monotonic()
+        if self.active:
+            self._pending.add(user_id)
+
+    def take_pending(self) -> List[int]:
+        pending, self._pending = list(self._pending), set()
+        return pending
+
+    def offenders(self, lookback: float) -> List[int]:
+        since = time.monotonic() - lookback
+        joined = {uid for ts, uid in self._joins if ts >= since}
+        posted = {uid for ts, uid, _ in self._messages if ts >= since}
+        flagged = {uid for uid, ts in self._flagged.items() if ts >= since}
+        return list((joined & posted) | flagged)
+
+    def message_ids(self, user_ids: Set[int]) -> List[int]:
+        return [mid for _, uid, mid in self._messages if uid in user_ids]
+
+    def forget(self, user_ids: Set[int]):
+        self._joins = deque(j for j in self._joins if j[1] not in user_ids)
+        self._messages = deque((m for m in self._messages if m[1] not in user_ids), maxlen=RAID_MESSAGES_KEPT)
+        for uid in user_ids:
+            self._flagged.pop(uid, None)
+            self._pending.discard(uid)
+
+
+RAID = RaidMonitor()
+
+
+async def execute_raid(chat_id: int, user_ids: List[int], action: str, duration: Optional[timedelta],
+                       reason: str, issued_by: int) -> Tuple[List[int], int]:
+    """Банит или мутит пачку пользователей. Возвращает (наказанные, ошибок)."""
+    exempt = await asyncio.gather(*(is_chat_admin_or_bot_admin(uid, chat_id) for uid in user_ids))
+    targets = [uid for uid, skip in zip(user_ids, exempt) if not skip]
+    if not targets:
+        return [], 0
+
+    until_date = datetime.now() + duration if duration else None
+    semaphore = asyncio.Semaphore(RAID_CONCURRENCY)
+
+    async def punish(user_id: int) -> bool:
+        async with semaphore:
+            try:
+                if action == "ban":
+                    await bot.ban_chat_member(chat_id, user_id, until_date=until_date)
+                else:
+                    await bot.restrict_chat_member(chat_id, user_id, MUTE_PERMISSIONS, until_date=until_date)
+                return True
+            except Exception as e:
+                logger.error(f"Ошибка рейд-наказания {user_id}: {e}")
+                return False
+
+    with outbound_priority(PRIORITY_MODERATION):
+        results = await asyncio.gather(*(punish(uid) for uid in targets))
+    done = [uid for uid, ok in zip(targets, results) if ok]
+    if done:
+        if action == "ban":
+            await MODERATION.ban_many(done, chat_id, reason, issued_by, duration)
+        else:
+            await MODERATION.mute_many(done, chat_id, reason, issued_by, duration)
+        done_set = set(done)
+        await bulk_delete_messages(chat_id, RAID.message_ids(done_set))
+        RAID.forget(done_set)
+
+    mentions = await asyncio.gather(*(get_user_mention(uid) for uid in done[:20]))
+    more = f"\n… и ещё {len(done) - 20}" if len(done) > 20 else ""
+    await send_to_mod_log(
+        f"🛡 Рейд: {'баны' if action == 'ban' else 'муты'}\n\n"
+        f"👥 <b>Наказано:</b> {len(done)} из {len(targets)}\n"
+        f"⏳ <b>Срок:</b> {await format_duration(duration)}\n"
+        f"📝 <b>Причина:</b> {reason}\n"
+        + "".join(f"\n• {m} (<code>{uid}</code>)" for uid, m in zip(done, mentions)) + more +
+        f"\n\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+        kind="raid"
+    )
+    return done, len(targets) - len(done)
+
+
+async def announce_raid():
+    await send_to_mod_log(
+        f"🚨 <b>Рейд-режим включён</b>\n\n"
+        f"Не меньше {RAID_JOIN_LIMIT} входов за {RAID_JOIN_WINDOW} с.\n"
+        f"Флудеры мутятся пачками на {await format_duration(RAID_AUTO_MUTE)}; "
+        f"вошедших и написавших можно наказать командой <code>/raid ban</code>.\n"
+        f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+        kind="raid_alert"
+    )
+
+
+async def raid_auto_loop():
+    """Раз в RAID_AUTO_INTERVAL мутит накопленных в рейд-режиме нарушителей одной пачкой."""
+    while True:
+        await asyncio.sleep(RAID_AUTO_INTERVAL)
+        pending = RAID.take_pending()
+        if not pending:
+            continue
+        try:
+            await execute_raid(CHAT_ID, pending, "mute", RAID_AUTO_MUTE, "Флуд во время рейда", 0)
+        except Exception as e:
+            logger.error(f"Ошибка автоматической рейд-модерации: {e}")
+
+
+# ============================================================
+#       ОТЛОЖЕННОЕ УДАЛЕНИЕ СЛУЖЕБНЫХ СООБЩЕНИЙ БОТА
+# ============================================================
+# «Удалить через N секунд» (подтверждения, результаты /cc, команды
+# не-админов) записывается в таблицу pending_deletions и в min-кучу в
+# памяти. Наступившие удаления группируются по чату и уходят пачками через
+# bulk_delete_messages. Очередь переживает перезапуск: при старте куча
+# заполняется из таблицы, просроченные записи удаляются сразу.
+
+DEFERRED_DELETE_WINDOW = 1.0  # секунд — удаления в пределах окна объединяются
+DEFERRED_DELETE_RETRY = 30.0  # секунд до повтора после ошибки
+
+
+class DeferredDeletions:
+    def __init__(self):
+        # (момент удаления, id записи, chat_id, message_id)
+        self._heap: List[Tuple[datetime, int, int, int]] = []
+        # id записей pending_deletions, которые осталось удалить из таблицы
+        self._done: List[int] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def schedule(self, chat_id: int, message_id: int, delay: float):
+        """Удалить сообщение через delay секунд (запись сохраняется в БД)."""
+        delete_at = datetime.now() + timedelta(seconds=delay)
+        try:
+            conn = await get_db_connection()
+            cursor = conn.cursor()
+            await cursor.execute(
+                "INSERT INTO pending_deletions (chat_id, message_id, delete_at) VALUES (%s, %s, %s) "
+                "ON CONFLICT (chat_id, message_id) DO UPDATE SET delete_at = excluded.delete_at "
+                "RETURNING id",
+                (chat_id, message_id, delete_at)
+            )
+            entry_id = (await cursor.fetchone())[0]
+            await conn.commit()
+            await conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения отложенного удаления: {e}")
+            entry_id = 0  # удалим хотя бы в рамках текущего запуска
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (delete_at, entry_id, chat_id, message_id))
+        if self._wakeup and (earliest is None or delete_at < earliest):
+            self._wakeup.set()
+
+    @property
+    def depth(self) -> int:
+        return len(self._heap)
+
+    async def load(self) -> int:
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute("SELECT delete_at, id, chat_id, message_id FROM pending_deletions")
+        heap = [tuple(row) for row in await cursor.fetchall()]
+        await conn.close()
+        heapq.heapify(heap)
+        self._heap = heap
+        return len(heap)
+
+    async def _flush(self, due: List[Tuple[datetime, int, int, int]]):
+        by_chat: Dict[int, List[Tuple[datetime, int, int, int]]] = {}
+        for entry in due:
+            by_chat.setdefault(entry[2], []).append(entry)
+        results = await asyncio.gather(*(
+            bulk_delete_messages(chat_id, [entry[3] for entry in entries])
+            for chat_id, entries in by_chat.items()
+        ), return_exceptions=True)
+        retry_at = datetime.now() + timedelta(seconds=DEFERRED_DELETE_RETRY)
+        for (chat_id, entries), result in zip(by_chat.items(), results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка отложенного удаления сообщений в чате {chat_id}: {result}")
+                for _, entry_id, _, message_id in entries:
+                    heapq.heappush(self._heap, (retry_at, entry_id, chat_id, message_id))
+            else:
+                # Запись удаляется и при неудаче отдельных сообщений: они уже
+                # удалены вручную или старше 48 часов — повторять бессмысленно
+                self._done.extend(entry[1] for entry in entries if entry[1])
+        await self._forget_done()
+
+    async def _forget_done(self):
+        if not self._done:
+            return
+        batch, self._done = self._done, []
+        try:
+            conn = await get_db_connection()
+            cursor = conn.cursor()
+            await cursor.execute("DELETE FROM pending_deletions WHERE id = ANY(%s)", (batch,))
+            await conn.commit()
+            await conn.close()
+        except Exception as e:
+            logger.error(f"Ошибка очистки pending_deletions ({len(batch)}): {e}")
+            # Повторим позже вместе со следующими записями
+            self._done.extend(batch)
+
+    async def run(self):
+        self._wakeup = asyncio.Event()
+        while True:
+            self._wakeup.clear()
+            limit = datetime.now() + timedelta(seconds=DEFERRED_DELETE_WINDOW)
+            due = []
+            while self._heap and self._heap[0][0] <= limit:
+                due.append(heapq.heappop(self._heap))
+            if due:
+                await self._flush(due)
+                continue
+            await self._forget_done()
+            timeout = None
+            if self._heap:
+                timeout = max(0.0, (self._heap[0][0] - datetime.now()).total_seconds())
+            if self._done:
+                timeout = min(timeout, DEFERRED_DELETE_RETRY) if timeout is not None else DEFERRED_DELETE_RETRY
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+
+DEFERRED_DELETIONS = DeferredDeletions()
+
 async def warn_user(chat_id: int, user_id: int, reason: str = None, message_thread_id: int = None) -> bool:
     try:
-        add_warn(user_id, chat_id, reason, chat_id)
-        warns = get_user_warns(user_id, chat_id)
+        # Число активных варнов приходит из того же запроса, что и вставка;
+        # на WARN_LIMIT варны сбрасываются там же
+        warn_count = await MODERATION.warn(user_id, chat_id, reason, chat_id)
 
         reason_str = f"\n📝 <b>Причина:</b> {reason}" if reason else ""
         user_mention = await get_user_mention(user_id)
@@ -2201,7 +3987,7 @@ async def warn_user(chat_id: int, user_id: int, reason: str = None, message_thre
             chat_id,
             f"⚠️ <b>Предупреждение выдано</b>\n\n"
             f"👤 <b>Пользователь:</b> {user_mention}\n"
-            f"🔢 <b>Всего предупреждений:</b> {len(warns)}{reason_str}\n"
+            f"🔢 <b>Всего предупреждений:</b> {warn_count}{reason_str}\n"
             f"📅 <b>Действует:</b> {WARN_EXPIRE_DAYS} дней",
             parse_mode="HTML",
             message_thread_id=message_thread_id,
@@ -2213,14 +3999,14 @@ async def warn_user(chat_id: int, user_id: int, reason: str = None, message_thre
             f"⚠️ Предупреждение\n\n"
             f"👤 <b>Пользователь:</b> {user_mention}\n"
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
-            f"🔢 <b>Предупреждений:</b> {len(warns)}"
+            f"🔢 <b>Предупреждений:</b> {warn_count}"
             + (f"\n📝 <b>Причина:</b> {reason}" if reason else "") +
-            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="warn", user_id=user_id
         )
 
-        if len(warns) >= 3:
-            await ban_user(chat_id, user_id, reason="3 предупреждения", message_thread_id=message_thread_id)
-            clear_user_warns(user_id, chat_id)
+        if warn_count >= WARN_LIMIT:
+            await ban_user(chat_id, user_id, reason=f"{WARN_LIMIT} предупреждения", message_thread_id=message_thread_id)
 
         return True
     except Exception as e:
@@ -2229,8 +4015,8 @@ async def warn_user(chat_id: int, user_id: int, reason: str = None, message_thre
 
 async def warn_admin(user_id: int, reason: str, issued_by: int) -> bool:
     try:
-        add_admin_warn(user_id, reason, issued_by)
-        warns = get_admin_warns(user_id)
+        await add_admin_warn(user_id, reason, issued_by)
+        warns = await get_admin_warns(user_id)
 
         reason_str = f"\n📝 <b>Причина:</b> {reason}" if reason else ""
         user_mention = await get_user_mention(user_id)
@@ -2254,7 +4040,8 @@ async def warn_admin(user_id: int, reason: str, issued_by: int) -> bool:
             f"🔢 <b>Предупреждений:</b> {len(warns)}\n"
             f"👮 <b>Выдал:</b> {issued_mention}"
             + (f"\n📝 <b>Причина:</b> {reason}" if reason else "") +
-            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"\n🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="admin_warn", user_id=user_id
         )
 
         if len(warns) >= 3:
@@ -2266,20 +4053,123 @@ async def warn_admin(user_id: int, reason: str, issued_by: int) -> bool:
                 f"📝 <b>Причина:</b> 3 предупреждения",
                 parse_mode="HTML",
             )
-            remove_admin(user_id)
-            clear_admin_warns(user_id)
+            await remove_admin(user_id)
+            await clear_admin_warns(user_id)
 
         return True
     except Exception as e:
         logger.error(f"Ошибка выдачи варна администратору: {e}")
         return False
 
-async def send_to_mod_log(text: str):
-    """Отправляет сообщение в журнал модерации"""
-    try:
-        await bot.send_message(MOD_LOG_CHAT_ID, text, parse_mode="HTML")
-    except Exception as e:
-        logger.error(f"Ошибка отправки в журнал модерации: {e}")
+# ============================================================
+#          ЖУРНАЛ МОДЕРАЦИИ — ПАКЕТНАЯ ЗАПИСЬ И ДАЙДЖЕСТЫ
+# ============================================================
+# send_to_mod_log не шлёт сообщение сразу: событие (тип, пользователь,
+# текст) ложится в буфер. Раз в MOD_LOG_FLUSH_INTERVAL буфер одним
+# INSERT ... unnest пишется в mod_events и уходит в MOD_LOG_CHAT_ID
+# дайджестами — события склеиваются в сообщения до MOD_LOG_MAX_CHARS
+# символов, делится дайджест только по границам событий (обрезка могла бы
+# разорвать HTML-тег). Если Telegram отклоняет дайджест, события уходят по
+# одному, а событие, которое не принимается и так, — простым текстом.
+# Отправка идёт с приоритетом PRIORITY_BULK, чтобы журнал не отнимал лимит
+# у ответов в чате.
+
+MOD_LOG_FLUSH_INTERVAL = 3   # секунд
+MOD_LOG_MAX_CHARS = 4096     # лимит длины сообщения Telegram
+MOD_LOG_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+class ModLogWriter:
+    def __init__(self):
+        # (kind, user_id, text, created_at)
+        self._pending: List[Tuple[str, Optional[int], str, datetime]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def add(self, text: str, kind: str, user_id: Optional[int] = None):
+        self._pending.append((kind, user_id, text, datetime.now()))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # События, пришедшие во время отправки дайджеста, уходят следующим циклом
+        while True:
+            await asyncio.sleep(MOD_LOG_FLUSH_INTERVAL)
+            await self.flush()
+            if not self._pending:
+                return
+
+    @staticmethod
+    def digests(texts: List[str]) -> List[List[str]]:
+        """Группирует события в дайджесты не длиннее MOD_LOG_MAX_CHARS.
+        Событие не режется: слишком длинное уходит отдельным дайджестом."""
+        groups: List[List[str]] = []
+        current: List[str] = []
+        length = 0
+        for text in texts:
+            if current and length + len(MOD_LOG_SEPARATOR) + len(text) > MOD_LOG_MAX_CHARS:
+                groups.append(current)
+                current, length = [], 0
+            length += len(text) + (len(MOD_LOG_SEPARATOR) if current else 0)
+            current.append(text)
+        if current:
+            groups.append(current)
+        return groups
+
+    async def _send(self, events: List[str]):
+        if len(events) == 1 and len(events[0]) > MOD_LOG_MAX_CHARS:
+            await self._send_plain(events[0])
+            return
+        try:
+            await bot.send_message(MOD_LOG_CHAT_ID, MOD_LOG_SEPARATOR.join(events), parse_mode="HTML")
+            return
+        except TelegramBadRequest as e:
+            if len(events) == 1:
+                logger.warning(f"Событие журнала модерации отклонено ({e}), отправляю простым текстом")
+                await self._send_plain(events[0])
+                return
+            logger.warning(f"Дайджест журнала модерации отклонён ({e}), отправляю по событию")
+        for event in events:
+            await self._send([event])
+
+    @staticmethod
+    async def _send_plain(text: str):
+        plain = html.unescape(re.sub(r"<[^>]*>", "", text))
+        for start in range(0, len(plain), MOD_LOG_MAX_CHARS):
+            await bot.send_message(MOD_LOG_CHAT_ID, plain[start:start + MOD_LOG_MAX_CHARS], parse_mode=None)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            kinds, user_ids, texts, created = (list(column) for column in zip(*batch))
+            try:
+                conn = await get_db_connection()
+                cursor = conn.cursor()
+                await cursor.execute(
+                    "INSERT INTO mod_events (kind, user_id, text, created_at) "
+                    "SELECT * FROM unnest(%s::text[], %s::bigint[], %s::text[], %s::timestamp[])",
+                    (kinds, user_ids, texts, created)
+                )
+                await conn.commit()
+                await conn.close()
+            except Exception as e:
+                logger.error(f"Ошибка записи событий модерации ({len(batch)}): {e}")
+            with outbound_priority(PRIORITY_BULK):
+                for events in self.digests(texts):
+                    try:
+                        await self._send(events)
+                    except Exception as e:
+                        logger.error(f"Ошибка отправки в журнал модерации: {e}")
+
+
+MOD_LOG = ModLogWriter()
+
+
+async def send_to_mod_log(text: str, kind: str = "info", user_id: int = None):
+    """Ставит событие в журнал модерации (запись и отправка — пакетами, см. MOD_LOG)"""
+    MOD_LOG.add(text, kind, user_id)
 
 
 # ============================================================
@@ -2299,14 +4189,14 @@ async def start_appeal_flow(message: Message, state: FSMContext, punishment_type
             "❌ <b>Это обжалование предназначено не вам.</b>\n\n"
             "Кнопка «Обжаловать» работает только для того пользователя, которому было выдано наказание.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(user.id)
+            reply_markup=await get_main_keyboard(user.id)
         )
         return
 
-    if is_user_blocked(user.id):
+    if await is_user_blocked(user.id):
         await message.answer(
             "🚫 Вы заблокированы в боте и не можете подавать жалобы.",
-            reply_markup=get_main_keyboard(user.id)
+            reply_markup=await get_main_keyboard(user.id)
         )
         return
 
@@ -2316,7 +4206,7 @@ async def start_appeal_flow(message: Message, state: FSMContext, punishment_type
             "Для подачи обжалования необходим username.\n"
             "Пожалуйста, установите его в настройках Telegram и попробуйте снова.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(user.id)
+            reply_markup=await get_main_keyboard(user.id)
         )
         return
 
@@ -2337,7 +4227,7 @@ async def start_appeal_flow(message: Message, state: FSMContext, punishment_type
         f"Вы начали процесс обжалования наказания.\n\n"
         f"👮 Укажите юзернейм администратора, который выдал вам наказание (например, <code>@admin</code>):",
         parse_mode="HTML",
-        reply_markup=get_main_keyboard(user.id)
+        reply_markup=await get_main_keyboard(user.id)
     )
     await state.set_state(AdminComplaintStates.waiting_for_admin_username)
 
@@ -2567,13 +4457,13 @@ TERMS_OF_SERVICE_TEXT = (
     "✔️ Вы обязуетесь соблюдать все изложенные требования</i>"
 )
 
-def get_main_keyboard(user_id: int = None):
+async def get_main_keyboard(user_id: int = None):
     """Стандартная Reply-клавиатура для ЛС с ботом.
     Кнопка «Просмотреть жалобы» и «Админ-панель» показываются только администраторам.
     """
     builder = ReplyKeyboardBuilder()
     # Кнопки управления — только для владельцев и администраторов
-    if user_id is not None and (user_id in ADMIN_IDS or is_admin(user_id)):
+    if user_id is not None and (user_id in ADMIN_IDS or await is_admin(user_id)):
         builder.row(KeyboardButton(text="🛠️ Админ-панель"))
         builder.row(KeyboardButton(text="📋 Просмотреть жалобы"))
         builder.row(KeyboardButton(text="📣 Рассылка в боте"))
@@ -2606,23 +4496,153 @@ async def cmd_maintenance(message: Message):
         await message.answer("❌ У вас нет прав для использования этой команды.")
         return
 
-    MAINTENANCE_MODE = not MAINTENANCE_MODE
-
-    if MAINTENANCE_MODE:
-        await message.answer(
-            "🔧 <b>Режим технических работ ВКЛЮЧЁН</b>\n\n"
-            "Все пользователи теперь получают сообщение о тех.работах вместо обычных ответов бота.\n\n"
-            "Чтобы выключить — отправьте /tw ещё раз.",
-            parse_mode="HTML"
-        )
-        logger.info(f"Режим тех.работ включён владельцем {message.from_user.id}")
-    else:
-        await message.answer(
-            "✅ <b>Режим технических работ ВЫКЛЮЧЕН</b>\n\n"
-            "Бот работает в штатном режиме.",
-            parse_mode="HTML"
+    MAINTENANCE_MODE = not MAINTENANCE_MODE
+
+    if MAINTENANCE_MODE:
+        await message.answer(
+            "🔧 <b>Режим технических работ ВКЛЮЧЁН</b>\n\n"
+            "Все пользователи теперь получают сообщение о тех.работах вместо обычных ответов бота.\n\n"
+            "Чтобы выключить — отправьте /tw ещё раз.",
+            parse_mode="HTML"
+        )
+        logger.info(f"Режим тех.работ включён владельцем {message.from_user.id}")
+    else:
+        await message.answer(
+            "✅ <b>Режим технических работ ВЫКЛЮЧЕН</b>\n\n"
+            "Бот работает в штатном режиме.",
+            parse_mode="HTML"
+        )
+        logger.info(f"Режим тех.работ выключен владельцем {message.from_user.id}")
+
+
+@dp.message(Command("trigger_add"), F.chat.type == ChatType.PRIVATE)
+async def cmd_trigger_add(message: Message, command: CommandObject):
+    """/trigger_add слово [вариант1 вариант2 ...] — добавляет триггерное слово без перезапуска."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    parts = (command.args or "").lower().split()
+    if not parts:
+        await message.answer(
+            "❌ Использование: /trigger_add слово [вариант1 вариант2 ...]\n\n"
+            "Пример: <code>/trigger_add кинг king к1нг</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    word, variants = parts[0], parts[1:]
+    await add_trigger_word(word, variants, message.from_user.id)
+    await message.answer(
+        f"✅ Триггерное слово <code>{html.escape(word)}</code> добавлено"
+        + (f" (варианты: {html.escape(', '.join(variants))})" if variants else "")
+        + f"\n🔢 Версия словаря: {TRIGGER_MATCHER.version}",
+        parse_mode="HTML"
+    )
+    logger.info(f"Владелец {message.from_user.id} добавил триггерное слово {word}: {variants}")
+
+
+@dp.message(Command("trigger_del"), F.chat.type == ChatType.PRIVATE)
+async def cmd_trigger_del(message: Message, command: CommandObject):
+    """/trigger_del слово — удаляет триггерное слово со всеми вариантами."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    word = (command.args or "").strip().lower()
+    if not word:
+        await message.answer("❌ Использование: /trigger_del слово")
+        return
+
+    if word in TRIGGER_WORDS:
+        await message.answer(
+            f"❌ Слово <code>{html.escape(word)}</code> задано в коде бота (TRIGGER_WORDS) "
+            f"и вернётся после перезапуска — удалить его можно только правкой кода.",
+            parse_mode="HTML"
+        )
+        return
+
+    if await remove_trigger_word(word):
+        await message.answer(f"✅ Триггерное слово <code>{html.escape(word)}</code> удалено.", parse_mode="HTML")
+        logger.info(f"Владелец {message.from_user.id} удалил триггерное слово {word}")
+    else:
+        await message.answer(f"❌ Слово <code>{html.escape(word)}</code> не найдено.", parse_mode="HTML")
+
+
+@dp.message(Command("triggers"), F.chat.type == ChatType.PRIVATE)
+async def cmd_triggers(message: Message):
+    """/triggers — список текущих триггерных слов."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    lines = [
+        f"• <code>{html.escape(word)}</code>: {html.escape(', '.join(variants))}"
+        for word, variants in TRIGGER_MATCHER.words.items()
+    ]
+    await message.answer(
+        f"🤬 <b>Триггерные слова</b> (версия {TRIGGER_MATCHER.version})\n\n" + "\n".join(lines),
+        parse_mode="HTML"
+    )
+
+
+@dp.message(Command("dispatch_stats"), F.chat.type == ChatType.PRIVATE)
+async def cmd_dispatch_stats(message: Message):
+    """/dispatch_stats — глубина очередей обработки и отложенных удалений."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    updates = UPDATE_SERIALIZER.stats()
+    text = (
+        f"📊 <b>Очереди обработки</b>\n\n"
+        f"🔑 Ключей (чат, пользователь) в работе: <b>{updates['active_keys']}</b>\n"
+        f"⏳ Апдейтов ждут своей очереди: <b>{updates['waiting']}</b>\n"
+        f"📏 Самая длинная очередь: <b>{updates['max_depth']}</b> "
+        f"(максимум с запуска: {updates['max_depth_seen']})\n"
+    )
+    if UPDATE_POOL is not None:
+        text += f"📥 Очередь webhook: <b>{UPDATE_POOL.depth}</b>\n"
+    text += (
+        f"🗑 Отложенных удалений: <b>{DEFERRED_DELETIONS.depth}</b>\n"
+        f"\n📤 Ожидают отправки в Telegram: <b>{OUTBOX.depth}</b>"
+    )
+    await message.answer(text, parse_mode="HTML")
+
+
+@dp.message(Command("ads_rescore"), F.chat.type == ChatType.PRIVATE)
+async def cmd_ads_rescore(message: Message, command: CommandObject):
+    """/ads_rescore [дней] — как текущий классификатор оценил бы историю user_ads."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("❌ У вас нет прав для использования этой команды.")
+        return
+
+    days = int(command.args) if command.args and command.args.strip().isdigit() else 30
+    started = time.monotonic()
+    try:
+        result = await rescore_user_ads(days)
+    except Exception as e:
+        logger.error(f"Ошибка пересчёта объявлений: {e}")
+        await message.answer("❌ Не удалось пересчитать объявления.")
+        return
+
+    total = result["total"]
+    share = result["flagged"] / total * 100 if total else 0
+    top = sorted(result["features"].items(), key=lambda item: item[1], reverse=True)[:8]
+    text = (
+        f"📊 <b>Пересчёт объявлений за {days} дн.</b>\n\n"
+        f"Всего: <b>{total}</b>, распознано как объявления: <b>{result['flagged']}</b> ({share:.1f}%)\n"
+        f"Засчитывается в лимиты (оценка ≥ {AD_ENFORCE_SCORE}): <b>{result['enforced']}</b>, "
+        f"режим: <code>{AD_ENFORCE_MODE}</code>\n"
+        f"Порог: {AD_CLASSIFIER.threshold}, время: {time.monotonic() - started:.1f} с\n\n"
+        f"<b>Частые признаки:</b>\n" + "\n".join(f"• <code>{name}</code>: {count}" for name, count in top)
+    )
+    if result["low_scored"]:
+        text += "\n\n<b>Примеры ниже порога:</b>\n" + "\n".join(
+            f"• {score:.1f}: " + sample[:80].replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            for score, sample in result["low_scored"]
         )
-        logger.info(f"Режим тех.работ выключен владельцем {message.from_user.id}")
+    await message.answer(text, parse_mode="HTML")
 
 
 # ============================================================
@@ -2715,7 +4735,7 @@ async def safe_deal_create_redirect(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
     # Если пользователь уже принимал соглашение — сразу к выбору роли
-    if has_accepted_tos(callback.from_user.id):
+    if await has_accepted_tos(callback.from_user.id):
         await state.set_state(SafeDealStates.DEAL_ROLE)
         keyboard = InlineKeyboardBuilder()
         keyboard.row(InlineKeyboardButton(text="👤 Я покупатель", callback_data="role_buyer"))
@@ -2752,7 +4772,7 @@ async def safe_deal_create_confirmed(callback: CallbackQuery, state: FSMContext)
     await callback.answer()
 
     # Сохраняем факт принятия соглашения (один раз навсегда)
-    save_tos_acceptance(callback.from_user.id)
+    await save_tos_acceptance(callback.from_user.id)
 
     await state.set_state(SafeDealStates.DEAL_ROLE)
 
@@ -2774,17 +4794,17 @@ async def safe_deal_my_deals_redirect(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     
     cursor = conn.cursor()
-    cursor.execute('''
+    await cursor.execute('''
         SELECT * FROM safe_deals 
         WHERE buyer_id = %s OR seller_id = %s 
         ORDER BY created_at DESC
     ''', (user_id, user_id))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await cursor.fetchall()
+    await conn.close()
     
     if not rows:
         keyboard = InlineKeyboardBuilder()
@@ -2818,13 +4838,13 @@ async def safe_deal_balance_redirect(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     
     cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM safe_deal_balances WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT balance FROM safe_deal_balances WHERE user_id = %s", (user_id,))
+    row = await cursor.fetchone()
+    await conn.close()
     
     balance = row[0] if row else 0.0
     
@@ -2846,17 +4866,17 @@ async def safe_deal_reviews_redirect(callback: CallbackQuery):
     await callback.answer()
     user_id = callback.from_user.id
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     
     cursor = conn.cursor()
-    cursor.execute('''
+    await cursor.execute('''
         SELECT * FROM safe_deal_reviews 
         WHERE reviewed_user_id = %s 
         ORDER BY created_at DESC
     ''', (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await cursor.fetchall()
+    await conn.close()
     
     if not rows:
         keyboard = InlineKeyboardBuilder()
@@ -2954,6 +4974,9 @@ async def process_role_seller(callback: CallbackQuery, state: FSMContext):
 async def process_safe_amount(message: Message, state: FSMContext):
     try:
         amount = float(message.text.strip())
+        if not math.isfinite(amount):
+            await message.answer("❌ Введите число:")
+            return
         if amount <= 0:
             await message.answer("❌ Сумма должна быть больше 0:")
             return
@@ -3004,7 +5027,7 @@ async def process_safe_partner(message: Message, state: FSMContext):
     actual_username = None
     
     # ШАГ 1: ищем в реестре пользователей, запустивших бота
-    db_user = find_bot_user_by_username(partner_username)
+    db_user = await find_bot_user_by_username(partner_username)
     if db_user:
         partner_id = db_user["user_id"]
         actual_username = db_user["username"] or partner_username
@@ -3109,7 +5132,7 @@ async def process_safe_group_link(message: Message, state: FSMContext):
     deal_id = generate_deal_id()
     
     # Проверяем уникальность номера
-    while get_safe_deal(deal_id):
+    while await get_safe_deal(deal_id):
         deal_id = generate_deal_id()
     
     deal = {
@@ -3126,10 +5149,10 @@ async def process_safe_group_link(message: Message, state: FSMContext):
         "group_link": link
     }
     
-    if save_safe_deal(deal):
+    if await save_safe_deal(deal):
         creator_role = data.get("creator_role")
         # Отмечаем создателя как подтвердившего
-        set_user_safe_confirmed(deal_id, creator_role)
+        await set_user_safe_confirmed(deal_id, creator_role)
         
         # Определяем партнёра
         partner_id = data.get("seller_id") if creator_role == "buyer" else data.get("buyer_id")
@@ -3184,7 +5207,7 @@ async def sd_view_invite(callback: CallbackQuery):
     """Просмотр деталей приглашения к сделке"""
     await callback.answer()
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3218,7 +5241,7 @@ async def sd_accept_deal(callback: CallbackQuery):
     """Принятие сделки второй стороной"""
     await callback.answer()
     deal_id = callback.data.split("_")[2]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3230,12 +5253,12 @@ async def sd_accept_deal(callback: CallbackQuery):
         return
     
     # Проверяем, не подтверждена ли уже сделка обеими сторонами
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("SELECT buyer_confirmed, seller_confirmed FROM safe_deals WHERE id = %s", (deal_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT buyer_confirmed, seller_confirmed FROM safe_deals WHERE id = %s", (deal_id,))
+    row = await cursor.fetchone()
+    await conn.close()
     both_confirmed = row and row[0] and row[1]
     
     if both_confirmed:
@@ -3243,7 +5266,7 @@ async def sd_accept_deal(callback: CallbackQuery):
         return
     
     user_role = "buyer" if user_id == deal["buyer_id"] else "seller"
-    set_user_safe_confirmed(deal_id, user_role)
+    await set_user_safe_confirmed(deal_id, user_role)
     
     creator_id = deal["creator_id"]
     user_username = callback.from_user.username or "пользователь"
@@ -3283,7 +5306,7 @@ async def sd_reject_deal(callback: CallbackQuery):
     """Отклонение сделки второй стороной"""
     await callback.answer()
     deal_id = callback.data.split("_")[2]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3294,7 +5317,7 @@ async def sd_reject_deal(callback: CallbackQuery):
         await callback.answer("❌ Вы не являетесь участником этой сделки", show_alert=True)
         return
     
-    update_safe_deal_status(deal_id, "rejected")
+    await update_safe_deal_status(deal_id, "rejected")
     user_username = callback.from_user.username or "пользователь"
     
     try:
@@ -3339,7 +5362,7 @@ async def sd_deal_details(callback: CallbackQuery):
 
 async def _show_safe_deal_details(callback: CallbackQuery, deal_id: str):
     """Общая функция показа деталей сделки"""
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
         return
@@ -3374,12 +5397,12 @@ async def _show_safe_deal_details(callback: CallbackQuery, deal_id: str):
     keyboard = InlineKeyboardBuilder()
     
     # Проверяем подтверждения
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("SELECT buyer_confirmed, seller_confirmed FROM safe_deals WHERE id = %s", (deal_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT buyer_confirmed, seller_confirmed FROM safe_deals WHERE id = %s", (deal_id,))
+    row = await cursor.fetchone()
+    await conn.close()
     both_confirmed = row and row[0] and row[1]
     
     status = deal.get("status", "")
@@ -3419,7 +5442,7 @@ async def sd_initiate_payment(callback: CallbackQuery):
     """Инициация оплаты сделки"""
     await callback.answer()
     deal_id = callback.data.split("_")[2]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3460,12 +5483,12 @@ async def sd_initiate_payment(callback: CallbackQuery):
         payment_url = f"https://yoomoney.ru/quickpay/confirm.xml?{urlencode(payment_params)}"
         
         # Сохраняем URL платежа
-        conn = get_db_connection()
+        conn = await get_db_connection()
 
         cursor = conn.cursor()
-        cursor.execute("UPDATE safe_deals SET payment_url = %s WHERE id = %s", (payment_url, deal_id))
-        conn.commit()
-        conn.close()
+        await cursor.execute("UPDATE safe_deals SET payment_url = %s WHERE id = %s", (payment_url, deal_id))
+        await conn.commit()
+        await conn.close()
         
         keyboard = InlineKeyboardBuilder()
         keyboard.row(InlineKeyboardButton(text="💳 Перейти к оплате", url=payment_url))
@@ -3494,7 +5517,7 @@ async def sd_check_payment(callback: CallbackQuery):
     """Проверка оплаты через ЮMoney API"""
     await callback.answer()
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3560,15 +5583,15 @@ async def sd_check_payment(callback: CallbackQuery):
     
     if payment_confirmed:
         # Подтверждаем оплату в БД
-        conn = get_db_connection()
+        conn = await get_db_connection()
 
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "UPDATE safe_deals SET payment_confirmed = TRUE, status = 'payment_received' WHERE id = %s",
             (deal_id,)
         )
-        conn.commit()
-        conn.close()
+        await conn.commit()
+        await conn.close()
         
         # Уведомляем обоих участников в ЛС
         for participant_id in [deal["buyer_id"], deal["seller_id"]]:
@@ -3630,7 +5653,7 @@ async def sd_work_done(callback: CallbackQuery):
     """Продавец отмечает работу как выполненную"""
     await callback.answer()
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3666,7 +5689,7 @@ async def sd_confirm_receipt(callback: CallbackQuery):
     """Покупатель подтверждает получение работы"""
     await callback.answer()
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3678,18 +5701,18 @@ async def sd_confirm_receipt(callback: CallbackQuery):
     
     # Зачисляем средства продавцу
     seller_amount = deal.get("amount", 0)
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
     # Обновляем/создаём баланс продавца
-    cursor.execute("""
+    await cursor.execute("""
         INSERT INTO safe_deal_balances (user_id, balance)
         VALUES (%s, %s)
         ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
     """, (deal["seller_id"], seller_amount))
-    cursor.execute("UPDATE safe_deals SET status = 'completed' WHERE id = %s", (deal_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE safe_deals SET status = 'completed' WHERE id = %s", (deal_id,))
+    await conn.commit()
+    await conn.close()
     
     # Уведомляем продавца
     try:
@@ -3726,7 +5749,7 @@ async def sd_review_seller(callback: CallbackQuery, state: FSMContext):
     """Начало процесса оставления отзыва продавцу"""
     await callback.answer()
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3802,16 +5825,16 @@ async def _sd_save_review(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     
     cursor = conn.cursor()
-    cursor.execute("""
+    await cursor.execute("""
         INSERT INTO safe_deal_reviews (deal_id, reviewer_id, reviewed_user_id, review_text, rating, created_at)
         VALUES (%s, %s, %s, %s, %s, %s)
     """, (deal_id, message.from_user.id, reviewed_user_id, review_text, rating, datetime.now()))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     
     keyboard = InlineKeyboardBuilder()
     keyboard.row(InlineKeyboardButton(text="📋 Мои сделки", callback_data="safe_deal_my_deals"))
@@ -3835,7 +5858,7 @@ async def sd_open_dispute(callback: CallbackQuery):
     """Открытие спора по сделке"""
     await callback.answer()
     deal_id = callback.data.split("_")[2]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
@@ -3846,7 +5869,7 @@ async def sd_open_dispute(callback: CallbackQuery):
         await callback.answer("❌ Вы не являетесь участником этой сделки", show_alert=True)
         return
     
-    update_safe_deal_status(deal_id, "dispute")
+    await update_safe_deal_status(deal_id, "dispute")
     
     group_link = deal.get("group_link", "")
     user_username = callback.from_user.username or "No username"
@@ -3918,7 +5941,7 @@ async def sd_admin_refund(callback: CallbackQuery):
         return
     
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
         return
@@ -3931,7 +5954,7 @@ async def sd_admin_refund(callback: CallbackQuery):
         )
         return
     
-    update_safe_deal_status(deal_id, "cancelled")
+    await update_safe_deal_status(deal_id, "cancelled")
     
     for participant_id in [deal["buyer_id"], deal["seller_id"]]:
         try:
@@ -3963,7 +5986,7 @@ async def sd_admin_pay(callback: CallbackQuery):
         return
     
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
         return
@@ -3971,17 +5994,17 @@ async def sd_admin_pay(callback: CallbackQuery):
     seller_amount = deal.get("amount", 0)
     
     # Зачисляем продавцу
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("""
+    await cursor.execute("""
         INSERT INTO safe_deal_balances (user_id, balance)
         VALUES (%s, %s)
         ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance
     """, (deal["seller_id"], seller_amount))
-    cursor.execute("UPDATE safe_deals SET status = 'completed' WHERE id = %s", (deal_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE safe_deals SET status = 'completed' WHERE id = %s", (deal_id,))
+    await conn.commit()
+    await conn.close()
     
     for participant_id in [deal["buyer_id"], deal["seller_id"]]:
         try:
@@ -4013,12 +6036,12 @@ async def sd_admin_cancel(callback: CallbackQuery):
         return
 
     deal_id = callback.data.split("_")[3]
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
     if not deal:
         await callback.answer("❌ Сделка не найдена", show_alert=True)
         return
 
-    update_safe_deal_status(deal_id, "cancelled")
+    await update_safe_deal_status(deal_id, "cancelled")
 
     for participant_id in [deal["buyer_id"], deal["seller_id"]]:
         try:
@@ -4058,7 +6081,7 @@ async def cmd_link_deal(message: Message, command: CommandObject):
         return
 
     deal_id = command.args.strip()
-    deal = get_safe_deal(deal_id)
+    deal = await get_safe_deal(deal_id)
 
     if not deal:
         await message.answer("❌ Сделка не найдена. Проверьте номер.")
@@ -4070,26 +6093,26 @@ async def cmd_link_deal(message: Message, command: CommandObject):
         return
 
     # Проверяем, не привязан ли чат уже к другой сделке
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM safe_deals WHERE group_chat_id = %s AND id != %s",
+    await cursor.execute("SELECT id FROM safe_deals WHERE group_chat_id = %s AND id != %s",
                    (message.chat.id, deal_id))
-    existing = cursor.fetchone()
-    conn.close()
+    existing = await cursor.fetchone()
+    await conn.close()
 
     if existing:
         await message.answer(f"❌ Этот чат уже привязан к сделке #{existing[0]}.")
         return
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
 
     cursor = conn.cursor()
-    cursor.execute("UPDATE safe_deals SET group_chat_id = %s WHERE id = %s",
+    await cursor.execute("UPDATE safe_deals SET group_chat_id = %s WHERE id = %s",
                    (message.chat.id, deal_id))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     await message.answer(
         f"✅ <b>Чат успешно привязан к сделке #{deal_id}!</b>\n\n"
@@ -4139,13 +6162,13 @@ async def sd_withdraw_request(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
 
     cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM safe_deal_balances WHERE user_id = %s", (user_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT balance FROM safe_deal_balances WHERE user_id = %s", (user_id,))
+    row = await cursor.fetchone()
+    await conn.close()
     balance = row[0] if row else 0.0
 
     if balance < 50:
@@ -4205,20 +6228,20 @@ async def sd_process_bank(callback: CallbackQuery, state: FSMContext):
     username = callback.from_user.username or "No username"
 
     # Списываем с баланса и создаём заявку
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE safe_deal_balances SET balance = balance - %s WHERE user_id = %s",
         (amount, user_id)
     )
-    cursor.execute("""
+    await cursor.execute("""
         INSERT INTO safe_deal_withdrawals (user_id, amount, status, created_at, wallet)
         VALUES (%s, %s, 'pending', %s, %s) RETURNING id
     """, (user_id, amount, datetime.now(), f"{phone} | {bank_name}"))
-    withdrawal_id = cursor.fetchone()["id"]
-    conn.commit()
-    conn.close()
+    withdrawal_id = (await cursor.fetchone())["id"]
+    await conn.commit()
+    await conn.close()
 
     # Уведомляем всех администраторов с деталями для ручного перевода
     admin_text = (
@@ -4275,16 +6298,16 @@ async def wd_mark_done(callback: CallbackQuery):
     parts = callback.data.split(":")
     withdrawal_id, user_id, amount = int(parts[1]), int(parts[2]), float(parts[3])
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
 
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE safe_deal_withdrawals SET status = 'completed' WHERE id = %s",
         (withdrawal_id,)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     await callback.message.edit_text(
         callback.message.text + f"\n\n✅ <b>Выполнено администратором @{callback.from_user.username or callback.from_user.id}</b>",
@@ -4312,19 +6335,19 @@ async def wd_mark_rejected(callback: CallbackQuery):
     withdrawal_id, user_id, amount = int(parts[1]), int(parts[2]), float(parts[3])
 
     # Возвращаем деньги на баланс
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE safe_deal_withdrawals SET status = 'rejected' WHERE id = %s",
         (withdrawal_id,)
     )
-    cursor.execute(
+    await cursor.execute(
         "UPDATE safe_deal_balances SET balance = balance + %s WHERE user_id = %s",
         (amount, user_id)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     await callback.message.edit_text(
         callback.message.text + f"\n\n❌ <b>Отклонено администратором @{callback.from_user.username or callback.from_user.id}. Средства возвращены.</b>",
@@ -4362,16 +6385,16 @@ async def _sd_save_service_review(message: Message, state: FSMContext):
     state_data = await state.get_data()
     rating = state_data.get("service_rating", 5)
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     
     cursor = conn.cursor()
-    cursor.execute("""
+    await cursor.execute("""
         INSERT INTO safe_deal_service_reviews (reviewer_id, review_text, rating, created_at)
         VALUES (%s, %s, %s, %s)
     """, (message.from_user.id, review_text, rating, datetime.now()))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     
     keyboard = InlineKeyboardBuilder()
     keyboard.row(InlineKeyboardButton(text="🔙 Главное меню", callback_data="back_to_safe_deal_menu"))
@@ -4502,15 +6525,15 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
         )
         return
 
-    if is_user_blocked(message.from_user.id):
-        conn = get_db_connection()
+    if await is_user_blocked(message.from_user.id):
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(
+        await cursor.execute(
             "SELECT reason, blocked_at FROM bot_blocks WHERE user_id = %s AND is_active = TRUE ORDER BY blocked_at DESC LIMIT 1",
             (message.from_user.id,)
         )
-        block_info = cursor.fetchone()
-        conn.close()
+        block_info = await cursor.fetchone()
+        await conn.close()
         reason = block_info[0] if block_info else "Нарушение правил"
         blocked_at = block_info[1] if block_info else "неизвестно"
         await message.answer(
@@ -4543,7 +6566,7 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
             )
             return
 
-        register_bot_user(user)
+        await register_bot_user(user)
 
         # Подтверждаем токен на сервере сайта
         import httpx
@@ -4580,7 +6603,7 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
             )
             return
 
-        register_bot_user(user)
+        await register_bot_user(user)
 
         import httpx
         try:
@@ -4603,8 +6626,8 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
         return
 
     if command.args == "admin_quest":
-        register_bot_user(message.from_user)
-        quest_state = get_admin_quest_state()
+        await register_bot_user(message.from_user)
+        quest_state = await get_admin_quest_state()
         if not quest_state["is_open"]:
             await message.answer(
                 "😔 Набор администраторов сейчас закрыт. Следите за объявлениями в группе.",
@@ -4636,7 +6659,7 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
             pass
 
     user_id = message.from_user.id
-    register_bot_user(message.from_user)
+    await register_bot_user(message.from_user)
 
     if command.args and command.args.startswith("appeal_"):
         await message.answer(
@@ -4662,7 +6685,7 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
     await message.answer(
         welcome_text,
         parse_mode="HTML",
-        reply_markup=get_main_keyboard(message.from_user.id)
+        reply_markup=await get_main_keyboard(message.from_user.id)
     )
 
 # ============================================================
@@ -4671,8 +6694,8 @@ async def cmd_start_with_reviews(message: Message, command: CommandObject, state
 
 @dp.message(StateFilter(None), F.chat.type == ChatType.PRIVATE, F.text == "📢 Оставить жалобу на админа")
 async def btn_complain_admin(message: Message, state: FSMContext):
-    if is_user_blocked(message.from_user.id):
-        await message.answer("🚫 Вы заблокированы в боте.", reply_markup=get_main_keyboard(message.from_user.id))
+    if await is_user_blocked(message.from_user.id):
+        await message.answer("🚫 Вы заблокированы в боте.", reply_markup=await get_main_keyboard(message.from_user.id))
         return
 
     # Автоматически определяем username пользователя
@@ -4694,7 +6717,7 @@ async def btn_complain_admin(message: Message, state: FSMContext):
             "🔗 <a href='https://okbob.app/blog/telegram-set-username?ysclid=mm0dtsva4d256888466'>Как установить username</a>",
             parse_mode="HTML",
             disable_web_page_preview=True,
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
 
 @dp.message(StateFilter(None), F.chat.type == ChatType.PRIVATE, F.text == "🛠️ Админ-панель")
@@ -4713,9 +6736,9 @@ async def btn_admin_panel(message: Message):
 @dp.message(StateFilter(None), F.chat.type == ChatType.PRIVATE, F.text == "📋 Просмотреть жалобы")
 async def btn_view_complaints(message: Message):
     if not await is_bot_admin(message.from_user.id):
-        await message.answer("❌ У вас нет прав для просмотра жалоб.", reply_markup=get_main_keyboard(message.from_user.id))
+        await message.answer("❌ У вас нет прав для просмотра жалоб.", reply_markup=await get_main_keyboard(message.from_user.id))
         return
-    complaints = get_active_complaints()
+    complaints = await get_active_complaints()
     complaints_count = len(complaints)
     text = f"📋 <b>Активные жалобы на администраторов</b>\n\n📊 <b>Всего:</b> {complaints_count}\n\n"
     if complaints_count > 0:
@@ -4726,7 +6749,268 @@ async def btn_view_complaints(message: Message):
             text += f"\n... и ещё {complaints_count - 10}"
     else:
         text += "🎉 Активных жалоб нет!"
-    await message.answer(text, parse_mode="HTML", reply_markup=get_complaints_keyboard())
+    await message.answer(text, parse_mode="HTML", reply_markup=await get_complaints_keyboard())
+
+
+# ============================================================
+#   ДВИЖОК РАССЫЛОК (broadcast_jobs / broadcast_deliveries)
+# ============================================================
+# Рассылка — это задание в БД со списком получателей. Фоновый воркер
+# выбирает получателей пачками, отправляет их параллельно (темп задаёт
+# OUTBOX, приоритет — массовый) и одним запросом пишет статусы пачки.
+# Незавершённые задания продолжаются после перезапуска бота; при падении
+# посреди пачки её получатели могут получить сообщение повторно.
+# Сбой БД в воркере не останавливает рассылку молча: шаг повторяется с
+# растущей паузой (статусы отправленной пачки держатся в памяти и не
+# рассылаются заново), а после BROADCAST_MAX_RETRIES неудач задание
+# помечается failed и автор видит это в сообщении с прогрессом.
+
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_PROGRESS_INTERVAL = 5  # секунд между обновлениями прогресса
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_RETRY_DELAY = 2.0      # секунд, удваивается с каждой попыткой
+
+
+class BroadcastEngine:
+    def __init__(self):
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def create_job(self, created_by: int, text: str) -> Tuple[int, int]:
+        """Создаёт задание на всех незаблокированных пользователей. Возвращает (job_id, total)."""
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute(
+            "INSERT INTO broadcast_jobs (created_by, text) VALUES (%s, %s) RETURNING id",
+            (created_by, text)
+        )
+        job_id = (await cursor.fetchone())[0]
+        await cursor.execute(
+            "INSERT INTO broadcast_deliveries (job_id, user_id) "
+            "SELECT %s, user_id FROM bot_users WHERE NOT COALESCE(is_blocked, FALSE)",
+            (job_id,)
+        )
+        total = cursor.rowcount
+        await cursor.execute("UPDATE broadcast_jobs SET total = %s WHERE id = %s", (total, job_id))
+        await conn.commit()
+        await conn.close()
+        return job_id, total
+
+    async def attach_progress(self, job_id: int, chat_id: int, message_id: int):
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE broadcast_jobs SET progress_chat_id = %s, progress_message_id = %s WHERE id = %s",
+            (chat_id, message_id, job_id)
+        )
+        await conn.commit()
+        await conn.close()
+
+    def start(self, job_id: int):
+        task = self._tasks.get(job_id)
+        if task is None or task.done():
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    async def resume_all(self) -> int:
+        """Продолжает задания, прерванные перезапуском."""
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute("SELECT id FROM broadcast_jobs WHERE status = 'running'")
+        job_ids = [row[0] for row in await cursor.fetchall()]
+        await conn.close()
+        for job_id in job_ids:
+            self.start(job_id)
+        return len(job_ids)
+
+    async def cancel(self, job_id: int) -> bool:
+        conn = await get_db_connection()
+        cursor = conn.cursor()
+        await cursor.execute(
+            "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = %s "
+            "WHERE id = %s AND status = 'running'",
+            (datetime.now(), job_id)
+        )
+        cancelled = cursor.rowcount > 0
+        await conn.commit()
+        await conn.close()
+        # Воркер сам заметит смену статуса перед следующей пачкой
+        return cancelled
+
+    async def _load_job(self, job_id: int):
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute("SELECT * FROM broadcast_jobs WHERE id = %s", (job_id,))
+            return await cursor.fetchone()
+        finally:
+            await conn.close()
+
+    async def _next_batch(self, job_id: int) -> List[int]:
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(
+                "SELECT user_id FROM broadcast_deliveries WHERE job_id = %s AND status = 'pending' "
+                "ORDER BY user_id LIMIT %s",
+                (job_id, BROADCAST_BATCH_SIZE)
+            )
+            return [row[0] for row in await cursor.fetchall()]
+        finally:
+            await conn.close()
+
+    async def _finish(self, job_id: int, status: str):
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.execute(
+                "UPDATE broadcast_jobs SET status = %s, finished_at = %s "
+                "WHERE id = %s AND status = 'running'",
+                (status, datetime.now(), job_id)
+            )
+            await conn.commit()
+        finally:
+            await conn.close()
+
+    async def _retrying(self, job_id: int, step, *args):
+        """Выполняет шаг воркера, при ошибке повторяет с растущей паузой.
+        После BROADCAST_MAX_RETRIES неудач исключение уходит в _run."""
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            try:
+                return await step(*args)
+            except Exception as e:
+                if attempt == BROADCAST_MAX_RETRIES:
+                    raise
+                delay = BROADCAST_RETRY_DELAY * 2 ** attempt
+                logger.warning(f"Рассылка #{job_id}: {step.__name__} не выполнен ({e}), повтор через {delay:.0f} с")
+                await asyncio.sleep(delay)
+
+    async def _deliver(self, semaphore: asyncio.Semaphore, user_id: int, text: str) -> Tuple[str, Optional[str], int]:
+        async with semaphore:
+            try:
+                await bot.send_message(user_id, text, parse_mode="HTML")
+                return "sent", None, user_id
+            except TelegramForbiddenError as e:
+                return "blocked", str(e)[:200], user_id
+            except Exception as e:
+                return "failed", str(e)[:200], user_id
+
+    async def _save_batch(self, job_id: int, results: List[Tuple[str, Optional[str], int]]):
+        now = datetime.now()
+        counts = {"sent": 0, "failed": 0, "blocked": 0}
+        for status, _, _ in results:
+            counts[status] += 1
+        conn = await get_db_connection()
+        try:
+            cursor = conn.cursor()
+            await cursor.executemany(
+                "UPDATE broadcast_deliveries SET status = %s, error = %s, updated_at = %s "
+                "WHERE job_id = %s AND user_id = %s",
+                [(status, error, now, job_id, user_id) for status, error, user_id in results]
+            )
+            blocked = [user_id for status, _, user_id in results if status == "blocked"]
+            if blocked:
+                # Следующий /start должен снять пометку, даже если профиль не менялся
+                BOT_USER_WRITER.forget(blocked)
+                await cursor.execute(
+                    "UPDATE bot_users SET is_blocked = TRUE WHERE user_id = ANY(%s)", (blocked,)
+                )
+            await cursor.execute(
+                "UPDATE broadcast_jobs SET sent = sent + %s, failed = failed + %s, blocked = blocked + %s "
+                "WHERE id = %s",
+                (counts["sent"], counts["failed"], counts["blocked"], job_id)
+            )
+            await conn.commit()
+        finally:
+            await conn.close()
+
+    async def _report(self, job, final: bool = False):
+        if not job["progress_chat_id"]:
+            return
+        done = job["sent"] + job["failed"] + job["blocked"]
+        if final:
+            header = {
+                "done": "✅ <b>Рассылка завершена!</b>",
+                "failed": "❌ <b>Рассылка прервана из-за ошибки базы данных</b>",
+            }.get(job["status"], "⛔ <b>Рассылка остановлена</b>")
+        else:
+            header = f"⏳ <b>Рассылка #{job['id']}…</b> {done}/{job['total']}"
+        text = (
+            f"{header}\n\n"
+            f"📤 Успешно: <b>{job['sent']}</b>\n"
+            f"🚫 Заблокировали бота: <b>{job['blocked']}</b>\n"
+            f"❌ Не доставлено: <b>{job['failed']}</b>"
+        )
+        markup = None
+        if not final:
+            kb = InlineKeyboardBuilder()
+            kb.button(text="⛔ Остановить", callback_data=f"bc_cancel:{job['id']}")
+            markup = kb.as_markup()
+        try:
+            await bot.edit_message_text(
+                text, chat_id=job["progress_chat_id"], message_id=job["progress_message_id"],
+                parse_mode="HTML", reply_markup=markup
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки #{job['id']}: {e}")
+
+    async def _run(self, job_id: int):
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_report = 0.0
+        job = None
+        try:
+            with outbound_priority(PRIORITY_BULK):
+                while True:
+                    job = await self._retrying(job_id, self._load_job, job_id)
+                    if job is None or job["status"] != "running":
+                        break
+                    user_ids = await self._retrying(job_id, self._next_batch, job_id)
+                    if not user_ids:
+                        await self._retrying(job_id, self._finish, job_id, "done")
+                        break
+                    results = await asyncio.gather(
+                        *(self._deliver(semaphore, user_id, job["text"]) for user_id in user_ids)
+                    )
+                    # Пачка уже отправлена: повторяем только запись статусов
+                    await self._retrying(job_id, self._save_batch, job_id, results)
+                    if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                        last_report = time.monotonic()
+                        await self._report(await self._retrying(job_id, self._load_job, job_id))
+            job = await self._retrying(job_id, self._load_job, job_id)
+            if job:
+                await self._report(job, final=True)
+                logger.info(
+                    f"Рассылка #{job_id} ({job['status']}): {job['sent']} успешно, "
+                    f"{job['blocked']} заблокировали, {job['failed']} ошибок"
+                )
+        except Exception as e:
+            logger.error(f"Ошибка рассылки #{job_id}: {e}")
+            await self._fail(job_id, job)
+        finally:
+            self._tasks.pop(job_id, None)
+
+    async def _fail(self, job_id: int, job):
+        """Помечает задание failed и сообщает автору (по последнему прочитанному состоянию)."""
+        try:
+            await self._finish(job_id, "failed")
+        except Exception as e:
+            logger.error(f"Не удалось пометить рассылку #{job_id} как failed: {e}")
+        if job is None:
+            return
+        job = dict(job, status="failed")
+        if job["progress_chat_id"]:
+            await self._report(job, final=True)
+            return
+        try:
+            await bot.send_message(
+                job["created_by"],
+                f"❌ Рассылка #{job_id} прервана из-за ошибки базы данных. "
+                f"Отправлено: {job['sent']} из {job['total']}.",
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сообщить о сбое рассылки #{job_id}: {e}")
+
+
+BROADCASTS = BroadcastEngine()
 
 
 # ============================================================
@@ -4778,39 +7062,50 @@ async def process_bot_broadcast_text(message: Message, state: FSMContext):
         await state.clear()
         await message.answer(
             "❌ Рассылка отменена.",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         return
 
     broadcast_text = message.text
-    user_ids = get_all_bot_users()
-
-    await message.answer(
-        f"⏳ Начинаю рассылку для <b>{len(user_ids)}</b> пользователей...",
-        parse_mode="HTML",
-        reply_markup=get_main_keyboard(message.from_user.id)
-    )
     await state.clear()
 
-    success_count = 0
-    fail_count = 0
-    for user_id in user_ids:
-        try:
-            await bot.send_message(user_id, broadcast_text, parse_mode="HTML")
-            success_count += 1
-            await asyncio.sleep(0.05)  # Защита от флуда Telegram
-        except Exception:
-            fail_count += 1
+    try:
+        job_id, total = await BROADCASTS.create_job(message.from_user.id, broadcast_text)
+    except Exception as e:
+        logger.error(f"Ошибка создания рассылки: {e}")
+        await message.answer(
+            "❌ Не удалось создать рассылку.",
+            reply_markup=await get_main_keyboard(message.from_user.id)
+        )
+        return
 
     await message.answer(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📤 Успешно: <b>{success_count}</b>\n"
-        f"❌ Не доставлено: <b>{fail_count}</b>",
-        parse_mode="HTML"
+        f"⏳ Рассылка #{job_id} запущена для <b>{total}</b> пользователей.",
+        parse_mode="HTML",
+        reply_markup=await get_main_keyboard(message.from_user.id)
     )
-    logger.info(
-        f"Рассылка в боте от {message.from_user.id}: {success_count} успешно, {fail_count} ошибок"
+    # Отдельное сообщение с прогрессом и кнопкой остановки — его редактирует воркер
+    kb = InlineKeyboardBuilder()
+    kb.button(text="⛔ Остановить", callback_data=f"bc_cancel:{job_id}")
+    progress_msg = await message.answer(
+        f"⏳ <b>Рассылка #{job_id}…</b> 0/{total}", parse_mode="HTML", reply_markup=kb.as_markup()
     )
+    await BROADCASTS.attach_progress(job_id, progress_msg.chat.id, progress_msg.message_id)
+    BROADCASTS.start(job_id)
+    logger.info(f"Рассылка #{job_id} в боте от {message.from_user.id}: {total} получателей")
+
+
+@dp.callback_query(F.data.startswith("bc_cancel:"))
+async def cb_broadcast_cancel(callback: CallbackQuery):
+    """Остановка рассылки по кнопке в сообщении с прогрессом"""
+    if not await is_bot_admin(callback.from_user.id):
+        await callback.answer("❌ Нет прав.", show_alert=True)
+        return
+    job_id = int(callback.data.split(":", 1)[1])
+    if await BROADCASTS.cancel(job_id):
+        await callback.answer("⛔ Рассылка будет остановлена.")
+    else:
+        await callback.answer("Рассылка уже завершена.")
 
 
 @dp.message(BroadcastStates.waiting_for_chat_broadcast_text, F.chat.type == ChatType.PRIVATE)
@@ -4820,7 +7115,7 @@ async def process_chat_broadcast_text(message: Message, state: FSMContext):
         await state.clear()
         await message.answer(
             "❌ Рассылка отменена.",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         return
 
@@ -4832,14 +7127,14 @@ async def process_chat_broadcast_text(message: Message, state: FSMContext):
         await message.answer(
             "✅ <b>Сообщение успешно отправлено в чат барахолки!</b>",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         logger.info(f"Рассылка в чат от {message.from_user.id}")
     except Exception as e:
         await message.answer(
             f"❌ <b>Ошибка отправки сообщения в чат:</b>\n<code>{e}</code>",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         logger.error(f"Ошибка рассылки в чат от {message.from_user.id}: {e}")
 
@@ -4850,43 +7145,43 @@ async def cmd_stats(message: Message):
         await message.answer("❌ У вас нет прав для этой команды.")
         return
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
 
     # Статистика варнов
-    cursor.execute("SELECT COUNT(*) AS c FROM warns")
-    total_warns = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM warns")
+    total_warns = (await cursor.fetchone())["c"]
 
-    cursor.execute("SELECT COUNT(*) AS c FROM warns WHERE expires_at > %s", (datetime.now(),))
-    active_warns = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM warns WHERE expires_at > %s", (datetime.now(),))
+    active_warns = (await cursor.fetchone())["c"]
 
     # Статистика мутов
-    cursor.execute("SELECT COUNT(*) AS c FROM mutes")
-    total_mutes = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM mutes")
+    total_mutes = (await cursor.fetchone())["c"]
 
-    cursor.execute("SELECT COUNT(*) AS c FROM mutes WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)", (datetime.now(),))
-    active_mutes = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM mutes WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)", (datetime.now(),))
+    active_mutes = (await cursor.fetchone())["c"]
 
     # Статистика банов
-    cursor.execute("SELECT COUNT(*) AS c FROM bans")
-    total_bans = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM bans")
+    total_bans = (await cursor.fetchone())["c"]
 
-    cursor.execute("SELECT COUNT(*) AS c FROM bans WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)", (datetime.now(),))
-    active_bans = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM bans WHERE is_active = TRUE AND (expires_at IS NULL OR expires_at > %s)", (datetime.now(),))
+    active_bans = (await cursor.fetchone())["c"]
 
     # Статистика объявлений
-    cursor.execute("SELECT COUNT(*) AS c FROM user_ads")
-    total_ads = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM user_ads")
+    total_ads = (await cursor.fetchone())["c"]
 
-    cursor.execute("SELECT COUNT(*) AS c FROM user_ads WHERE DATE(sent_at) = CURRENT_DATE")
-    today_ads = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM user_ads WHERE sent_at >= CURRENT_DATE")
+    today_ads = (await cursor.fetchone())["c"]
 
     # Статистика администраторов
-    cursor.execute("SELECT COUNT(*) AS c FROM admins")
-    total_admins = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM admins")
+    total_admins = (await cursor.fetchone())["c"]
 
-    cursor.execute("SELECT COUNT(*) AS c FROM admin_warns WHERE is_active = TRUE")
-    active_admin_warns = cursor.fetchone()["c"]
+    await cursor.execute("SELECT COUNT(*) AS c FROM admin_warns WHERE is_active = TRUE")
+    active_admin_warns = (await cursor.fetchone())["c"]
 
     stats_text = f"""
     📊 <b>Статистика бота</b>
@@ -4913,7 +7208,7 @@ async def cmd_stats(message: Message):
 
     ?? <b>Бот работает стабильно!</b>
     """
-    conn.close()
+    await conn.close()
 
     await message.answer(stats_text, parse_mode="HTML")
 
@@ -4922,8 +7217,7 @@ async def cmd_warns(message: Message, command: CommandObject):
     """Просмотр предупреждений пользователя"""
     if not await is_chat_admin(message.from_user.id, message.chat.id):
         clown_msg = await message.reply("🤡")
-        await asyncio.sleep(2)
-        await delete_message(message.chat.id, message.message_id)
+        await DEFERRED_DELETIONS.schedule(message.chat.id, message.message_id, 2)
         await mute_user(
             message.chat.id,
             message.from_user.id,
@@ -4954,7 +7248,7 @@ async def cmd_warns(message: Message, command: CommandObject):
         )
         return
 
-    warns = get_user_warns(user_id, message.chat.id)
+    warns = await get_user_warns(user_id, message.chat.id)
     user_mention = await get_user_mention(user_id)
 
     if not warns:
@@ -4977,8 +7271,7 @@ async def cmd_warns(message: Message, command: CommandObject):
 async def cmd_clearwarns(message: Message, command: CommandObject):
     if not await is_chat_admin(message.from_user.id, message.chat.id):
         clown_msg = await message.reply("🤡")
-        await asyncio.sleep(2)
-        await delete_message(message.chat.id, message.message_id)
+        await DEFERRED_DELETIONS.schedule(message.chat.id, message.message_id, 2)
         await mute_user(
             message.chat.id,
             message.from_user.id,
@@ -5002,7 +7295,7 @@ async def cmd_clearwarns(message: Message, command: CommandObject):
         )
         return
 
-    clear_user_warns(user_id, message.chat.id)
+    await clear_user_warns(user_id, message.chat.id)
     user_mention = await get_user_mention(user_id)
 
     await message.answer(
@@ -5022,8 +7315,8 @@ async def cmd_adblock(message: Message, command: CommandObject):
         return
     
     # Проверка роли (только admin и владелец)
-    if not admin_can(message.from_user.id, "can_adblock"):
-        role = get_admin_role(message.from_user.id)
+    if not await admin_can(message.from_user.id, "can_adblock"):
+        role = await get_admin_role(message.from_user.id)
         role_label = ADMIN_ROLES.get(role, {}).get("label", "вашей роли") if role else "вашей роли"
         await message.answer(
             f"❌ Роль <b>{role_label}</b> не позволяет использовать /adblock.\n"
@@ -5159,9 +7452,7 @@ async def cmd_clear_chat(message: Message, command: CommandObject):
     """Очистка указанного количества сообщений в чате"""
     if not await is_chat_admin(message.from_user.id, message.chat.id):
         clown_msg = await message.reply("🤡")
-        await asyncio.sleep(2)
-        
-        await delete_message(message.chat.id, message.message_id)
+        await DEFERRED_DELETIONS.schedule(message.chat.id, message.message_id, 2)
         await mute_user(
             message.chat.id,
             message.from_user.id,
@@ -5200,49 +7491,38 @@ async def cmd_clear_chat(message: Message, command: CommandObject):
     )
 
     try:
-        deleted_count = 0
-        skipped_count = 0
-        
-        # Удаляем САМОЕ ПЕРВОЕ - команду /cc
-        await delete_message(message.chat.id, message.message_id)
-        
-        # Начинаем с сообщения ПЕРЕД подтверждающим сообщением
-        current_message_id = confirm_msg.message_id - 1
-        
-        # Удаляем сообщения ВПЕРЁД (от старых к новым)
-        while (current_message_id > 0 and 
-               deleted_count + skipped_count < count):
-            
+        # Последние известные сообщения чата; если их меньше, чем просили
+        # (например, после перезапуска бота), добираем диапазоном ID ниже
+        target_ids = RECENT_MESSAGES.before(
+            message.chat.id, confirm_msg.message_id, count, exclude=(message.message_id,)
+        )
+        if len(target_ids) < count:
+            lowest = min(target_ids + [message.message_id])
+            target_ids += list(range(lowest - 1, max(lowest - 1 - (count - len(target_ids)), 0), -1))
+
+        last_edit = time.monotonic()
+
+        async def report_progress(processed: int, deleted: int):
+            nonlocal last_edit
+            if time.monotonic() - last_edit < CLEAR_PROGRESS_INTERVAL or processed >= len(target_ids):
+                return
+            last_edit = time.monotonic()
             try:
-                # Пытаемся удалить сообщение
-                success = await delete_message(message.chat.id, current_message_id)
-                if success:
-                    deleted_count += 1
-                else:
-                    skipped_count += 1
-                
-                # Небольшая задержка чтобы не превысить лимиты Telegram
-                await asyncio.sleep(0.1)
-                
-            except Exception as e:
-                skipped_count += 1
-                # Продолжаем с следующим сообщением при любой ошибке
-            
-            current_message_id -= 1
-            
-            # Обновляем прогресс каждые 10 сообщений
-            if (deleted_count + skipped_count) % 10 == 0:
-                try:
-                    await confirm_msg.edit_text(
-                        f"🧹 <b>Очистка сообщений...</b>\n\n"
-                        f"📊 <b>Прогресс:</b>\n"
-                        f"• 🗑️ Удалено: {deleted_count}\n"
-                        f"• ⏭️ Пропущено: {skipped_count}\n"
-                        f"• ⏳ Осталось: {count - (deleted_count + skipped_count)}",
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
+                await confirm_msg.edit_text(
+                    f"🧹 <b>Очистка сообщений...</b>\n\n"
+                    f"📊 <b>Прогресс:</b>\n"
+                    f"• 🗑️ Удалено: {deleted}\n"
+                    f"• ⏭️ Пропущено: {processed - deleted}\n"
+                    f"• ⏳ Осталось: {len(target_ids) - processed}",
+                    parse_mode="HTML"
+                )
+            except Exception:
+                pass
+
+        # Команда /cc удаляется первой пачкой, в статистику не входит
+        await bulk_delete_messages(message.chat.id, [message.message_id])
+        deleted_count = await bulk_delete_messages(message.chat.id, target_ids, report_progress)
+        skipped_count = len(target_ids) - deleted_count
         
         # Обновляем сообщение с результатами
         result_text = (
@@ -5260,8 +7540,7 @@ async def cmd_clear_chat(message: Message, command: CommandObject):
         )
         
         # Удаляем сообщение с результатами через 15 секунд
-        await asyncio.sleep(15)
-        await delete_message(message.chat.id, confirm_msg.message_id)
+        await DEFERRED_DELETIONS.schedule(message.chat.id, confirm_msg.message_id, 15)
         
     except Exception as e:
         logger.error(f"Ошибка при очистке чата: {e}")
@@ -5273,6 +7552,57 @@ async def cmd_clear_chat(message: Message, command: CommandObject):
         except:
             pass
 
+# RAID видит только CHAT_ID — в других чатах команда не срабатывает
+@dp.message(Command("raid"), F.chat.id == CHAT_ID)
+async def cmd_raid(message: Message, command: CommandObject):
+    """Массовое наказание участников рейда: /raid ban|mute [окно] [срок], /raid off"""
+    if not await is_chat_admin(message.from_user.id, message.chat.id):
+        await auto_punish_non_admin(message)
+        return
+
+    args = (command.args or "").lower().split()
+    action = args[0] if args else "ban"
+    if action == "off":
+        RAID.active_until = 0.0
+        await message.answer("✅ Рейд-режим выключен.")
+        return
+    if action not in ("ban", "mute") or len(args) > 3:
+        await message.answer(
+            "📌 <b>Форматы:</b>\n"
+            "• <code>/raid ban [окно]</code> — забанить вошедших и написавших за окно (по умолчанию 10m)\n"
+            "• <code>/raid mute [окно] [срок]</code> — замутить их (срок по умолчанию 1d)\n"
+            "• <code>/raid off</code> — выключить рейд-режим",
+            parse_mode="HTML"
+        )
+        return
+    if not await admin_can(message.from_user.id, "can_ban" if action == "ban" else "can_mute"):
+        await message.answer("❌ Ваша роль не позволяет это наказание.")
+        return
+
+    lookback = parse_time(args[1]) if len(args) > 1 else timedelta(seconds=RAID_LOOKBACK)
+    duration = parse_time(args[2]) if len(args) > 2 else (None if action == "ban" else RAID_AUTO_MUTE)
+    if lookback is None or (len(args) > 2 and duration is None):
+        await message.answer("❌ Неверный формат времени. Примеры: 30m, 2h, 1d")
+        return
+
+    await delete_message(message.chat.id, message.message_id)
+    offenders = RAID.offenders(lookback.total_seconds())
+    if not offenders:
+        notice = await message.answer("ℹ️ Нарушителей за это окно не найдено.")
+        await DEFERRED_DELETIONS.schedule(message.chat.id, notice.message_id, 15)
+        return
+
+    done, failed = await execute_raid(
+        message.chat.id, offenders, action, duration, "Рейд", message.from_user.id
+    )
+    notice = await message.answer(
+        f"🛡 <b>Рейд отражён</b>\n\n"
+        f"{'🚫 Забанено' if action == 'ban' else '🔇 Замучено'}: {len(done)}"
+        + (f"\n⚠️ Не удалось: {failed}" if failed else ""),
+        parse_mode="HTML"
+    )
+    await DEFERRED_DELETIONS.schedule(message.chat.id, notice.message_id, 30)
+
 @dp.message(Command("admin_add"))
 async def cmd_admin_add(message: Message, command: CommandObject):
     if not await is_owner(message.from_user.id):
@@ -5379,7 +7709,7 @@ async def cmd_admin_add(message: Message, command: CommandObject):
             pass  # Может не работать в некоторых группах
         
         # Добавляем в базу данных бота с ролью
-        add_admin(user_id, message.from_user.id, role=role_str, display_name=display_name)
+        await add_admin(user_id, message.from_user.id, role=role_str, display_name=display_name)
         
         # Список доступных команд по роли
         cmds = []
@@ -5534,10 +7864,10 @@ async def cmd_admin_remove(message: Message, command: CommandObject):
         )
         
         # Удаляем из базы данных бота
-        remove_admin(user_id)
+        await remove_admin(user_id)
         
         # Очищаем предупреждения администратора
-        clear_admin_warns(user_id)
+        await clear_admin_warns(user_id)
 
         # Деактивируем доступ на сайте (снимает is_active и стирает пароль)
         _site_deactivated = False
@@ -5588,11 +7918,11 @@ async def cmd_admin_quest(message: Message, command: CommandObject):
 
     # ── Закрытие набора ──
     if arg == "close":
-        state = get_admin_quest_state()
+        state = await get_admin_quest_state()
         if not state["is_open"]:
             await message.answer("ℹ️ Набор администраторов и так закрыт.")
             return
-        set_admin_quest_closed()
+        await set_admin_quest_closed()
         try:
             await bot.send_message(
                 CHAT_ID,
@@ -5620,7 +7950,7 @@ async def cmd_admin_quest(message: Message, command: CommandObject):
             return
         max_applications = int(arg)
 
-    set_admin_quest_open(max_applications)
+    await set_admin_quest_open(max_applications)
 
     kb = InlineKeyboardMarkup(inline_keyboard=[[
         InlineKeyboardButton(
@@ -5675,7 +8005,7 @@ async def admin_quest_process_time(message: Message, state: FSMContext):
     data = await state.update_data(quest_time=message.text.strip())
     await state.clear()
 
-    quest_state = get_admin_quest_state()
+    quest_state = await get_admin_quest_state()
     if not quest_state["is_open"]:
         await message.answer("😔 Набор администраторов уже закрыт, заявка не принята. Следите за новыми объявлениями.")
         return
@@ -5710,11 +8040,11 @@ async def admin_quest_process_time(message: Message, state: FSMContext):
         await message.answer("⚠️ Заявка заполнена, но не удалось доставить её владельцам. Свяжитесь с администрацией напрямую.")
         return
 
-    new_count = increment_admin_quest_applications()
+    new_count = await increment_admin_quest_applications()
     await message.answer("✅ Спасибо! Ваша заявка отправлена на рассмотрение.")
 
     if max_apps is not None and new_count >= max_apps:
-        set_admin_quest_closed()
+        await set_admin_quest_closed()
         try:
             await bot.send_message(
                 CHAT_ID,
@@ -5737,18 +8067,18 @@ async def cmd_admin_list(message: Message):
         await message.answer("❌ У вас нет прав для этой команды.")
         return
 
-    admins = get_all_admins()
+    admins = await get_all_admins()
     if not admins:
         await message.answer("📋 Список администраторов пуст.")
         return
 
+    profiles = await PROFILES.get_many(admins)
     admin_mentions = []
     for admin_id in admins:
-        try:
-            user = await bot.get_chat(admin_id)
-            name = user.first_name or user.username or str(admin_id)
+        if admin_id in profiles:
+            name = profiles[admin_id].display_name
             admin_mentions.append(f"• <a href='tg://user?id={admin_id}'>{name}</a>")
-        except:
+        else:
             admin_mentions.append(f"• {admin_id}")
 
     await message.answer(
@@ -5760,12 +8090,17 @@ async def cmd_admin_list(message: Message):
 @dp.message(Command("admins"))
 async def cmd_admins_public(message: Message):
     """Публичная команда — список администраторов с именами и специализацией"""
-    admins_info = get_all_admins_with_info()
+    admins_info = await get_all_admins_with_info()
     
     if not admins_info:
         await message.answer("👮 Список администраторов пока пуст.")
         return
     
+    # Имена тех, у кого не задан display_name, — одним пакетом
+    profiles = await PROFILES.get_many(
+        [a["user_id"] for a in admins_info if not a.get("display_name")]
+    )
+    
     lines = ["👮 <b>Команда администрации</b>\n"]
     
     # Группируем по ролям (от старшего к младшему)
@@ -5798,13 +8133,7 @@ async def cmd_admins_public(message: Message):
         
         for admin in members:
             user_id = admin["user_id"]
-            display_name = admin.get("display_name")
-            if not display_name:
-                try:
-                    user = await bot.get_chat(user_id)
-                    display_name = user.first_name or user.username or str(user_id)
-                except:
-                    display_name = str(user_id)
+            display_name = admin.get("display_name") or profile_name(profiles, user_id)
             lines.append(f"   ├ <a href='tg://user?id={user_id}'>{display_name}</a>")
         
         lines.append("")  # пустая строка между группами
@@ -5845,10 +8174,10 @@ async def cmd_admin_warn(message: Message, command: CommandObject):
         return
 
     # Добавляем предупреждение администратору
-    add_admin_warn(user_id, reason, message.from_user.id)
+    await add_admin_warn(user_id, reason, message.from_user.id)
     
     # Получаем текущее количество предупреждений
-    admin_warns = get_admin_warns(user_id)
+    admin_warns = await get_admin_warns(user_id)
     warn_count = len(admin_warns)
     
     user_mention = await get_user_mention(user_id)
@@ -5901,10 +8230,10 @@ async def cmd_admin_warn(message: Message, command: CommandObject):
             )
             
             # Удаляем из базы данных бота
-            remove_admin(user_id)
+            await remove_admin(user_id)
             
             # Очищаем предупреждения администратора
-            clear_admin_warns(user_id)
+            await clear_admin_warns(user_id)
             
             # Отправляем уведомление о снятии
             await message.answer(
@@ -5958,24 +8287,24 @@ async def cmd_admin_unwarn(message: Message, command: CommandObject):
 
     # Проверяем, является ли пользователь администратором чата или бота
     is_chat_admin_user = await is_chat_admin(user_id, message.chat.id)
-    is_bot_admin_user = is_admin(user_id)
+    is_bot_admin_user = await is_admin(user_id)
     
     if not (is_chat_admin_user or is_bot_admin_user):
         await message.answer("❌ Указанный пользователь не является администратором.")
         return
 
     # Получаем текущие предупреждения
-    warns_before = get_admin_warns(user_id)
+    warns_before = await get_admin_warns(user_id)
     warn_count_before = len(warns_before)
     
     # Снимаем последнее предупреждение
-    warn_id = remove_last_admin_warn(user_id)
+    warn_id = await remove_last_admin_warn(user_id)
     user_mention = await get_user_mention(user_id)
     owner_mention = await get_user_mention(message.from_user.id)
 
     if warn_id:
         # Получаем обновленное количество предупреждений
-        warns_after = get_admin_warns(user_id)
+        warns_after = await get_admin_warns(user_id)
         warn_count_after = len(warns_after)
         
         await message.answer(
@@ -6020,7 +8349,7 @@ async def cmd_admin_warns(message: Message, command: CommandObject):
         await message.answer("❌ Указанный пользователь не является администратором.")
         return
 
-    warns = get_admin_warns(user_id)
+    warns = await get_admin_warns(user_id)
     user_mention = await get_user_mention(user_id)
 
     if not warns:
@@ -6056,7 +8385,7 @@ async def cmd_check_admin(message: Message, command: CommandObject):
         return
     
     is_chat_admin_user = await is_chat_admin(user_id, message.chat.id)
-    is_bot_admin_user = is_admin(user_id)
+    is_bot_admin_user = await is_admin(user_id)
     is_owner_user = user_id in ADMIN_IDS
     is_combined_admin = await is_chat_admin_or_bot_admin(user_id, message.chat.id)
     
@@ -6120,32 +8449,26 @@ async def cmd_ban_info(message: Message, command: CommandObject):
         logger.error(f"Ошибка при получении информации о пользователе: {e}")
         # Продолжаем, даже если не удалось получить информацию
     
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
     
     # Проверяем все типы наказаний
-    cursor.execute("SELECT COUNT(*) AS c FROM warns WHERE user_id = %s AND chat_id = %s", 
+    await cursor.execute("SELECT COUNT(*) AS c FROM warns WHERE user_id = %s AND chat_id = %s", 
                   (user_id, message.chat.id))
-    warn_count = cursor.fetchone()["c"]
+    warn_count = (await cursor.fetchone())["c"]
     
-    cursor.execute("SELECT COUNT(*) AS c FROM mutes WHERE user_id = %s AND chat_id = %s AND is_active = TRUE", 
+    await cursor.execute("SELECT COUNT(*) AS c FROM mutes WHERE user_id = %s AND chat_id = %s AND is_active = TRUE", 
                   (user_id, message.chat.id))
-    mute_count = cursor.fetchone()["c"]
+    mute_count = (await cursor.fetchone())["c"]
     
-    cursor.execute("SELECT COUNT(*) AS c FROM bans WHERE user_id = %s AND chat_id = %s AND is_active = TRUE", 
+    await cursor.execute("SELECT COUNT(*) AS c FROM bans WHERE user_id = %s AND chat_id = %s AND is_active = TRUE", 
                   (user_id, message.chat.id))
-    ban_count = cursor.fetchone()["c"]
+    ban_count = (await cursor.fetchone())["c"]
     
-    # Детальная информация о банах
-    cursor.execute("""
-        SELECT reason, issued_by, issued_at, expires_at 
-        FROM bans 
-        WHERE user_id = %s AND chat_id = %s 
-        ORDER BY issued_at DESC
-    """, (user_id, message.chat.id))
-    
-    bans = cursor.fetchall()
-    conn.close()
+    await conn.close()
+
+    # История банов — из журнала moderation_events
+    bans = await MODERATION.history(user_id, kinds=("ban",), limit=5, chat_id=message.chat.id)
     
     user_mention = await get_user_mention(user_id)
     
@@ -6156,8 +8479,8 @@ async def cmd_ban_info(message: Message, command: CommandObject):
     
     if bans:
         response += "<b>История банов:</b>\n"
-        for i, ban in enumerate(bans[:5], 1):  # Показываем последние 5 банов
-            reason, issued_by, issued_at, expires_at = ban
+        for i, ban in enumerate(bans, 1):  # Последние 5 банов
+            reason, issued_by, issued_at, expires_at = ban["reason"], ban["issued_by"], ban["created_at"], ban["expires_at"]
             issued_by_mention = await get_user_mention(issued_by)
             expires_text = f"до {expires_at}" if expires_at else "навсегда"
             
@@ -6197,13 +8520,13 @@ async def cmd_addjbadm(message: Message, command: CommandObject):
         else:
             # Режим @username — ищем в БД
             uname = arg.lstrip("@").lower()
-            conn = get_db_connection()
+            conn = await get_db_connection()
             cursor = conn.cursor()
-            cursor.execute(
+            await cursor.execute(
                 "SELECT user_id, username FROM bot_users WHERE lower(username)=%s", (uname,)
             )
-            row = cursor.fetchone()
-            conn.close()
+            row = await cursor.fetchone()
+            await conn.close()
             if row:
                 target_user_id = row[0]
                 target_username = row[1]
@@ -6228,11 +8551,11 @@ async def cmd_addjbadm(message: Message, command: CommandObject):
 
     # Получаем username из БД если не знаем его ещё
     if not target_username and target_user_id:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT username FROM bot_users WHERE user_id=%s", (target_user_id,))
-        row = cursor.fetchone()
-        conn.close()
+        await cursor.execute("SELECT username FROM bot_users WHERE user_id=%s", (target_user_id,))
+        row = await cursor.fetchone()
+        await conn.close()
         target_username = row[0] if row else None
 
     site_username = target_username.lstrip("@").lower() if target_username else ""
@@ -6326,11 +8649,8 @@ async def cmd_report(message: Message, command: CommandObject):
     # Сохраняем жалобу в БД для отображения на сайте
     reporter_username = message.from_user.username or str(message.from_user.id)
     reported_username_str = ""
-    try:
-        _u = await bot.get_chat(reported_user_id)
-        reported_username_str = _u.username or str(reported_user_id)
-    except Exception:
-        reported_username_str = str(reported_user_id)
+    _u = await PROFILES.get(reported_user_id)
+    reported_username_str = (_u.username if _u else None) or str(reported_user_id)
     reported_msg_text = ""
     reported_msg_link = ""
     if message.reply_to_message:
@@ -6338,9 +8658,9 @@ async def cmd_report(message: Message, command: CommandObject):
         chat_id_for_link = str(message.chat.id).replace("-100", "")
         reported_msg_link = f"https://t.me/c/{chat_id_for_link}/{message.reply_to_message.message_id}"
     try:
-        _conn = get_db_connection()
+        _conn = await get_db_connection()
         _cursor = _conn.cursor()
-        _cursor.execute(
+        await _cursor.execute(
             """INSERT INTO user_reports
                (reporter_id, reporter_username, reported_id, reported_username,
                 reason, message_text, message_link, chat_id, status)
@@ -6349,8 +8669,8 @@ async def cmd_report(message: Message, command: CommandObject):
              reason, reported_msg_text[:500] if reported_msg_text else None,
              reported_msg_link or None, message.chat.id)
         )
-        _conn.commit()
-        _conn.close()
+        await _conn.commit()
+        await _conn.close()
     except Exception as _e:
         logger.error(f"Не удалось сохранить жалобу в БД: {_e}")
 
@@ -6377,7 +8697,7 @@ async def cmd_report(message: Message, command: CommandObject):
     )
     
     # Получаем список администраторов бота
-    admin_ids = list(set(get_all_admins() + ADMIN_IDS))
+    admin_ids = list(set(await get_all_admins() + ADMIN_IDS))
     
     # Функция для отправки жалобы одному администратору
     async def send_to_admin(admin_id):
@@ -6397,7 +8717,7 @@ async def cmd_report(message: Message, command: CommandObject):
             logger.error(f"Не удалось отправить жалобу администратору {admin_id}: {e}")
             return False
     
-    # Отправляем жалобы всем администраторам ПАРАЛЛЕЛЬНО
+    # Отправляем жалобы всем администраторам ПАРАЛЛЕЛЬНО (темп задаёт OUTBOX)
     tasks = [send_to_admin(admin_id) for admin_id in admin_ids]
     results = await asyncio.gather(*tasks)
     success_count = sum(results)
@@ -6427,8 +8747,7 @@ async def cmd_report(message: Message, command: CommandObject):
             )
     
     # Удаляем подтверждение через 10 секунд
-    await asyncio.sleep(10)
-    await delete_message(message.chat.id, confirm_msg.message_id)
+    await DEFERRED_DELETIONS.schedule(message.chat.id, confirm_msg.message_id, 10)
 
 @dp.callback_query(F.data.startswith(("warn:", "mute", "ban:", "dismiss:")))
 async def handle_report_callback(callback: types.CallbackQuery):
@@ -6578,7 +8897,7 @@ async def handle_report_callback(callback: types.CallbackQuery):
 async def start_complaint_callback(callback: types.CallbackQuery, state: FSMContext):
     """Оставлен для обратной совместимости со старыми сообщениями"""
     await callback.answer()
-    if is_user_blocked(callback.from_user.id):
+    if await is_user_blocked(callback.from_user.id):
         await callback.message.answer("🚫 Вы заблокированы в боте.")
         return
 
@@ -6696,11 +9015,11 @@ async def process_complaint_text(message: Message, state: FSMContext):
 @dp.message(AdminComplaintStates.waiting_for_evidence)
 async def process_evidence(message: Message, state: FSMContext):
     # Проверяем, не заблокирован ли пользователь
-    if is_user_blocked(message.from_user.id):
+    if await is_user_blocked(message.from_user.id):
         await message.answer(
             "❌ Вы заблокированы в боте и не можете подавать жалобы.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         await state.clear()
         return
@@ -6723,7 +9042,7 @@ async def process_evidence(message: Message, state: FSMContext):
             f"❌ Ошибка: отсутствуют обязательные данные ({', '.join(missing_fields)}). "
             f"Пожалуйста, начните процесс подачи жалобы заново.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
         return
     
@@ -6746,7 +9065,7 @@ async def process_evidence(message: Message, state: FSMContext):
         evidence = "Доказательства не предоставлены"
     
     # Сохраняем жалобу в базу данных
-    complaint_id = save_admin_complaint(
+    complaint_id = await save_admin_complaint(
         user_id=message.from_user.id,
         username=username,
         admin_username=admin_username,
@@ -6828,14 +9147,14 @@ async def process_evidence(message: Message, state: FSMContext):
             f"• Время: {datetime.now().strftime('%H:%M %d.%m.%Y')}\n\n"
             f"<i>Обратная связь будет предоставлена в ближайшее время.</i>",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
     else:
         await message.answer(
             "❌ К сожалению, не удалось отправить вашу жалобу. "
             "Пожалуйста, попробуйте позже или свяжитесь с владельцами напрямую.",
             parse_mode="HTML",
-            reply_markup=get_main_keyboard(message.from_user.id)
+            reply_markup=await get_main_keyboard(message.from_user.id)
         )
 
 @dp.callback_query(F.data.startswith("contact_complainant:"))
@@ -6879,13 +9198,13 @@ async def cmd_cancel(message: Message, state: FSMContext):
         
     current_state = await state.get_state()
     if current_state is None:
-        await message.answer("❌ Нечего отменять.", reply_markup=get_main_keyboard(message.from_user.id))
+        await message.answer("❌ Нечего отменять.", reply_markup=await get_main_keyboard(message.from_user.id))
         return
     
     await state.clear()
     await message.answer(
         "✅ Процесс подачи жалобы отменен.",
-        reply_markup=get_main_keyboard(message.from_user.id)
+        reply_markup=await get_main_keyboard(message.from_user.id)
     )
 
 @dp.callback_query(F.data == "view_all_complaints")
@@ -6895,7 +9214,7 @@ async def view_all_complaints(callback: types.CallbackQuery):
         await callback.answer("❌ У вас нет прав для просмотра жалоб.")
         return
     
-    complaints = get_active_complaints()
+    complaints = await get_active_complaints()
     complaints_count = len(complaints)
     
     text = f"📋 <b>Активные жалобы на администраторов</b>\n\n"
@@ -6920,13 +9239,13 @@ async def view_all_complaints(callback: types.CallbackQuery):
         await callback.message.edit_text(
             text,
             parse_mode="HTML",
-            reply_markup=get_complaints_keyboard()
+            reply_markup=await get_complaints_keyboard()
         )
     except Exception:
         await callback.message.answer(
             text,
             parse_mode="HTML",
-            reply_markup=get_complaints_keyboard()
+            reply_markup=await get_complaints_keyboard()
         )
     await callback.answer()
 
@@ -6938,7 +9257,7 @@ async def view_complaint(callback: types.CallbackQuery):
         return
     
     complaint_id = int(callback.data.split(":")[1])
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await callback.answer("❌ Жалоба не найдена.")
@@ -6971,7 +9290,7 @@ async def refresh_complaints(callback: types.CallbackQuery):
         await callback.answer("❌ У вас нет прав для просмотра жалоб.")
         return
     
-    complaints = get_active_complaints()
+    complaints = await get_active_complaints()
     complaints_count = len(complaints)
     
     text = f"📋 <b>Активные жалобы на администраторов</b>\n\n"
@@ -6990,7 +9309,7 @@ async def refresh_complaints(callback: types.CallbackQuery):
     await callback.message.edit_text(
         text,
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
     await callback.answer("✅ Список обновлен")
 
@@ -7002,7 +9321,7 @@ async def start_reject_complaint(callback: types.CallbackQuery, state: FSMContex
         return
     
     complaint_id = int(callback.data.split(":")[1])
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await callback.answer("❌ Жалоба не найдена.")
@@ -7026,7 +9345,7 @@ async def start_approve_complaint(callback: types.CallbackQuery, state: FSMConte
         return
     
     complaint_id = int(callback.data.split(":")[1])
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await callback.answer("❌ Жалоба не найдена.")
@@ -7050,7 +9369,7 @@ async def start_warn_false_report(callback: types.CallbackQuery, state: FSMConte
         return
     
     complaint_id = int(callback.data.split(":")[1])
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await callback.answer("❌ Жалоба не найдена.")
@@ -7074,7 +9393,7 @@ async def start_warn_incorrect_report(callback: types.CallbackQuery, state: FSMC
         return
     
     complaint_id = int(callback.data.split(":")[1])
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await callback.answer("❌ Жалоба не найдена.")
@@ -7095,7 +9414,7 @@ async def process_reject_reason(message: Message, state: FSMContext):
     """Обрабатывает причину отклонения жалобы"""
     data = await state.get_data()
     complaint_id = data['complaint_id']
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await message.answer("❌ Жалоба не найдена.")
@@ -7107,7 +9426,7 @@ async def process_reject_reason(message: Message, state: FSMContext):
         reason = "Причина не указана"
     
     # Обновляем статус жалобы
-    update_complaint_status(complaint_id, "rejected", message.from_user.id, reason)
+    await update_complaint_status(complaint_id, "rejected", message.from_user.id, reason)
     
     # Уведомляем жалобщика
     try:
@@ -7130,7 +9449,7 @@ async def process_reject_reason(message: Message, state: FSMContext):
         f"👤 <b>Жалобщик:</b> {complaint['username']}\n"
         f"📝 <b>Причина:</b> {reason}",
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
     
     await state.clear()
@@ -7140,7 +9459,7 @@ async def process_approve_actions(message: Message, state: FSMContext):
     """Обрабатывает действия по принятой жалобе"""
     data = await state.get_data()
     complaint_id = data['complaint_id']
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await message.answer("❌ Жалоба не найдена.")
@@ -7152,7 +9471,7 @@ async def process_approve_actions(message: Message, state: FSMContext):
         actions = "Причина не указана"
     
     # Обновляем статус жалобы
-    update_complaint_status(complaint_id, "approved", message.from_user.id, actions)
+    await update_complaint_status(complaint_id, "approved", message.from_user.id, actions)
     
     # Уведомляем жалобщика
     try:
@@ -7175,7 +9494,7 @@ async def process_approve_actions(message: Message, state: FSMContext):
         f"👤 <b>Жалобщик:</b> {complaint['username']}\n"
         f"📋 <b>Действия:</b> {actions}",
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
     
     await state.clear()
@@ -7185,7 +9504,7 @@ async def process_false_report_reason(message: Message, state: FSMContext):
     """Обрабатывает причину бана за ложную жалобу - БАН в ЛС с ботом"""
     data = await state.get_data()
     complaint_id = data['complaint_id']
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await message.answer("❌ Жалоба не найдена.")
@@ -7197,10 +9516,10 @@ async def process_false_report_reason(message: Message, state: FSMContext):
         reason = "Причина не указана"
     
     # Обновляем статус жалобы
-    update_complaint_status(complaint_id, "false_report", message.from_user.id, reason)
+    await update_complaint_status(complaint_id, "false_report", message.from_user.id, reason)
     
     # БЛОКИРУЕМ пользователя в боте за ложную жалобу
-    block_user(complaint['user_id'], f"Ложная жалоба: {reason}", message.from_user.id)
+    await block_user(complaint['user_id'], f"Ложная жалоба: {reason}", message.from_user.id)
     
     # Уведомляем жалобщика
     try:
@@ -7224,7 +9543,7 @@ async def process_false_report_reason(message: Message, state: FSMContext):
         f"📝 <b>Причина:</b> {reason}\n"
         f"📊 <b>Статус:</b> ✅ Пользователь заблокирован в боте",
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
     
     await state.clear()
@@ -7234,7 +9553,7 @@ async def process_incorrect_report_reason(message: Message, state: FSMContext):
     """Обрабатывает причину предупреждения за некорректную жалобу - ПРЕДУПРЕЖДЕНИЕ в боте"""
     data = await state.get_data()
     complaint_id = data['complaint_id']
-    complaint = get_complaint_by_id(complaint_id)
+    complaint = await get_complaint_by_id(complaint_id)
     
     if not complaint:
         await message.answer("❌ Жалоба не найдена.")
@@ -7246,18 +9565,18 @@ async def process_incorrect_report_reason(message: Message, state: FSMContext):
         reason = "Причина не указана"
     
     # Обновляем статус жалобы
-    update_complaint_status(complaint_id, "incorrect_report", message.from_user.id, reason)
+    await update_complaint_status(complaint_id, "incorrect_report", message.from_user.id, reason)
     
     # Выдаем предупреждение в БОТЕ за некорректную жалобу
-    add_bot_warn(complaint['user_id'], f"Некорректная жалоба: {reason}", message.from_user.id)
+    await add_bot_warn(complaint['user_id'], f"Некорректная жалоба: {reason}", message.from_user.id)
     
     # Получаем текущие предупреждения в боте
-    bot_warns = get_bot_warns(complaint['user_id'])
+    bot_warns = await get_bot_warns(complaint['user_id'])
     warn_count = len(bot_warns)
     
     # Проверяем, нужно ли блокировать пользователя в боте (3 или более предупреждений в боте)
     if warn_count >= 3:
-        block_user(complaint['user_id'], "3 предупреждения в боте за некорректные жалобы", message.from_user.id)
+        await block_user(complaint['user_id'], "3 предупреждения в боте за некорректные жалобы", message.from_user.id)
         block_message = "\n\n🚫 <b>Пользователь заблокирован в боте за 3 предупреждения!</b>"
     else:
         block_message = f"\n\n📊 <b>Текущее количество предупреждений в боте:</b> {warn_count}/3"
@@ -7286,7 +9605,7 @@ async def process_incorrect_report_reason(message: Message, state: FSMContext):
         f"📝 <b>Причина:</b> {reason}\n"
         f"📊 <b>Статус:</b> ✅ Предупреждение выдано{block_message}",
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
     
     await state.clear()
@@ -7307,7 +9626,7 @@ async def cmd_complaints(message: Message):
         await message.answer("❌ У вас нет прав для просмотра жалоб.")
         return
     
-    complaints = get_active_complaints()
+    complaints = await get_active_complaints()
     complaints_count = len(complaints)
     
     text = f"📋 <b>Активные жалобы на администраторов</b>\n\n"
@@ -7326,7 +9645,7 @@ async def cmd_complaints(message: Message):
     await message.answer(
         text,
         parse_mode="HTML",
-        reply_markup=get_complaints_keyboard()
+        reply_markup=await get_complaints_keyboard()
     )
 
 @dp.message(Command("my_bot_warns"))
@@ -7336,7 +9655,7 @@ async def cmd_my_bot_warns(message: Message):
         await message.answer("❌ Эта команда работает только в личных сообщениях с ботом.")
         return
     
-    bot_warns = get_bot_warns(message.from_user.id)
+    bot_warns = await get_bot_warns(message.from_user.id)
     
     if not bot_warns:
         await message.answer("✅ У вас нет активных предупреждений в боте.")
@@ -7373,7 +9692,7 @@ async def cmd_unblock(message: Message, command: CommandObject):
         await message.answer("❌ Пользователь не найден.")
         return
     
-    unblock_user(user_id)
+    await unblock_user(user_id)
     user_mention = await get_user_mention(user_id)
     
     await message.answer(
@@ -7547,7 +9866,7 @@ async def cmd_warn_v2(message: Message, command: CommandObject):
         return
     
     # Проверка роли (мл. модератор не может делать варны)
-    if not admin_can(message.from_user.id, "can_warn"):
+    if not await admin_can(message.from_user.id, "can_warn"):
         await message.answer(
             "❌ Ваша роль (<b>Мл. модератор</b>) не позволяет выдавать предупреждения.\n"
             "Минимальная роль для /warn — <b>Модератор</b>.",
@@ -7619,7 +9938,7 @@ async def cmd_unwarn_v2(message: Message, command: CommandObject):
         return
     
     # Получаем все активные варны
-    warns = get_user_warns(parsed['user_id'], message.chat.id)
+    warns = await get_user_warns(parsed['user_id'], message.chat.id)
     
     if not warns:
         user_mention = await get_user_mention(parsed['user_id'])
@@ -7628,7 +9947,7 @@ async def cmd_unwarn_v2(message: Message, command: CommandObject):
     
     # Удаляем последнее предупреждение
     last_warn = max(warns, key=lambda x: x['id'])
-    remove_warn(last_warn['id'])
+    await remove_warn(last_warn['id'])
     
     user_mention = await get_user_mention(parsed['user_id'])
     admin_mention = await get_user_mention(message.from_user.id)
@@ -7650,7 +9969,7 @@ async def cmd_mute_v2(message: Message, command: CommandObject):
         return
     
     # Проверка роли (все роли кроме полного отсутствия могут мутить)
-    if not admin_can(message.from_user.id, "can_mute"):
+    if not await admin_can(message.from_user.id, "can_mute"):
         await message.answer("❌ У вас нет прав для выдачи мута.", parse_mode="HTML")
         return
     
@@ -7688,7 +10007,7 @@ async def cmd_tmute_v2(message: Message, command: CommandObject):
         await auto_punish_non_admin(message)
         return
     
-    if not admin_can(message.from_user.id, "can_mute"):
+    if not await admin_can(message.from_user.id, "can_mute"):
         await message.answer("❌ У вас нет прав для выдачи мута.", parse_mode="HTML")
         return
     
@@ -7747,14 +10066,14 @@ async def cmd_unmute_v2(message: Message, command: CommandObject):
     await unmute_user(message.chat.id, parsed['user_id'], message.message_thread_id)
     
     # Деактивируем в БД
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE mutes SET is_active = FALSE WHERE user_id = %s AND chat_id = %s AND is_active = TRUE",
         (parsed['user_id'], message.chat.id)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
 @dp.message(Command("ban"))
 async def cmd_ban_v2(message: Message, command: CommandObject):
@@ -7764,8 +10083,8 @@ async def cmd_ban_v2(message: Message, command: CommandObject):
         return
     
     # Проверка роли (мл. модератор и модератор не могут банить)
-    if not admin_can(message.from_user.id, "can_ban"):
-        role = get_admin_role(message.from_user.id)
+    if not await admin_can(message.from_user.id, "can_ban"):
+        role = await get_admin_role(message.from_user.id)
         role_label = ADMIN_ROLES.get(role, {}).get("label", "вашей роли") if role else "вашей роли"
         await message.answer(
             f"❌ Роль <b>{role_label}</b> не позволяет выдавать баны.\n"
@@ -7808,8 +10127,8 @@ async def cmd_tban_v2(message: Message, command: CommandObject):
         await auto_punish_non_admin(message)
         return
     
-    if not admin_can(message.from_user.id, "can_ban"):
-        role = get_admin_role(message.from_user.id)
+    if not await admin_can(message.from_user.id, "can_ban"):
+        role = await get_admin_role(message.from_user.id)
         role_label = ADMIN_ROLES.get(role, {}).get("label", "вашей роли") if role else "вашей роли"
         await message.answer(
             f"❌ Роль <b>{role_label}</b> не позволяет выдавать баны.\n"
@@ -7873,14 +10192,14 @@ async def cmd_unban_v2(message: Message, command: CommandObject):
     await unban_user(message.chat.id, parsed['user_id'], message.message_thread_id)
     
     # Деактивируем в БД
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "UPDATE bans SET is_active = FALSE WHERE user_id = %s AND chat_id = %s AND is_active = TRUE",
         (parsed['user_id'], message.chat.id)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
 @dp.message(Command("amnist"))
 async def cmd_amnist(message: Message):
@@ -7896,14 +10215,14 @@ async def cmd_amnist(message: Message):
     )
 
     # Получаем список забаненных из БД
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT DISTINCT user_id FROM bans WHERE chat_id = %s AND is_active = TRUE",
         (message.chat.id,)
     )
-    banned_rows = cursor.fetchall()
-    conn.close()
+    banned_rows = await cursor.fetchall()
+    await conn.close()
 
     if not banned_rows:
         await status_msg.edit_text(
@@ -7923,26 +10242,26 @@ async def cmd_amnist(message: Message):
         parse_mode="HTML"
     )
 
-    for (user_id,) in banned_rows:
-        try:
-            await bot.unban_chat_member(message.chat.id, user_id, only_if_banned=True)
-            unbanned_ids.append(user_id)
-            success_count += 1
-        except Exception as e:
-            logger.warning(f"Амнистия: не удалось разбанить {user_id}: {e}")
-            fail_count += 1
-        await asyncio.sleep(0.05)  # небольшая пауза, чтобы не упереться в лимиты Telegram
+    with outbound_priority(PRIORITY_BULK):
+        for (user_id,) in banned_rows:
+            try:
+                await bot.unban_chat_member(message.chat.id, user_id, only_if_banned=True)
+                unbanned_ids.append(user_id)
+                success_count += 1
+            except Exception as e:
+                logger.warning(f"Амнистия: не удалось разбанить {user_id}: {e}")
+                fail_count += 1
 
     # Деактивируем все баны в БД для успешно разбаненных
     if unbanned_ids:
-        conn = get_db_connection()
+        conn = await get_db_connection()
         cursor = conn.cursor()
-        cursor.executemany(
+        await cursor.executemany(
             "UPDATE bans SET is_active = FALSE WHERE user_id = %s AND chat_id = %s AND is_active = TRUE",
             [(uid, message.chat.id) for uid in unbanned_ids]
         )
-        conn.commit()
-        conn.close()
+        await conn.commit()
+        await conn.close()
 
     # Итоговый отчёт
     issuer_mention = await get_user_mention(message.from_user.id)
@@ -7962,7 +10281,8 @@ async def cmd_amnist(message: Message):
         f"👮 <b>Инициатор:</b> {issuer_mention}\n"
         f"🔓 <b>Разбанено:</b> {success_count} из {total}\n"
         f"⚠️ <b>Ошибок:</b> {fail_count}\n"
-        f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+        f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+        kind="amnesty"
     )
 
 
@@ -7977,7 +10297,7 @@ async def cmd_public(message: Message):
         return
     
     # Проверяем, не заблокирован ли пользователь
-    if is_user_blocked(message.from_user.id):
+    if await is_user_blocked(message.from_user.id):
         await message.answer(
             "🚫 <b>Вы заблокированы в боте</b>\n\n"
             "Вы не можете использовать функции бота из-за нарушений правил.",
@@ -8042,19 +10362,15 @@ async def show_reviews_in_private(message: Message, seller_id: int):
     """Показывает отзывы о продавце в личных сообщениях"""
     
     # Получаем статистику
-    avg_rating, review_count = get_user_rating_stats(seller_id)
+    avg_rating, review_count = await get_user_rating_stats(seller_id)
     
     # Получаем отзывы
-    reviews = get_user_reviews(seller_id)
+    reviews = await get_user_reviews(seller_id)
     
     # Получаем информацию о продавце
-    try:
-        seller = await bot.get_chat(seller_id)
-        seller_name = seller.first_name or seller.username or str(seller_id)
-        seller_username = f"@{seller.username}" if seller.username else str(seller_id)
-    except:
-        seller_name = str(seller_id)
-        seller_username = str(seller_id)
+    seller = await PROFILES.get(seller_id)
+    seller_name = seller.display_name if seller else str(seller_id)
+    seller_username = f"@{seller.username}" if seller and seller.username else str(seller_id)
     
     # Формируем текст
     stars = "⭐" * int(avg_rating) + "½" * (avg_rating % 1 >= 0.5)
@@ -8066,12 +10382,9 @@ async def show_reviews_in_private(message: Message, seller_id: int):
     
     if reviews:
         text += "<b>Отзывы:</b>\n"
+        profiles = await PROFILES.get_many([r['from_user_id'] for r in reviews[:10]])
         for i, review in enumerate(reviews[:10], 1):  # Показываем последние 10 отзывов
-            try:
-                from_user = await bot.get_chat(review['from_user_id'])
-                from_name = from_user.first_name or from_user.username or str(review['from_user_id'])
-            except:
-                from_name = str(review['from_user_id'])
+            from_name = profile_name(profiles, review['from_user_id'])
             
             stars_review = "⭐" * review['rating']
             text += f"\n{i}. {stars_review} от {from_name}:\n"
@@ -8085,7 +10398,7 @@ async def show_reviews_in_private(message: Message, seller_id: int):
     
     # Проверяем, может ли пользователь оставить отзыв
     if message.from_user.id != seller_id:
-        existing = get_user_review_from_user(message.from_user.id, seller_id)
+        existing = await get_user_review_from_user(message.from_user.id, seller_id)
         if not existing:
             keyboard.row(
                 InlineKeyboardButton(
@@ -8114,7 +10427,7 @@ async def start_leave_review(callback: types.CallbackQuery, state: FSMContext):
         return
     
     # Проверяем, не оставлял ли уже отзыв
-    existing = get_user_review_from_user(callback.from_user.id, target_user_id)
+    existing = await get_user_review_from_user(callback.from_user.id, target_user_id)
     if existing:
         await callback.answer("❌ Вы уже оставляли отзыв этому пользователю")
         return
@@ -8138,7 +10451,7 @@ async def start_leave_review_ls(callback: types.CallbackQuery, state: FSMContext
         return
     
     # Проверяем, не оставлял ли уже отзыв
-    existing = get_user_review_from_user(callback.from_user.id, target_user_id)
+    existing = await get_user_review_from_user(callback.from_user.id, target_user_id)
     if existing:
         await callback.answer("❌ Вы уже оставляли отзыв этому пользователю")
         return
@@ -8181,16 +10494,13 @@ async def process_review_text(message: Message, state: FSMContext):
     rating = data['rating']
     
     # Сохраняем отзыв
-    add_user_review(message.from_user.id, target_user_id, rating, review_text)
+    await add_user_review(message.from_user.id, target_user_id, rating, review_text)
     
     # Получаем обновленную статистику
-    avg_rating, review_count = get_user_rating_stats(target_user_id)
+    avg_rating, review_count = await get_user_rating_stats(target_user_id)
     
-    try:
-        target_user = await bot.get_chat(target_user_id)
-        target_name = target_user.first_name or target_user.username or str(target_user_id)
-    except:
-        target_name = str(target_user_id)
+    target_user = await PROFILES.get(target_user_id)
+    target_name = target_user.display_name if target_user else str(target_user_id)
     
     await message.answer(
         f"✅ <b>Отзыв оставлен!</b>\n\n"
@@ -8207,17 +10517,16 @@ async def process_review_text(message: Message, state: FSMContext):
 
 async def show_user_reviews_after_review(message: Message, target_user_id: int):
     """Показывает профиль после оставления отзыва"""
-    avg_rating, review_count = get_user_rating_stats(target_user_id)
-    reviews = get_user_reviews(target_user_id)
+    avg_rating, review_count = await get_user_rating_stats(target_user_id)
+    reviews = await get_user_reviews(target_user_id)
     
     if target_user_id == message.from_user.id:
         title = "👤 <b>Ваш профиль</b>"
     else:
-        try:
-            user = await bot.get_chat(target_user_id)
-            name = user.first_name or user.username or str(target_user_id)
-            title = f"👤 <b>Профиль пользователя {name}</b>"
-        except:
+        user = await PROFILES.get(target_user_id)
+        if user:
+            title = f"👤 <b>Профиль пользователя {user.display_name}</b>"
+        else:
             title = f"👤 <b>Профиль пользователя</b>"
     
     stars = "⭐" * int(avg_rating) + "½" * (avg_rating % 1 >= 0.5)
@@ -8229,12 +10538,9 @@ async def show_user_reviews_after_review(message: Message, target_user_id: int):
     
     if reviews:
         text += "<b>Последние отзывы:</b>\n"
+        profiles = await PROFILES.get_many([r['from_user_id'] for r in reviews[:5]])
         for review in reviews[:5]:
-            try:
-                from_user = await bot.get_chat(review['from_user_id'])
-                from_name = from_user.first_name or from_user.username or str(review['from_user_id'])
-            except:
-                from_name = str(review['from_user_id'])
+            from_name = profile_name(profiles, review['from_user_id'])
             
             stars_review = "⭐" * review['rating']
             text += f"\n• {stars_review} от {from_name}:\n  {review['review_text'][:50]}...\n"
@@ -8242,7 +10548,7 @@ async def show_user_reviews_after_review(message: Message, target_user_id: int):
     await message.answer(
         text,
         parse_mode="HTML",
-        reply_markup=get_user_reviews_keyboard(target_user_id, message.from_user.id)
+        reply_markup=await get_user_reviews_keyboard(target_user_id, message.from_user.id)
     )
 
 @dp.callback_query(F.data == "cancel_review")
@@ -8290,10 +10596,10 @@ async def cmd_profile(message: Message):
     user_id = message.from_user.id
     
     # Получаем статистику
-    avg_rating, review_count = get_user_rating_stats(user_id)
+    avg_rating, review_count = await get_user_rating_stats(user_id)
     
     # Получаем отзывы
-    reviews = get_user_reviews(user_id)
+    reviews = await get_user_reviews(user_id)
     
     # Получаем статистику объявлений
     ads = get_user_ads(user_id)
@@ -8316,12 +10622,9 @@ async def cmd_profile(message: Message):
     
     if reviews:
         text += "<b>Ваши последние отзывы:</b>\n"
+        profiles = await PROFILES.get_many([r['from_user_id'] for r in reviews[:3]])
         for review in reviews[:3]:
-            try:
-                from_user = await bot.get_chat(review['from_user_id'])
-                from_name = from_user.first_name or from_user.username or str(review['from_user_id'])
-            except:
-                from_name = str(review['from_user_id'])
+            from_name = profile_name(profiles, review['from_user_id'])
             
             stars_review = "⭐" * review['rating']
             text += f"\n• {stars_review} от {from_name}:\n  {review['review_text'][:50]}...\n"
@@ -8341,10 +10644,10 @@ async def my_profile_callback(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     
     # Получаем статистику
-    avg_rating, review_count = get_user_rating_stats(user_id)
+    avg_rating, review_count = await get_user_rating_stats(user_id)
     
     # Получаем отзывы
-    reviews = get_user_reviews(user_id)
+    reviews = await get_user_reviews(user_id)
     
     # Получаем статистику объявлений
     ads = get_user_ads(user_id)
@@ -8367,12 +10670,9 @@ async def my_profile_callback(callback: types.CallbackQuery):
     
     if reviews:
         text += "<b>Ваши последние отзывы:</b>\n"
+        profiles = await PROFILES.get_many([r['from_user_id'] for r in reviews[:3]])
         for review in reviews[:3]:
-            try:
-                from_user = await bot.get_chat(review['from_user_id'])
-                from_name = from_user.first_name or from_user.username or str(review['from_user_id'])
-            except:
-                from_name = str(review['from_user_id'])
+            from_name = profile_name(profiles, review['from_user_id'])
             
             stars_review = "⭐" * review['rating']
             text += f"\n• {stars_review} от {from_name}:\n  {review['review_text'][:50]}...\n"
@@ -8484,7 +10784,7 @@ async def adm_product_more_photos(message: Message, state: FSMContext):
         # Формируем итоговое описание с ценой
         full_description = f"💰 Цена: {price}\n{description}" if price else description
 
-        product_id = add_product_to_db(
+        product_id = await add_product_to_db(
             category=category,
             name=name,
             description=full_description,
@@ -8555,26 +10855,13 @@ async def handle_message(message: Message):
     user_id = message.from_user.id
 
     text = message.text or message.caption or ""
-    text_lower = text.lower()
-
-    # Проверка на запрещенные слова (УСВ) - исправленная логика
-    has_trigger_word = False
-    found_word = None
-    
-    for trigger_word, variants in TRIGGER_WORDS.items():
-        for variant in variants:
-            # Ищем вхождение варианта как отдельного слова или части слова
-            # Используем поиск подстроки с учетом границ слов
-            pattern = r'\b' + re.escape(variant) + r'\w*'
-            if re.search(pattern, text_lower):
-                has_trigger_word = True
-                found_word = variant
-                logger.info(f"Найдено триггерное слово '{variant}' в сообщении: {text}")
-                break
-        if has_trigger_word:
-            break
+
+    # Проверка на запрещенные слова (УСВ) — один проход по тексту
+    trigger = TRIGGER_MATCHER.find(text)
     
-    if has_trigger_word:
+    if trigger:
+        found_word = trigger[1]
+        logger.info(f"Найдено триггерное слово '{found_word}' в сообщении: {text}")
         # Удаляем сообщение с запрещенным словом
         await delete_message(message.chat.id, message.message_id)
         
@@ -8590,10 +10877,20 @@ async def handle_message(message: Message):
             f"👤 <b>Пользователь:</b> {user_mention_log}\n"
             f"🆔 <b>ID:</b> <code>{user_id}</code>\n"
             f"🔤 <b>Слово:</b> <code>{found_word}</code>\n"
-            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}"
+            f"🕐 <b>Время:</b> {get_moscow_time().strftime('%d.%m.%Y %H:%M:%S')}",
+            kind="trigger", user_id=user_id
         )
         return
 
+    # Флуд и спам (в памяти, микросекунды на сообщение)
+    if text and await enforce_flood(message, text):
+        return
+
+    # Лимит объявлений (в памяти, без запросов к БД для разрешённых объявлений)
+    if not text.startswith('/') and counts_toward_ad_limits(text):
+        if await enforce_ad_limits(message, text):
+            return
+
     # Автоматическое удаление команд бота от обычных пользователей
     if text.startswith('/'):
         # Список команд этого бота для которых нужно наказывать
@@ -8602,7 +10899,8 @@ async def handle_message(message: Message):
             '/ban', '/tban', '/unban', '/cc', '/admin_add', '/admin_remove', '/admin_quest',
             '/admin_list', '/admin_warn', '/awarn', '/admin_unwarn', 
             '/admin_warns', '/check_admin', '/ban_info', '/stats',
-            '/complaints', '/unblock'
+            '/complaints', '/unblock', '/trigger_add', '/trigger_del', '/triggers',
+            '/dispatch_stats', '/ads_rescore', '/raid'
         ]
         
         # Проверяем, является ли команда командой этого бота
@@ -8638,6 +10936,20 @@ async def handle_my_chat_member(update: ChatMemberUpdated):
     elif new_status == ChatMemberStatus.ADMINISTRATOR:
         logger.info(f"Бот получил права администратора в чате {update.chat.id}")
 
+# Апдейты chat_member — держат кэш статусов участников в актуальном состоянии
+@dp.chat_member()
+async def handle_chat_member(update: ChatMemberUpdated):
+    """Обновляет CHAT_MEMBERS при любом изменении статуса участника (назначение
+    админом, мут, бан, выход из чата и т.д.)"""
+    CHAT_MEMBERS.set(update.chat.id, update.new_chat_member.user.id, update.new_chat_member.status)
+    joined = (
+        update.old_chat_member.status in (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED)
+        and update.new_chat_member.status in (ChatMemberStatus.MEMBER, ChatMemberStatus.RESTRICTED)
+    )
+    if joined and update.chat.id == CHAT_ID and RAID.on_join(update.new_chat_member.user.id):
+        logger.warning("Всплеск входов в чат — включён рейд-режим")
+        await announce_raid()
+
 # Обработчик новых участников
 
 
@@ -8648,29 +10960,21 @@ async def cleanup_expired_data():
         conn = None
         had_error = False
         try:
-            conn = get_db_connection()
+            conn = await get_db_connection()
             cursor = conn.cursor()
             
             # Используем московское время для очистки
             current_time = get_moscow_time()
             
-            # Очищаем истекшие варны
-            cursor.execute("DELETE FROM warns WHERE expires_at <= %s", (current_time,))
-            
-            # Деактивируем истекшие муты
-            cursor.execute(
-                "UPDATE mutes SET is_active = FALSE WHERE expires_at <= %s AND is_active = TRUE",
-                (current_time,)
-            )
-            
-            # Деактивируем истекшие баны
-            cursor.execute(
-                "UPDATE bans SET is_active = FALSE WHERE expires_at <= %s AND is_active = TRUE",
-                (current_time,)
-            )
-            
+            # Отпечатки объявлений старше окна повторов
+            AD_FINGERPRINTS.prune(time.time())
+            FLOOD_DETECTOR.prune(time.monotonic())
+
+            # Очищаем истекшие варны (история остаётся в moderation_events;
+            # муты и баны снимает по сроку EXPIRIES)
+            await cursor.execute("DELETE FROM warns WHERE expires_at <= %s", (current_time,))
             
-            conn.commit()
+            await conn.commit()
             
             logger.info("Очистка устаревших данных выполнена")
         except Exception as e:
@@ -8679,10 +10983,237 @@ async def cleanup_expired_data():
         finally:
             # Соединение обязательно возвращается в пул при любом исходе
             if conn is not None:
-                conn.close()
+                await conn.close()
 
         await asyncio.sleep(300 if had_error else 3600)
 
+# ============================================================
+#          ХРАНЕНИЕ ДАННЫХ: СЕКЦИИ, АРХИВ И ОЧИСТКА
+# ============================================================
+# Для каждой растущей таблицы задана политика хранения (RETENTION_POLICIES).
+# Журналы с чистым добавлением (user_ads, moderation_events, mod_events)
+# секционированы помесячно по времени: init_db один раз переводит обычную
+# таблицу в секционированную, а retention_loop раз в сутки создаёт секции
+# наперёд и удаляет секции старше срока хранения: сначала секция
+# выгружается в gzip-CSV (RETENTION_ARCHIVE_DIR), затем отсоединяется и
+# удаляется целиком в одной транзакции, без DELETE и последующего VACUUM.
+# В таблицах с состоянием (муты, баны, жалобы, сессии) строки удаляются
+# пачками по RETENTION_DELETE_BATCH, чтобы не держать долгих блокировок;
+# выгрузка пачки и её удаление — одна команда COPY (DELETE … RETURNING *).
+# История таких строк остаётся в moderation_events.
+
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "data/archive")
+RETENTION_INTERVAL = 24 * 3600      # секунд между проходами
+RETENTION_FIRST_DELAY = 600         # секунд после старта до первого прохода
+RETENTION_DELETE_BATCH = 5000
+PARTITION_MONTHS_AHEAD = 2
+
+
+class RetentionPolicy:
+    __slots__ = ("table", "column", "keep", "where", "partitioned", "archive")
+
+    def __init__(self, table: str, column: str, keep: timedelta, where: str = None,
+                 partitioned: bool = False, archive: bool = False):
+        self.table = table
+        self.column = column
+        self.keep = keep
+        self.where = where
+        self.partitioned = partitioned
+        self.archive = archive
+
+
+RETENTION_POLICIES = [
+    RetentionPolicy("user_ads", "sent_at", timedelta(days=90), partitioned=True, archive=True),
+    RetentionPolicy("moderation_events", "created_at", timedelta(days=730), partitioned=True, archive=True),
+    RetentionPolicy("mod_events", "created_at", timedelta(days=90), partitioned=True),
+    RetentionPolicy("mutes", "issued_at", timedelta(days=180), where="is_active = FALSE", archive=True),
+    RetentionPolicy("bans", "issued_at", timedelta(days=180), where="is_active = FALSE", archive=True),
+    RetentionPolicy("user_reports", "created_at", timedelta(days=180), where="status <> 'pending'", archive=True),
+    RetentionPolicy("ad_limit_violations", "violation_date", timedelta(days=30)),
+    RetentionPolicy("periodic_messages", "sent_at", timedelta(days=7)),
+    RetentionPolicy("admin_sessions", "expires_at", timedelta(0)),
+    RetentionPolicy("user_sessions", "expires_at", timedelta(0)),
+]
+
+
+def _month_start(moment: datetime, shift: int = 0) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + shift
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+async def _create_partitions(cursor, table: str, since: datetime, until: datetime):
+    """Создаёт помесячные секции, покрывающие [since, until]."""
+    month = _month_start(since)
+    while month <= until:
+        following = _month_start(month, 1)
+        await cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {table}_p{month:%Y%m} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"
+        )
+        month = following
+
+
+async def ensure_partitioned(cursor, table: str, column: str):
+    """Переводит обычную таблицу в секционированную по месяцам column
+    (вызывается из init_db; для уже секционированной ничего не делает)."""
+    await cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = await cursor.fetchone()
+    if not row or row[0] != "r":
+        return
+    logger.info(f"Секционирование {table} по {column}...")
+    await cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> %s",
+        (table, f"{table}_pkey")
+    )
+    index_defs = [r[0] for r in await cursor.fetchall()]
+    await cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", (table,))
+    sequence = (await cursor.fetchone())[0]
+
+    legacy = f"{table}_legacy"
+    await cursor.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    await cursor.execute(f"UPDATE {legacy} SET {column} = CURRENT_TIMESTAMP WHERE {column} IS NULL")
+    await cursor.execute(f"CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE ({column})")
+    await cursor.execute(f"ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL")
+    await cursor.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, {column})")
+    # Страховка: строка с датой вне созданных секций не должна ронять INSERT
+    await cursor.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+    await cursor.execute(f"SELECT MIN({column}) FROM {legacy}")
+    oldest = (await cursor.fetchone())[0] or datetime.now()
+    await _create_partitions(cursor, table, oldest, _month_start(datetime.now(), PARTITION_MONTHS_AHEAD))
+    await cursor.execute(f"INSERT INTO {table} SELECT * FROM {legacy}")
+    if sequence:
+        await cursor.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    await cursor.execute(f"DROP TABLE {legacy}")
+    for index_def in index_defs:
+        await cursor.execute(index_def.replace("CREATE INDEX", "CREATE INDEX IF NOT EXISTS", 1))
+
+
+async def _open_archive(name: str):
+    """Создаёт файл gzip-CSV в RETENTION_ARCHIVE_DIR; возвращает (путь, файл)."""
+    os.makedirs(RETENTION_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(RETENTION_ARCHIVE_DIR, f"{name}_{datetime.now():%Y%m%d_%H%M%S}.csv.gz")
+    return path, await asyncio.to_thread(gzip.open, path, "wb")
+
+
+async def _copy_out(cursor, archive, query: str, params=(), header: bool = True) -> int:
+    """Дописывает результат query в открытый архив; возвращает число строк."""
+    options = "FORMAT csv, HEADER" if header else "FORMAT csv"
+    async with cursor.copy(f"COPY ({query}) TO STDOUT WITH ({options})", params) as copy:
+        async for chunk in copy:
+            await asyncio.to_thread(archive.write, chunk)
+    # Данные — на диск до COMMIT удаления
+    await asyncio.to_thread(archive.flush)
+    return cursor.rowcount
+
+
+async def _archive(cursor, name: str, query: str, params=()) -> str:
+    """Выгружает результат query в gzip-CSV; возвращает путь к файлу.
+    Неполный файл при ошибке удаляется."""
+    path, archive = await _open_archive(name)
+    try:
+        await _copy_out(cursor, archive, query, params)
+    except Exception:
+        await asyncio.to_thread(archive.close)
+        os.remove(path)
+        raise
+    await asyncio.to_thread(archive.close)
+    return path
+
+
+async def _drop_old_partitions(conn, policy: RetentionPolicy, cutoff: datetime) -> int:
+    cursor = conn.cursor()
+    await cursor.execute(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(%s) ORDER BY c.relname",
+        (policy.table,)
+    )
+    dropped = 0
+    for (name,) in await cursor.fetchall():
+        match = re.fullmatch(rf"{policy.table}_p(\d{{4}})(\d{{2}})", name)
+        if not match or _month_start(datetime(int(match[1]), int(match[2]), 1), 1) > cutoff:
+            continue
+        # Сначала архив: если выгрузка не удалась, секция остаётся на месте
+        # и будет выгружена при следующем проходе
+        if policy.archive:
+            path = await _archive(cursor, name, f"SELECT * FROM {name}")
+            await conn.commit()
+            logger.info(f"Секция {name} выгружена в {path}")
+        await cursor.execute(f"ALTER TABLE {policy.table} DETACH PARTITION {name}")
+        await cursor.execute(f"DROP TABLE {name}")
+        await conn.commit()
+        dropped += 1
+    return dropped
+
+
+async def _delete_expired_rows(conn, policy: RetentionPolicy, cutoff: datetime) -> int:
+    cursor = conn.cursor()
+    condition = f"{policy.column} < %s" + (f" AND {policy.where}" if policy.where else "")
+    delete_batch = (
+        f"DELETE FROM {policy.table} WHERE ctid = ANY(ARRAY("
+        f"SELECT ctid FROM {policy.table} WHERE {condition} LIMIT %s))"
+    )
+    deleted = 0
+    if not policy.archive:
+        while True:
+            await cursor.execute(delete_batch, (cutoff, RETENTION_DELETE_BATCH))
+            await conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < RETENTION_DELETE_BATCH:
+                return deleted
+
+    await cursor.execute(f"SELECT 1 FROM {policy.table} WHERE {condition} LIMIT 1", (cutoff,))
+    if not await cursor.fetchone():
+        return 0
+    # Пачка удаляется той же командой, что её выгружает: строка, которой
+    # нет в архиве, не может быть удалена. При сбое транзакция откатывается,
+    # и строки незавершённой пачки попадут в архив ещё раз при следующем проходе
+    path, archive = await _open_archive(policy.table)
+    try:
+        while True:
+            count = await _copy_out(
+                cursor, archive, f"{delete_batch} RETURNING *",
+                (cutoff, RETENTION_DELETE_BATCH), header=deleted == 0
+            )
+            await conn.commit()
+            deleted += count
+            if count < RETENTION_DELETE_BATCH:
+                break
+    finally:
+        await asyncio.to_thread(archive.close)
+    logger.info(f"Устаревшие строки {policy.table} ({deleted}) выгружены в {path}")
+    return deleted
+
+
+async def apply_retention():
+    """Один проход по RETENTION_POLICIES."""
+    now = datetime.now()
+    for policy in RETENTION_POLICIES:
+        cutoff = now - policy.keep
+        conn = await get_db_connection()
+        try:
+            if policy.partitioned:
+                cursor = conn.cursor()
+                await _create_partitions(cursor, policy.table, now, _month_start(now, PARTITION_MONTHS_AHEAD))
+                await conn.commit()
+                dropped = await _drop_old_partitions(conn, policy, cutoff)
+                if dropped:
+                    logger.info(f"Хранение {policy.table}: удалено секций: {dropped}")
+            else:
+                deleted = await _delete_expired_rows(conn, policy, cutoff)
+                if deleted:
+                    logger.info(f"Хранение {policy.table}: удалено строк: {deleted}")
+        except Exception as e:
+            logger.error(f"Ошибка политики хранения {policy.table}: {e}")
+        finally:
+            await conn.close()
+
+
+async def retention_loop():
+    await asyncio.sleep(RETENTION_FIRST_DELAY)
+    while True:
+        await apply_retention()
+        await asyncio.sleep(RETENTION_INTERVAL)
+
 # ============================================================
 #         ЕЖЕДНЕВНАЯ РАССЫЛКА ПРАВИЛ / ЗАКАЗОВ / ЖАЛОБ
 # ============================================================
@@ -8819,20 +11350,20 @@ DAILY_SAFE_DEAL_TEXT = """🔐 Безопасные сделки
 async def _do_send_info():
     """Отправляет правила, заказы, жалобы и инфо о сделках в чат.
     Перед отправкой удаляет предыдущие сообщения рассылки."""
-    conn = get_db_connection()
+    conn = await get_db_connection()
 
     cursor = conn.cursor()
 
     # Удаляем предыдущие сообщения рассылки
-    cursor.execute("SELECT message_id FROM periodic_messages WHERE chat_id = %s", (CHAT_ID,))
-    old_ids = cursor.fetchall()
+    await cursor.execute("SELECT message_id FROM periodic_messages WHERE chat_id = %s", (CHAT_ID,))
+    old_ids = await cursor.fetchall()
     for (msg_id,) in old_ids:
         try:
             await bot.delete_message(chat_id=CHAT_ID, message_id=msg_id)
         except Exception as e:
             logger.warning(f"Не удалось удалить старое сообщение {msg_id}: {e}")
-    cursor.execute("DELETE FROM periodic_messages WHERE chat_id = %s", (CHAT_ID,))
-    conn.commit()
+    await cursor.execute("DELETE FROM periodic_messages WHERE chat_id = %s", (CHAT_ID,))
+    await conn.commit()
 
     # Отправляем новые сообщения и сохраняем их ID
     new_ids = []
@@ -8844,18 +11375,17 @@ async def _do_send_info():
                 disable_web_page_preview=True
             )
             new_ids.append(sent.message_id)
-            await asyncio.sleep(1)
         except Exception as e:
             logger.error(f"Ошибка при отправке периодического сообщения: {e}")
 
     # Сохраняем новые ID
     for msg_id in new_ids:
-        cursor.execute(
+        await cursor.execute(
             "INSERT INTO periodic_messages (message_id, chat_id) VALUES (%s, %s)",
             (msg_id, CHAT_ID)
         )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     logger.info(f"Периодическая рассылка успешно отправлена, сохранено {len(new_ids)} ID сообщений")
 
 
@@ -8940,17 +11470,17 @@ def get_category_keyboard(cat_index: int):
     return builder.as_markup()
 
 
-def get_product_list_for_delete(cat_index: int):
+async def get_product_list_for_delete(cat_index: int):
     """Inline-клавиатура со списком товаров для удаления"""
     category = PRODUCT_CATEGORIES[cat_index]
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT id, name FROM shop_products WHERE category = %s AND is_active = 1 ORDER BY id DESC",
         (category,)
     )
-    products = cursor.fetchall()
-    conn.close()
+    products = await cursor.fetchall()
+    await conn.close()
     builder = InlineKeyboardBuilder()
     if products:
         for prod_id, prod_name in products:
@@ -8969,34 +11499,34 @@ def get_product_list_for_delete(cat_index: int):
 # 2. GET /api/product-photo/{product_id}/{photo_index} — отдавать фото по индексу из shop_product_photos
 #    (ранее был только /api/product-photo/{product_id} — он остаётся для совместимости, отдаёт фото с sort_order=0)
 
-def add_product_to_db(category: str, name: str, description: str, photo_file_id: str, added_by: int, extra_photos: list = None) -> int:
+async def add_product_to_db(category: str, name: str, description: str, photo_file_id: str, added_by: int, extra_photos: list = None) -> int:
     """Добавляет товар в БД и возвращает его ID. extra_photos — список доп. file_id."""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "INSERT INTO shop_products (category, name, description, photo_file_id, added_by) VALUES (%s, %s, %s, %s, %s) RETURNING id",
         (category, name, description, photo_file_id, added_by)
     )
-    product_id = cursor.fetchone()["id"]
+    product_id = (await cursor.fetchone())["id"]
     # Сохраняем все фото в отдельную таблицу (первое + доп.)
     all_photos = [photo_file_id] + (extra_photos or [])
     for i, fid in enumerate(all_photos):
-        cursor.execute(
+        await cursor.execute(
             "INSERT INTO shop_product_photos (product_id, file_id, sort_order) VALUES (%s, %s, %s)",
             (product_id, fid, i)
         )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     return product_id
 
 
-def delete_product_from_db(product_id: int):
+async def delete_product_from_db(product_id: int):
     """Мягкое удаление товара"""
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("UPDATE shop_products SET is_active = 0 WHERE id = %s", (product_id,))
-    conn.commit()
-    conn.close()
+    await cursor.execute("UPDATE shop_products SET is_active = 0 WHERE id = %s", (product_id,))
+    await conn.commit()
+    await conn.close()
 
 
 
@@ -9043,14 +11573,14 @@ async def adm_category(callback: CallbackQuery):
     cat_index = int(callback.data.split(":")[2])
     category = PRODUCT_CATEGORIES[cat_index]
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute(
+    await cursor.execute(
         "SELECT COUNT(*) AS c FROM shop_products WHERE category = %s AND is_active = 1",
         (category,)
     )
-    count = cursor.fetchone()["c"]
-    conn.close()
+    count = (await cursor.fetchone())["c"]
+    await conn.close()
 
     await callback.message.edit_text(
         f"📂 <b>{category}</b>\n\n"
@@ -9090,7 +11620,7 @@ async def adm_delete_product_list(callback: CallbackQuery):
         return
     cat_index = int(callback.data.split(":")[2])
     category = PRODUCT_CATEGORIES[cat_index]
-    kb, count = get_product_list_for_delete(cat_index)
+    kb, count = await get_product_list_for_delete(cat_index)
 
     if count == 0:
         await callback.answer("В этой категории нет товаров.", show_alert=True)
@@ -9114,21 +11644,21 @@ async def adm_delete_confirm(callback: CallbackQuery):
     product_id = int(parts[2])
     cat_index = int(parts[3])
 
-    conn = get_db_connection()
+    conn = await get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT name FROM shop_products WHERE id = %s", (product_id,))
-    row = cursor.fetchone()
-    conn.close()
+    await cursor.execute("SELECT name FROM shop_products WHERE id = %s", (product_id,))
+    row = await cursor.fetchone()
+    await conn.close()
 
     if not row:
         await callback.answer("Товар не найден.", show_alert=True)
         return
 
-    delete_product_from_db(product_id)
+    await delete_product_from_db(product_id)
     await callback.answer(f"✅ Товар «{row[0]}» удалён.", show_alert=True)
 
     # Обновляем список
-    kb, count = get_product_list_for_delete(cat_index)
+    kb, count = await get_product_list_for_delete(cat_index)
     if count == 0:
         await callback.message.edit_text(
             f"📂 <b>{PRODUCT_CATEGORIES[cat_index]}</b>\n\nВсе товары удалены.",
@@ -9139,31 +11669,246 @@ async def adm_delete_confirm(callback: CallbackQuery):
         await callback.message.edit_reply_markup(reply_markup=kb)
 
 
+# ============================================================
+#             ПОРЯДОК ОБРАБОТКИ АПДЕЙТОВ
+# ============================================================
+# Апдейты обрабатываются конкурентно (polling — каждый апдейт отдельной
+# задачей, webhook — пулом воркеров), но апдейты одного пользователя в одном
+# чате — строго по очереди: OrderedDispatcher.feed_update берёт блокировку по
+# ключу (chat_id, user_id) раньше, чем aiogram загрузит состояние FSM. Блокировки asyncio.Lock отдаются в порядке ожидания,
+# а задачи встают в очередь в порядке поступления апдейтов.
+# Поэтому обработчики не должны «спать»: «удалить через N секунд» ставится
+# в DEFERRED_DELETIONS (переживает перезапуск), остальное — фоновые циклы.
+
+
+def update_key(update: Update) -> Tuple[int, int]:
+    """(chat_id, user_id) апдейта — ключ упорядочивания."""
+    if update.message:
+        user = update.message.from_user
+        return update.message.chat.id, user.id if user else 0
+    if update.callback_query:
+        query = update.callback_query
+        chat_id = query.message.chat.id if query.message else query.from_user.id
+        return chat_id, query.from_user.id
+    if update.chat_member:
+        return update.chat_member.chat.id, update.chat_member.new_chat_member.user.id
+    if update.my_chat_member:
+        return update.my_chat_member.chat.id, update.my_chat_member.from_user.id
+    return 0, update.update_id
+
+
+class KeyedSerializer:
+    def __init__(self):
+        # ключ → [блокировка, число ожидающих + выполняющийся]
+        self._entries: Dict[Any, list] = {}
+        self.max_depth_seen = 0
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.max_depth_seen = max(self.max_depth_seen, entry[1])
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        depths = [entry[1] for entry in self._entries.values()]
+        return {
+            "active_keys": len(depths),
+            "waiting": sum(d - 1 for d in depths),
+            "max_depth": max(depths, default=0),
+            "max_depth_seen": self.max_depth_seen,
+        }
+
+
+UPDATE_SERIALIZER = KeyedSerializer()
+
+
+# ============================================================
+#         ПРИЁМ АПДЕЙТОВ ЧЕРЕЗ WEBHOOK (альтернатива polling)
+# ============================================================
+# BOT_MODE=webhook: aiohttp-сервер принимает апдейты от Telegram, проверяет
+# секретный токен, кладёт апдейт в общую очередь и сразу отвечает 200.
+# Апдейты разбирает пул воркеров; порядок внутри (чат, пользователь)
+# обеспечивает OrderedDispatcher, поэтому медленный обработчик
+# задерживает только апдейты своего ключа.
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")              # публичный https://.../tg/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "32"))
+UPDATE_QUEUE_SIZE = 5000  # при переполнении приём ждёт (Telegram повторит позже)
+
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member", "my_chat_member"]
+
+
+class UpdateWorkerPool:
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def submit(self, update: Update):
+        await self._queue.put(update)
+
+    async def _work(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def stop(self):
+        """Дожидается обработки уже принятых апдейтов и останавливает воркеры."""
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+
+
+UPDATE_POOL: Optional[UpdateWorkerPool] = None
+
+
+async def run_webhook():
+    global UPDATE_POOL
+    pool = UPDATE_POOL = UpdateWorkerPool(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+    pool.start()
+
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if WEBHOOK_SECRET and not secrets.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+        try:
+            update = Update(**await request.json())
+        except Exception as e:
+            logger.warning(f"Webhook: некорректный апдейт: {e}")
+            return web.Response(status=400)
+        await pool.submit(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=ALLOWED_UPDATES,
+        max_connections=100,
+    )
+    logger.info(f"Webhook: слушаю {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {UPDATE_WORKERS}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # Сначала перестаём принимать, потом дорабатываем очередь
+        await runner.cleanup()
+        await pool.stop()
+
+
 # Основная функция
 async def main():
     logger.info("Запуск бота...")
+
+    # set_webhook("") молча снимает webhook — без адреса бот не получит ни одного апдейта
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook, но WEBHOOK_URL не задан")
+
+    # Схема БД (асинхронно — пул создаётся внутри уже запущенного event loop)
+    await init_db()
     
     # Получаем username бота
     await set_bot_username()
+
+    # Триггерные слова из БД (добавленные владельцами)
+    await load_trigger_words()
     
-    # Восстанавливаем активные наказания
+    # Предзагружаем администраторов чата в кэш статусов участников
+    try:
+        count = await CHAT_MEMBERS.preload_admins(CHAT_ID)
+        logger.info(f"Кэш участников: загружено {count} администраторов чата {CHAT_ID}")
+    except Exception as e:
+        logger.error(f"Не удалось загрузить администраторов чата {CHAT_ID}: {e}")
+
+    # Восстанавливаем активные наказания в фоне — polling не ждёт
     logger.info("Восстановление активных наказаний...")
-    await restore_active_punishments()
+    asyncio.create_task(restore_active_punishments())
     
+    # Кэш администраторов и подписка на его изменения
+    await ADMIN_REGISTRY.reload()
+    asyncio.create_task(listen_admin_changes())
+    asyncio.create_task(refresh_admin_registry_periodically())
+
     # Запускаем фоновые задачи
     asyncio.create_task(cleanup_expired_data())
-    asyncio.create_task(monitor_expired_punishments())
+    # Сроки мутов/банов: куча из БД + сверка
+    count = await EXPIRIES.reload()
+    logger.info(f"Запланировано снятие наказаний: {count}")
+    asyncio.create_task(EXPIRIES.run())
+    asyncio.create_task(EXPIRIES.reconcile_periodically())
     asyncio.create_task(send_periodic_info())
+    asyncio.create_task(raid_auto_loop())
+    asyncio.create_task(retention_loop())
+
+    # Объявления за последние сутки — для лимитов
+    count = await AD_LIMITER.load()
+    logger.info(f"Лимит объявлений: загружено {count} объявлений за сутки")
+    count = await load_ad_fingerprints()
+    logger.info(f"Отпечатки объявлений: загружено {count}")
+
+    # Отложенные удаления, не выполненные до перезапуска
+    count = await DEFERRED_DELETIONS.load()
+    if count:
+        logger.info(f"Отложенных удалений из БД: {count}")
+    asyncio.create_task(DEFERRED_DELETIONS.run())
+
+    # Продолжаем рассылки, прерванные перезапуском
+    resumed = await BROADCASTS.resume_all()
+    if resumed:
+        logger.info(f"Продолжено рассылок: {resumed}")
     
     # Регистрируем middleware для режима тех.работ
     dp.message.middleware(MaintenanceMiddleware())
     dp.callback_query.middleware(MaintenanceMiddleware())
+
+    # Имена авторов входящих апдейтов — в кэш профилей
+    dp.message.outer_middleware(ProfileCacheMiddleware())
+    # ID сообщений групп — для /cc
+    dp.message.outer_middleware(RecentMessagesMiddleware())
+    dp.callback_query.outer_middleware(ProfileCacheMiddleware())
     
     # Запускаем бота
-    await dp.start_polling(
-        bot,
-        allowed_updates=["message", "callback_query", "chat_member", "my_chat_member"]
-    )
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            # Polling не работает, пока установлен webhook (после запуска в режиме webhook)
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+    finally:
+        await FSM_STORAGE.close()
+        await BOT_USER_WRITER.flush()
+        await MOD_LOG.flush()
+        await close_db_pool()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -14,7 +14,7 @@
 
 import os
 import sqlite3
-import psycopg2
+import psycopg
 
 SQLITE_PATH = os.getenv("SQLITE_PATH", "data/bot_database.db")
 
@@ -382,7 +382,7 @@ def migrate():
     sconn = sqlite3.connect(SQLITE_PATH)
     sconn.row_factory = sqlite3.Row
 
-    pconn = psycopg2.connect(**PG_CONF)
+    pconn = psycopg.connect(**PG_CONF)
     pconn.autocommit = False
     pcur = pconn.cursor()
 
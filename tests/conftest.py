@@ -0,0 +1,96 @@
+"""
+Общие фикстуры тестов.
+
+Тесты с БД нужен живой PostgreSQL: задайте TEST_POSTGRES_DSN с правом
+создавать базы, например
+
+    TEST_POSTGRES_DSN="host=127.0.0.1 port=5432 user=postgres" python -m pytest tests
+
+Без переменной такие тесты пропускаются. Каждый тест получает пустую
+базу со случайным именем, после теста она удаляется.
+"""
+
+import asyncio
+import os
+import secrets
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# main.py читает их при импорте
+os.environ.setdefault("BOT_TOKEN", "123456:TEST-TOKEN-aaaaaaaaaaaaaaaaaaaaaaaaaaaa")
+os.environ.setdefault("CHAT_ID", "-1001")
+os.environ.setdefault("MOD_LOG_CHAT_ID", "-1002")
+
+
+@pytest.fixture
+def pg_database():
+    """Пустая база; переменные POSTGRES_* main.py указывают на неё."""
+    dsn = os.getenv("TEST_POSTGRES_DSN")
+    if not dsn:
+        pytest.skip("TEST_POSTGRES_DSN не задан")
+    import psycopg
+    import psycopg.conninfo
+
+    params = psycopg.conninfo.conninfo_to_dict(dsn)
+    name = f"vapeneon_test_{secrets.token_hex(4)}"
+    with psycopg.connect(dsn, autocommit=True) as admin:
+        admin.execute(f"CREATE DATABASE {name} ENCODING 'UTF8' TEMPLATE template0")
+    previous = {key: os.environ.get(key) for key in
+                ("POSTGRES_HOST", "POSTGRES_PORT", "POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_DB")}
+    os.environ.update({
+        "POSTGRES_HOST": str(params.get("host", "localhost")),
+        "POSTGRES_PORT": str(params.get("port", "5432")),
+        "POSTGRES_USER": str(params.get("user", "postgres")),
+        "POSTGRES_PASSWORD": str(params.get("password", "")),
+        "POSTGRES_DB": name,
+    })
+    try:
+        yield name
+    finally:
+        import main
+        asyncio.run(main.close_db_pool())
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        with psycopg.connect(dsn, autocommit=True) as admin:
+            admin.execute(f"DROP DATABASE IF EXISTS {name} WITH (FORCE)")
+
+
+# Помощники для тестов с БД; main, как и в pg_database, импортируется лениво
+
+def _run(coro):
+    import main
+
+    async def scenario():
+        try:
+            return await coro
+        finally:
+            # Пул привязан к циклу событий — закрываем в том же цикле
+            await main.close_db_pool()
+    return asyncio.run(scenario())
+
+
+async def _fetch(sql, params=None):
+    import main
+    conn = await main.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        await cursor.execute(sql, params)
+        return await cursor.fetchall()
+    finally:
+        await conn.close()
+
+
+async def _execute(sql, params=None):
+    import main
+    conn = await main.get_db_connection()
+    try:
+        await conn.cursor().execute(sql, params)
+        await conn.commit()
+    finally:
+        await conn.close()
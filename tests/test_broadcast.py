@@ -0,0 +1,69 @@
+import main
+from conftest import _execute, _fetch, _run
+
+
+def _capture_sends(monkeypatch):
+    sent = []
+
+    async def make_request(bot, method, timeout=None):
+        sent.append((method.chat_id, method.text))
+        return True
+
+    monkeypatch.setattr(main.bot.session, "make_request", make_request)
+    monkeypatch.setattr(main.OUTBOX, "_task", None)
+    monkeypatch.setattr(main.OUTBOX, "_waiters", [])
+    monkeypatch.setattr(main, "BROADCAST_RETRY_DELAY", 0)
+    return sent
+
+
+async def _job_with_users(engine, *user_ids):
+    await main.init_db()
+    for user_id in user_ids:
+        await _execute("INSERT INTO bot_users (user_id) VALUES (%s)", (user_id,))
+    job_id, _ = await engine.create_job(1, "новости")
+    return job_id
+
+
+def test_failed_save_is_retried_without_resending(pg_database, monkeypatch):
+    sent = _capture_sends(monkeypatch)
+    engine = main.BroadcastEngine()
+    real_save = engine._save_batch
+    failures = [OSError("соединение потеряно")]
+
+    async def flaky_save(job_id, results):
+        if failures:
+            raise failures.pop()
+        await real_save(job_id, results)
+
+    monkeypatch.setattr(engine, "_save_batch", flaky_save)
+
+    async def scenario():
+        job_id = await _job_with_users(engine, 10, 11)
+        await engine._run(job_id)
+        return await _fetch("SELECT status, sent FROM broadcast_jobs WHERE id = %s", (job_id,))
+
+    rows = _run(scenario())
+    assert tuple(rows[0]) == ("done", 2)
+    assert sorted(chat_id for chat_id, _ in sent if chat_id != 1) == [10, 11]
+
+
+def test_persistent_db_error_marks_job_failed(pg_database, monkeypatch):
+    sent = _capture_sends(monkeypatch)
+    monkeypatch.setattr(main, "BROADCAST_MAX_RETRIES", 2)
+    engine = main.BroadcastEngine()
+
+    async def broken_batch(job_id):
+        raise OSError("соединение потеряно")
+
+    monkeypatch.setattr(engine, "_next_batch", broken_batch)
+
+    async def scenario():
+        job_id = await _job_with_users(engine, 10)
+        await engine._run(job_id)
+        return await _fetch("SELECT status, finished_at IS NOT NULL FROM broadcast_jobs WHERE id = %s", (job_id,))
+
+    rows = _run(scenario())
+    assert tuple(rows[0]) == ("failed", True)
+    # Автор без сообщения с прогрессом получает отдельное уведомление
+    assert [chat_id for chat_id, _ in sent] == [1]
+    assert "прервана" in sent[0][1]
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+
+import main
+
+
+class FakeSession:
+    """Подменяет сетевую часть bot.session: запоминает собранные запросы."""
+
+    def __init__(self, reject_batch=False):
+        self.reject_batch = reject_batch
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        request = method.build_request(bot)
+        self.requests.append((request.method, bot.session.build_form_data(request)))
+        if request.method == "deleteMessages" and self.reject_batch:
+            raise TelegramBadRequest(method=method, message="Bad Request: method not found")
+        return True
+
+
+@pytest.fixture
+def session(monkeypatch):
+    def install(**kwargs):
+        fake = FakeSession(**kwargs)
+        monkeypatch.setattr(main.bot.session, "make_request", fake.make_request)
+        return fake
+    # Планировщик OUTBOX привязан к циклу событий — каждому тесту свой
+    monkeypatch.setattr(main.OUTBOX, "_task", None)
+    monkeypatch.setattr(main.OUTBOX, "_waiters", [])
+    return install
+
+
+def _fields(form):
+    return {options["name"]: value for options, _, value in form._fields}
+
+
+def test_bulk_delete_sends_delete_messages_in_batches(session):
+    fake = session()
+    message_ids = list(range(1, 251))
+
+    deleted = asyncio.run(main.bulk_delete_messages(-1001, message_ids))
+
+    assert deleted == 250
+    assert [method for method, _ in fake.requests] == ["deleteMessages"] * 3
+    fields = _fields(fake.requests[0][1])
+    assert fields["chat_id"] == "-1001"
+    assert fields["message_ids"] == "[" + ", ".join(map(str, range(1, 101))) + "]"
+    assert _fields(fake.requests[2][1])["message_ids"] == "[" + ", ".join(map(str, range(201, 251))) + "]"
+
+
+def test_bulk_delete_falls_back_to_single_deletes(session):
+    fake = session(reject_batch=True)
+
+    deleted = asyncio.run(main.bulk_delete_messages(-1001, [10, 11, 12]))
+
+    assert deleted == 3
+    methods = [method for method, _ in fake.requests]
+    assert methods[0] == "deleteMessages"
+    assert sorted(methods[1:]) == ["deleteMessage"] * 3
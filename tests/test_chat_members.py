@@ -0,0 +1,29 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_followers_are_released_when_leader_is_cancelled(monkeypatch):
+    async def scenario():
+        requested = asyncio.Event()
+
+        async def slow_get_chat_member(chat_id, user_id):
+            requested.set()
+            await asyncio.sleep(10)
+
+        monkeypatch.setattr(main.bot, "get_chat_member", slow_get_chat_member)
+        cache = main.ChatMemberCache(ttl=60)
+        leader = asyncio.create_task(cache.get_status(-1001, 42))
+        await requested.wait()
+        follower = asyncio.create_task(cache.get_status(-1001, 42))
+        await asyncio.sleep(0)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(follower, 1)
+        return cache._inflight
+
+    assert asyncio.run(scenario()) == {}
@@ -0,0 +1,60 @@
+import main
+from conftest import _fetch, _run
+
+
+def test_failed_cleanup_is_retried(pg_database, monkeypatch):
+    deleted = []
+
+    async def fake_bulk_delete(chat_id, message_ids, on_progress=None):
+        deleted.extend(message_ids)
+        return len(message_ids)
+
+    async def broken_connection():
+        raise OSError("соединение потеряно")
+
+    monkeypatch.setattr(main, "bulk_delete_messages", fake_bulk_delete)
+
+    async def scenario():
+        await main.init_db()
+        deletions = main.DeferredDeletions()
+        await deletions.schedule(-1001, 1, 0)
+        await deletions.schedule(-1001, 2, 0)
+        due = [deletions._heap.pop(), deletions._heap.pop()]
+
+        real_connection = main.get_db_connection
+        monkeypatch.setattr(main, "get_db_connection", broken_connection)
+        await deletions._flush(due)
+        monkeypatch.setattr(main, "get_db_connection", real_connection)
+        left_after_error = await _fetch("SELECT count(*) FROM pending_deletions")
+        pending_ids = len(deletions._done)
+
+        await deletions._forget_done()
+        left = await _fetch("SELECT count(*) FROM pending_deletions")
+        return left_after_error[0][0], pending_ids, left[0][0], deletions._done
+
+    assert _run(scenario()) == (2, 2, 0, [])
+    assert sorted(deleted) == [1, 2]
+
+
+def test_failed_chat_is_requeued(pg_database, monkeypatch):
+    async def failing_bulk_delete(chat_id, message_ids, on_progress=None):
+        if chat_id == -1002:
+            raise RuntimeError("сбой")
+        return len(message_ids)
+
+    monkeypatch.setattr(main, "bulk_delete_messages", failing_bulk_delete)
+
+    async def scenario():
+        await main.init_db()
+        deletions = main.DeferredDeletions()
+        await deletions.schedule(-1001, 1, 0)
+        await deletions.schedule(-1002, 2, 0)
+        due = sorted(deletions._heap)
+        deletions._heap = []
+        await deletions._flush(due)
+        rows = await _fetch("SELECT chat_id, message_id FROM pending_deletions")
+        return [(chat_id, message_id) for _, _, chat_id, message_id in deletions._heap], rows
+
+    requeued, rows = _run(scenario())
+    assert requeued == [(-1002, 2)]
+    assert [tuple(row) for row in rows] == [(-1002, 2)]
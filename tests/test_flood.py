@@ -0,0 +1,91 @@
+import asyncio
+
+from chat_filters import FloodDetector, FloodVerdict
+
+import main
+
+T0 = 1000.0
+
+
+def _feed(detector, messages, user_id=1):
+    """messages — пары (секунда от T0, текст); возвращает вердикт на каждое."""
+    return [detector.check(user_id, text, T0 + at) for at, text in messages]
+
+
+def test_burst_is_flagged_on_the_fifth_message():
+    verdicts = _feed(FloodDetector(), [(i * 0.5, f"сообщение {i}") for i in range(5)])
+    assert verdicts == [None] * 4 + [FloodVerdict("burst", 1)]
+
+
+def test_slow_messages_are_not_a_burst():
+    assert _feed(FloodDetector(), [(i * 2.0, f"сообщение {i}") for i in range(5)]) == [None] * 5
+
+
+def test_repeat_is_flagged_on_the_third_copy():
+    verdicts = _feed(FloodDetector(), [(0, "продам кальян"), (20, "ПРОДАМ кальян"), (40, "продам кальян")])
+    assert verdicts == [None, None, FloodVerdict("repeat", 1)]
+
+
+def test_old_copies_do_not_count_as_repeat():
+    verdicts = _feed(FloodDetector(), [(0, "привет"), (70, "привет"), (140, "привет")])
+    assert verdicts == [None, None, None]
+
+
+def test_character_run_is_flagged():
+    assert _feed(FloodDetector(), [(0, "аааааааааааааа")]) == [FloodVerdict("chars", 1)]
+
+
+def test_emoji_wall_is_flagged_but_short_emoji_are_not():
+    verdicts = _feed(FloodDetector(), [(0, "🔥🎉😀🚀💨🔥🎉😀🚀💨🔥🎉"), (30, "круто 🔥🔥")], user_id=1)
+    assert verdicts == [FloodVerdict("emoji", 1), None]
+
+
+def test_cooldown_suppresses_repeated_verdicts():
+    verdicts = _feed(FloodDetector(cooldown=10), [(0, "а" * 12), (5, "б" * 12), (11, "в" * 12)])
+    assert verdicts == [FloodVerdict("chars", 1), None, FloodVerdict("chars", 2)]
+
+
+def test_strikes_escalate_within_window_and_reset_after():
+    detector = FloodDetector(cooldown=10, strike_window=600)
+    verdicts = _feed(detector, [(0, "а" * 12), (100, "б" * 12), (200, "в" * 12), (900, "г" * 12)])
+    assert [verdict.strikes for verdict in verdicts] == [1, 2, 3, 1]
+
+
+def test_users_are_tracked_separately():
+    detector = FloodDetector()
+    for i in range(4):
+        detector.check(1, f"сообщение {i}", T0 + i * 0.5)
+    assert detector.check(2, "сообщение", T0 + 2.0) is None
+
+
+def test_log_mode_keeps_message_and_skips_sanctions(monkeypatch):
+    calls = []
+
+    async def record(name, *args, **kwargs):
+        calls.append(name)
+
+    async def not_admin(user_id, chat_id):
+        return False
+
+    async def mention(user_id):
+        return str(user_id)
+
+    monkeypatch.setattr(main, "FLOOD_ENFORCE_MODE", "log")
+    monkeypatch.setattr(main, "FLOOD_DETECTOR", FloodDetector())
+    monkeypatch.setattr(main, "is_chat_admin_or_bot_admin", not_admin)
+    monkeypatch.setattr(main, "get_user_mention", mention)
+    for name in ("delete_message", "warn_user", "mute_user", "send_to_mod_log"):
+        monkeypatch.setattr(main, name, lambda *a, _name=name, **k: record(_name))
+
+    message = main.Message.parse_obj({
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": main.CHAT_ID, "type": "supergroup"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Тест"},
+        "text": "а" * 12,
+    })
+    handled = asyncio.run(main.enforce_flood(message, message.text))
+
+    assert handled is False
+    assert calls == ["send_to_mod_log"]
+    assert 42 not in main.RAID.offenders(60)
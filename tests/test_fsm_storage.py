@@ -0,0 +1,54 @@
+from datetime import timedelta
+
+from aiogram.fsm.storage.base import StorageKey
+
+import main
+from conftest import _fetch, _run
+
+
+def _key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_unstorable_value_does_not_block_other_users(pg_database):
+    async def scenario():
+        await main.init_db()
+        storage = main.PostgresStorage(timedelta(hours=1))
+        await storage.set_state(key=_key(1), state="SafeDealStates:DEAL_AMOUNT")
+        await storage.update_data(key=_key(2), data={"amount": float("nan")})
+        await storage.update_data(key=_key(3), data={"amount": 500.0})
+        await storage.flush()
+        # Следующие записи тоже доходят до таблицы
+        await storage.update_data(key=_key(4), data={"amount": 10.0})
+        await storage.flush()
+        rows = await _fetch("SELECT key, data FROM fsm_storage ORDER BY key")
+        await storage.close()
+        return rows, storage._dirty
+
+    rows, dirty = _run(scenario())
+    assert [(row[0], row[1]) for row in rows] == [
+        ("1:1:1:default", {}),
+        ("1:3:3:default", {"amount": 500.0}),
+        ("1:4:4:default", {"amount": 10.0}),
+    ]
+    assert dirty == {}
+
+
+def test_instances_share_state_without_delay(pg_database):
+    async def scenario():
+        await main.init_db()
+        first = main.PostgresStorage(timedelta(hours=1))
+        second = main.PostgresStorage(timedelta(hours=1))
+        # Второй экземпляр уже читал ключ — прочитанное не должно залипнуть
+        seen_before = await second.get_state(key=_key(5))
+        await first.set_state(key=_key(5), state="SafeDealStates:DEAL_AMOUNT")
+        await first.update_data(key=_key(5), data={"amount": 700.0})
+        seen_after = await second.get_state(key=_key(5)), await second.get_data(key=_key(5))
+        await first.set_state(key=_key(5), state=None)
+        await first.set_data(key=_key(5), data={})
+        cleared = await second.get_state(key=_key(5))
+        await first.close()
+        await second.close()
+        return seen_before, seen_after, cleared
+
+    assert _run(scenario()) == (None, ("SafeDealStates:DEAL_AMOUNT", {"amount": 700.0}), None)
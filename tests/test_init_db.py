@@ -0,0 +1,32 @@
+import main
+from conftest import _execute, _fetch, _run
+
+
+def test_init_db_twice_on_empty_schema(pg_database):
+    async def scenario():
+        await main.init_db()
+        await main.init_db()
+        return await _fetch(
+            "SELECT relname, relkind FROM pg_class WHERE relname = ANY(%s) ORDER BY relname",
+            (["mod_events", "moderation_events", "user_ads"],)
+        )
+
+    rows = _run(scenario())
+    assert [(r[0], r[1]) for r in rows] == [
+        ("mod_events", "p"), ("moderation_events", "p"), ("user_ads", "p"),
+    ]
+
+
+def test_init_db_backfills_moderation_events(pg_database):
+    async def scenario():
+        await main.init_db()
+        await _execute(
+            "INSERT INTO warns (user_id, chat_id, reason, issued_by, expires_at) "
+            "VALUES (42, -1001, 'флуд', 7, CURRENT_TIMESTAMP + INTERVAL '1 day')"
+        )
+        await _execute("DELETE FROM moderation_events")
+        await main.init_db()
+        return await _fetch("SELECT kind, user_id, reason FROM moderation_events")
+
+    rows = _run(scenario())
+    assert [(r[0], r[1], r[2]) for r in rows] == [("warn", 42, "флуд")]
@@ -0,0 +1,38 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+
+import main
+
+
+def test_digests_split_only_between_events():
+    events = [f"<b>Событие {i}</b> " + "x" * 1500 for i in range(6)] + ["<i>" + "y" * 5000 + "</i>"]
+
+    groups = main.ModLogWriter.digests(events)
+
+    assert [event for group in groups for event in group] == events
+    for group in groups[:-1]:
+        assert len(main.MOD_LOG_SEPARATOR.join(group)) <= main.MOD_LOG_MAX_CHARS
+    assert groups[-1] == [events[-1]]
+
+
+def test_rejected_digest_is_resent_per_event(monkeypatch):
+    sent = []
+
+    async def make_request(bot, method, timeout=None):
+        if method.parse_mode == "HTML" and "<broken" in method.text:
+            raise TelegramBadRequest(method=method, message="Bad Request: can't parse entities")
+        sent.append((method.parse_mode, method.text))
+        return True
+
+    monkeypatch.setattr(main.bot.session, "make_request", make_request)
+    monkeypatch.setattr(main.OUTBOX, "_task", None)
+    monkeypatch.setattr(main.OUTBOX, "_waiters", [])
+
+    asyncio.run(main.MOD_LOG._send(["<b>мут</b>", "<broken>бан &amp; варн", "<b>варн</b>"]))
+
+    assert sent == [
+        ("HTML", "<b>мут</b>"),
+        (None, "бан & варн"),
+        ("HTML", "<b>варн</b>"),
+    ]
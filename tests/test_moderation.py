@@ -0,0 +1,27 @@
+import asyncio
+
+import main
+from conftest import _fetch, _run
+
+
+def test_concurrent_warns_reach_the_limit(pg_database):
+    async def scenario():
+        await main.init_db()
+        await main.MODERATION.warn(42, -1001, "флуд", 1, limit=3)
+        counts = await asyncio.gather(*(
+            main.MODERATION.warn(42, -1001, "флуд", issued_by, limit=3) for issued_by in (2, 3)
+        ))
+        left = await _fetch("SELECT count(*) FROM warns WHERE user_id = 42")
+        return sorted(counts), left[0][0]
+
+    assert _run(scenario()) == ([2, 3], 0)
+
+
+def test_history_is_filtered_by_chat(pg_database):
+    async def scenario():
+        await main.init_db()
+        await main.MODERATION.record("ban", 42, chat_id=-1001, issued_by=1, reason="здесь")
+        await main.MODERATION.record("ban", 42, chat_id=-1009, issued_by=1, reason="в другом чате")
+        return await main.MODERATION.history(42, kinds=("ban",), chat_id=-1001)
+
+    assert [event["reason"] for event in _run(scenario())] == ["здесь"]
@@ -0,0 +1,102 @@
+import gzip
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from conftest import _execute, _fetch, _run
+
+OLD = datetime(2020, 1, 15)
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_ARCHIVE_DIR", str(tmp_path))
+    return tmp_path
+
+
+def _policy(table):
+    return next(policy for policy in main.RETENTION_POLICIES if policy.table == table)
+
+
+def _archived_rows(archive_dir, prefix):
+    rows = []
+    for path in sorted(archive_dir.glob(f"{prefix}_*.csv.gz")):
+        with gzip.open(path, "rt") as archive:
+            rows.extend(archive.read().splitlines()[1:])
+    return rows
+
+
+async def _old_ads():
+    await main.init_db()
+    conn = await main.get_db_connection()
+    try:
+        await main._create_partitions(conn.cursor(), "user_ads", OLD, OLD)
+        await conn.commit()
+    finally:
+        await conn.close()
+    await _execute(
+        "INSERT INTO user_ads (user_id, message_text, sent_at) VALUES (1, 'продам', %s), (2, 'куплю', %s)",
+        (OLD, OLD)
+    )
+
+
+async def _partition_exists(name):
+    return bool(await _fetch("SELECT 1 FROM pg_class WHERE relname = %s", (name,)))
+
+
+def test_old_partition_is_archived_then_dropped(pg_database, archive_dir):
+    async def scenario():
+        await _old_ads()
+        conn = await main.get_db_connection()
+        try:
+            dropped = await main._drop_old_partitions(conn, _policy("user_ads"), datetime.now() - timedelta(days=90))
+        finally:
+            await conn.close()
+        return dropped, await _partition_exists("user_ads_p202001")
+
+    assert _run(scenario()) == (1, False)
+    assert len(_archived_rows(archive_dir, "user_ads_p202001")) == 2
+
+
+def test_failed_archive_keeps_partition_attached(pg_database, archive_dir, monkeypatch):
+    async def broken_copy(*args, **kwargs):
+        raise OSError("диск заполнен")
+
+    async def scenario():
+        await _old_ads()
+        monkeypatch.setattr(main, "_copy_out", broken_copy)
+        conn = await main.get_db_connection()
+        try:
+            with pytest.raises(OSError):
+                await main._drop_old_partitions(conn, _policy("user_ads"), datetime.now() - timedelta(days=90))
+        finally:
+            await conn.close()
+        return await _fetch("SELECT count(*) FROM user_ads")
+
+    assert _run(scenario())[0][0] == 2
+    assert list(archive_dir.iterdir()) == []
+
+
+def test_expired_rows_are_archived_and_deleted_together(pg_database, archive_dir, monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_DELETE_BATCH", 2)
+
+    async def scenario():
+        await main.init_db()
+        await _execute(
+            "INSERT INTO mutes (user_id, chat_id, issued_by, issued_at, is_active) "
+            "SELECT g, -1001, 0, %s, g = 5 FROM generate_series(1, 5) g",
+            (OLD,)
+        )
+        conn = await main.get_db_connection()
+        try:
+            deleted = await main._delete_expired_rows(conn, _policy("mutes"), datetime.now() - timedelta(days=180))
+        finally:
+            await conn.close()
+        return deleted, await _fetch("SELECT user_id FROM mutes ORDER BY user_id")
+
+    deleted, left = _run(scenario())
+    assert deleted == 4
+    assert [row[0] for row in left] == [5]
+    archived = _archived_rows(archive_dir, "mutes")
+    assert sorted(int(line.split(",")[1]) for line in archived) == [1, 2, 3, 4]
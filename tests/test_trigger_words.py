@@ -0,0 +1,34 @@
+import pytest
+
+import main
+from chat_filters import TriggerMatcher
+from conftest import _fetch, _run
+
+
+@pytest.fixture(autouse=True)
+def matcher(monkeypatch):
+    monkeypatch.setattr(main, "TRIGGER_MATCHER", TriggerMatcher(main.TRIGGER_WORDS))
+
+
+def test_code_words_are_not_removed(pg_database):
+    async def scenario():
+        await main.init_db()
+        await main.add_trigger_word("кинг", ["k1ng"], 1)
+        removed = await main.remove_trigger_word("кинг")
+        return removed, await _fetch("SELECT variant FROM trigger_words WHERE word = 'кинг'")
+
+    removed, rows = _run(scenario())
+    assert removed is False
+    assert [row[0] for row in rows] == ["кинг", "k1ng"]
+    assert main.TRIGGER_MATCHER.find("тут кинг")[0] == "кинг"
+
+
+def test_added_words_are_removed(pg_database):
+    async def scenario():
+        await main.init_db()
+        await main.add_trigger_word("вейпшоп", [], 1)
+        removed = await main.remove_trigger_word("вейпшоп")
+        return removed, await _fetch("SELECT 1 FROM trigger_words WHERE word = 'вейпшоп'")
+
+    assert _run(scenario()) == (True, [])
+    assert main.TRIGGER_MATCHER.find("вейпшоп рядом") is None
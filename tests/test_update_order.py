@@ -0,0 +1,78 @@
+import asyncio
+from datetime import datetime
+
+from aiogram import F
+from aiogram.filters.state import StateFilter
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Message, Update
+
+import main
+
+
+class Flow(StatesGroup):
+    waiting_for_amount = State()
+
+
+def _update(update_id, text, user_id=7):
+    return Update.parse_obj({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(datetime.now().timestamp()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Тест"},
+            "text": text,
+        },
+    })
+
+
+def _dispatcher(routed):
+    dp = main.OrderedDispatcher(storage=MemoryStorage())
+
+    @dp.message(F.text == "сделка")
+    async def start(message: Message, state: FSMContext):
+        # Обработчик успевает уступить цикл событий до set_state
+        await asyncio.sleep(0.05)
+        await state.set_state(Flow.waiting_for_amount)
+        routed.append("start")
+
+    @dp.message(StateFilter(Flow.waiting_for_amount))
+    async def amount(message: Message, state: FSMContext):
+        routed.append(f"amount:{message.text}")
+        await state.clear()
+
+    @dp.message()
+    async def fallback(message: Message):
+        routed.append(f"fallback:{message.text}")
+
+    return dp
+
+
+def test_second_update_sees_state_set_by_first():
+    routed = []
+    dp = _dispatcher(routed)
+
+    async def scenario():
+        await asyncio.gather(
+            dp.feed_update(main.bot, _update(1, "сделка")),
+            dp.feed_update(main.bot, _update(2, "500")),
+        )
+
+    asyncio.run(scenario())
+    assert routed == ["start", "amount:500"]
+
+
+def test_other_users_are_not_blocked():
+    routed = []
+    dp = _dispatcher(routed)
+
+    async def scenario():
+        await asyncio.gather(
+            dp.feed_update(main.bot, _update(1, "сделка", user_id=7)),
+            dp.feed_update(main.bot, _update(2, "500", user_id=8)),
+        )
+
+    asyncio.run(scenario())
+    assert routed == ["fallback:500", "start"]
@@ -0,0 +1,20 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def test_webhook_mode_without_url_fails_before_startup(monkeypatch):
+    started = []
+
+    async def init_db():
+        started.append("init_db")
+
+    monkeypatch.setattr(main, "BOT_MODE", "webhook")
+    monkeypatch.setattr(main, "WEBHOOK_URL", "")
+    monkeypatch.setattr(main, "init_db", init_db)
+
+    with pytest.raises(RuntimeError, match="WEBHOOK_URL"):
+        asyncio.run(main.main())
+    assert started == []
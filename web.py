@@ -10,9 +10,10 @@ import secrets
 import httpx
 import string
 import random
-import psycopg2
-import psycopg2.pool
-import psycopg2.extras
+import psycopg
+import psycopg.conninfo
+import psycopg.rows
+import psycopg_pool
 from datetime import datetime, timedelta
 from typing import Optional
 from contextlib import asynccontextmanager
@@ -153,9 +154,10 @@ log = logging.getLogger("web")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    _init_db()
+    await _init_db()
     log.info("Сайт VapeNeon запущен на :8080")
     yield
+    await _close_db()
 
 app = FastAPI(title="VapeNeon", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
@@ -163,15 +165,26 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], all
 # ─── DB ──────────────────────────────────────────────────────────────────────
 # База — PostgreSQL. Схема создаётся один раз через migrate_to_postgres.py,
 # здесь только держим пул соединений и подчищаем протухшие сессии на старте.
+# Пул асинхронный (psycopg 3): запросы не блокируют event loop uvicorn,
+# поэтому медленный /api/users или /api/logs не задерживает логин и поллинг
+# остальных клиентов — каждый запрос берёт своё соединение из пула.
 
-_POOL: "psycopg2.pool.ThreadedConnectionPool" = None
+_POOL: "psycopg_pool.AsyncConnectionPool" = None
 
-def _init_db():
+DB_POOL_MIN_SIZE = int(os.getenv("WEB_DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("WEB_DB_POOL_MAX_SIZE", "10"))
+
+async def _init_db():
     global _POOL
-    _POOL = psycopg2.pool.ThreadedConnectionPool(minconn=1, maxconn=10, **PG_CONF)
+    _POOL = psycopg_pool.AsyncConnectionPool(
+        psycopg.conninfo.make_conninfo(**PG_CONF),
+        min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+        kwargs={"row_factory": psycopg.rows.dict_row},
+        open=False,
+    )
+    await _POOL.open()
 
-    conn = _POOL.getconn()
-    try:
+    async with _POOL.connection() as conn:
         cur = conn.cursor()
 
         # На случай, если миграция ещё не накатывала новые колонки —
@@ -182,9 +195,9 @@ def _init_db():
             ("submitter_tg_id",   "BIGINT DEFAULT 0"),
             ("submitter_username","TEXT"),
         ]:
-            cur.execute(f"ALTER TABLE admin_complaints ADD COLUMN IF NOT EXISTS {col} {typ}")
+            await cur.execute(f"ALTER TABLE admin_complaints ADD COLUMN IF NOT EXISTS {col} {typ}")
 
-        cur.execute("""
+        await cur.execute("""
             CREATE TABLE IF NOT EXISTS bug_reports (
                 id SERIAL PRIMARY KEY,
                 title TEXT NOT NULL,
@@ -196,9 +209,9 @@ def _init_db():
             )
         """)
 
-        cur.execute("ALTER TABLE admin_sessions ADD COLUMN IF NOT EXISTS ip TEXT")
+        await cur.execute("ALTER TABLE admin_sessions ADD COLUMN IF NOT EXISTS ip TEXT")
 
-        cur.execute("""
+        await cur.execute("""
             CREATE TABLE IF NOT EXISTS two_factor_auth (
                 id SERIAL PRIMARY KEY,
                 subject_type TEXT NOT NULL,      -- 'admin' | 'user'
@@ -211,61 +224,75 @@ def _init_db():
             )
         """)
 
-        cur.execute("DELETE FROM admin_sessions WHERE expires_at < now()")
-        cur.execute("DELETE FROM user_sessions WHERE expires_at < now()")
-        conn.commit()
-    finally:
-        _POOL.putconn(conn)
+        await cur.execute("DELETE FROM admin_sessions WHERE expires_at < now()")
+        await cur.execute("DELETE FROM user_sessions WHERE expires_at < now()")
+        await conn.commit()
+
+async def _close_db():
+    global _POOL
+    if _POOL is not None:
+        await _POOL.close()
+        _POOL = None
 
 class _PooledConn:
     """Тонкая обёртка над соединением из пула: весь остальной код вызывает
     conn.execute(...)/conn.commit()/conn.close() точно так же, как раньше
-    для sqlite3.Connection — но close() возвращает соединение в пул,
-    а не рвёт его."""
+    для sqlite3.Connection (только через await) — но close() возвращает
+    соединение в пул, а не рвёт его."""
 
     def __init__(self, raw):
         self._raw = raw
-        raw.cursor_factory = psycopg2.extras.RealDictCursor
 
-    def execute(self, sql, params=()):
-        cur = self._raw.cursor()
-        cur.execute(sql, params)
-        return cur
+    async def execute(self, sql, params=None):
+        return await self._raw.execute(sql, params)
 
     def cursor(self):
         return self._raw.cursor()
 
-    def commit(self):
-        self._raw.commit()
+    async def commit(self):
+        await self._raw.commit()
 
-    def rollback(self):
-        self._raw.rollback()
+    async def rollback(self):
+        await self._raw.rollback()
 
-    def close(self):
-        _POOL.putconn(self._raw)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc, tb):
-        if exc_type:
-            self._raw.rollback()
-        else:
-            self._raw.commit()
-        self.close()
+    async def close(self):
+        # Незавершённую транзакцию (обычно — просто SELECT) откатываем сами,
+        # чтобы пул не ругался в лог на каждый возврат соединения
+        if self._raw.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+            try:
+                await self._raw.rollback()
+            except Exception:
+                pass
+        await _POOL.putconn(self._raw)
 
 
-def db():
+async def db():
     """Возвращает соединение из пула (обёрнутое), совместимое по интерфейсу
     с тем, как раньше использовался sqlite3.Connection в этом файле."""
-    raw = _POOL.getconn()
+    raw = await _POOL.getconn()
     return _PooledConn(raw)
 
-def rows(conn, sql, params=()):
-    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+@asynccontextmanager
+async def db_session():
+    """async with db_session() as conn: — коммит при успехе, откат при ошибке,
+    соединение в любом случае возвращается в пул."""
+    conn = await db()
+    try:
+        yield conn
+        await conn.commit()
+    except BaseException:
+        await conn.rollback()
+        raise
+    finally:
+        await conn.close()
+
+async def rows(conn, sql, params=None):
+    cur = await conn.execute(sql, params)
+    return [dict(r) for r in await cur.fetchall()]
 
-def one(conn, sql, params=()):
-    r = conn.execute(sql, params).fetchone()
+async def one(conn, sql, params=None):
+    cur = await conn.execute(sql, params)
+    r = await cur.fetchone()
     return dict(r) if r else None
 
 # ─── HELPERS ─────────────────────────────────────────────────────────────────
@@ -274,23 +301,23 @@ def gen_password(length=12):
     chars = string.ascii_letters + string.digits + "!@#$%"
     return "".join(random.choices(chars, k=length))
 
-def get_admin_record(username: str) -> Optional[dict]:
+async def get_admin_record(username: str) -> Optional[dict]:
     """Получить запись администратора из БД или статического списка"""
     uname = username.lower().lstrip("@")
-    conn = db()
-    rec = one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (uname,))
-    conn.close()
+    conn = await db()
+    rec = await one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (uname,))
+    await conn.close()
     return rec
 
-def check_admin_password(username: str, password: str) -> Optional[dict]:
+async def check_admin_password(username: str, password: str) -> Optional[dict]:
     """Проверить логин/пароль. Возвращает dict с правами или None"""
     uname = username.lower().lstrip("@")
     pw_hash = hashlib.sha256(password.encode()).hexdigest()
 
     # Сначала проверяем БД
-    conn = db()
-    rec = one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (uname,))
-    conn.close()
+    conn = await db()
+    rec = await one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (uname,))
+    await conn.close()
     if rec and rec["password_hash"] == pw_hash:
         return {
             "username": rec["username"],
@@ -314,22 +341,22 @@ def get_client_ip(request: Request) -> str:
         return xff.split(",")[0].strip()
     return request.client.host if request.client else "unknown"
 
-def get_tfa_record(subject_type: str, username: str) -> Optional[dict]:
-    conn = db()
-    rec = one(conn, "SELECT * FROM two_factor_auth WHERE subject_type=%s AND lower(username)=%s",
+async def get_tfa_record(subject_type: str, username: str) -> Optional[dict]:
+    conn = await db()
+    rec = await one(conn, "SELECT * FROM two_factor_auth WHERE subject_type=%s AND lower(username)=%s",
               (subject_type, username.lower().lstrip("@")))
-    conn.close()
+    await conn.close()
     return rec
 
-def save_tfa_binding(subject_type: str, username: str, tg_id, tg_username):
-    conn = db()
-    conn.execute("""
+async def save_tfa_binding(subject_type: str, username: str, tg_id, tg_username):
+    conn = await db()
+    await conn.execute("""
         INSERT INTO two_factor_auth (subject_type, username, tg_id, tg_username, enabled)
         VALUES (%s,%s,%s,%s,1)
         ON CONFLICT (subject_type, username) DO UPDATE SET
             tg_id=excluded.tg_id, tg_username=excluded.tg_username, enabled=1
     """, (subject_type, username.lower().lstrip("@"), tg_id, tg_username))
-    conn.commit(); conn.close()
+    await conn.commit(); await conn.close()
 
 def gen_2fa_code() -> str:
     return "".join(random.choices(string.digits, k=6))
@@ -343,17 +370,17 @@ async def send_2fa_code(tg_id: int, code: str, ip: str):
     )
     await tg_send(tg_id, text)
 
-def is_site_banned(username: str) -> Optional[dict]:
+async def is_site_banned(username: str) -> Optional[dict]:
     """Проверить бан на сайте"""
     uname = username.lower().lstrip("@")
-    conn = db()
-    ban = one(conn, """
+    conn = await db()
+    ban = await one(conn, """
         SELECT * FROM site_bans
         WHERE lower(username)=%s AND is_active=1
         AND (expires_at IS NULL OR expires_at > now())
         ORDER BY created_at DESC LIMIT 1
     """, (uname,))
-    conn.close()
+    await conn.close()
     return ban
 
 # ─── TELEGRAM ────────────────────────────────────────────────────────────────
@@ -419,24 +446,24 @@ async def tg_warn_user(tg_id: int, reason: str, issued_by: str):
 
 # ─── AUTH ────────────────────────────────────────────────────────────────────
 
-def _del_session(token: str):
+async def _del_session(token: str):
     SESSIONS.pop(token, None)
     try:
-        c = db(); c.execute("DELETE FROM admin_sessions WHERE token=%s", (token,)); c.commit(); c.close()
+        c = await db(); await c.execute("DELETE FROM admin_sessions WHERE token=%s", (token,)); await c.commit(); await c.close()
     except Exception: pass
 
 USER_SESSION_TTL = timedelta(days=1)
 
-def get_user_session(token: str) -> Optional[dict]:
+async def get_user_session(token: str) -> Optional[dict]:
     """Получить пользовательскую сессию из памяти или БД"""
     if not token:
         return None
     if token in USER_SESSIONS:
         return USER_SESSIONS[token]
     # Восстанавливаем из БД после перезапуска
-    c = db()
-    row = one(c, "SELECT * FROM user_sessions WHERE token=%s AND expires_at > now()", (token,))
-    c.close()
+    c = await db()
+    row = await one(c, "SELECT * FROM user_sessions WHERE token=%s AND expires_at > now()", (token,))
+    await c.close()
     if not row:
         return None
     s = {
@@ -448,13 +475,13 @@ def get_user_session(token: str) -> Optional[dict]:
     USER_SESSIONS[token] = s
     return s
 
-def save_user_session(token: str, data: dict):
+async def save_user_session(token: str, data: dict):
     """Сохранить пользовательскую сессию в памяти и БД"""
     USER_SESSIONS[token] = data
     expires_dt = datetime.now() + USER_SESSION_TTL
     try:
-        c = db()
-        c.execute(
+        c = await db()
+        await c.execute(
             """INSERT INTO user_sessions (token, username, tg_id, appeal_reason, appeal_type, expires_at)
                VALUES (%s,%s,%s,%s,%s,%s)
                ON CONFLICT (token) DO UPDATE SET
@@ -464,18 +491,18 @@ def save_user_session(token: str, data: dict):
             (token, data.get("username", ""), data.get("tg_id", 0),
              data.get("appeal_reason", ""), data.get("appeal_type", ""), expires_dt.isoformat())
         )
-        c.commit(); c.close()
+        await c.commit(); await c.close()
     except Exception as e:
         log.error(f"Ошибка сохранения user_session: {e}")
 
-def del_user_session(token: str):
+async def del_user_session(token: str):
     """Удалить пользовательскую сессию"""
     USER_SESSIONS.pop(token, None)
     try:
-        c = db(); c.execute("DELETE FROM user_sessions WHERE token=%s", (token,)); c.commit(); c.close()
+        c = await db(); await c.execute("DELETE FROM user_sessions WHERE token=%s", (token,)); await c.commit(); await c.close()
     except Exception: pass
 
-def get_session(request: Request):
+async def get_session(request: Request):
     token = request.cookies.get("vn_session")
     if not token:
         log.warning("get_session: cookie vn_session отсутствует")
@@ -486,44 +513,44 @@ def get_session(request: Request):
         s = SESSIONS[token]
         if datetime.now() > s["expires"]:
             log.warning("get_session: сессия в памяти просрочена")
-            _del_session(token)
+            await _del_session(token)
             return None
         if s.get("ip") and s["ip"] != cur_ip:
             log.warning(f"get_session: смена IP ({s['ip']} -> {cur_ip}), сессия сброшена, требуется повторный вход с 2FA")
-            _del_session(token)
+            await _del_session(token)
             return None
         log.info(f"get_session: найдена в памяти, user={s['username']}")
         return s
     # Не в кеше — восстанавливаем из БД (после перезапуска сервера)
-    c = db()
-    row = one(c, "SELECT * FROM admin_sessions WHERE token=%s AND expires_at > now()", (token,))
-    c.close()
+    c = await db()
+    row = await one(c, "SELECT * FROM admin_sessions WHERE token=%s AND expires_at > now()", (token,))
+    await c.close()
     if not row:
         log.warning(f"get_session: токен не найден в БД (token={token[:12]}...)")
         return None
     if row.get("ip") and row["ip"] != cur_ip:
         log.warning(f"get_session: смена IP при восстановлении сессии ({row['ip']} -> {cur_ip})")
-        _del_session(token)
+        await _del_session(token)
         return None
     s = {
         "username": row["username"],
         "can_review_admin_complaints": bool(row["can_review_admin_complaints"]),
-        "expires": row["expires_at"],  # psycopg2 уже отдаёт datetime, парсить не нужно
+        "expires": row["expires_at"],  # psycopg уже отдаёт datetime, парсить не нужно
         "ip": row.get("ip"),
     }
     SESSIONS[token] = s
     log.info(f"get_session: восстановлена из БД, user={s['username']}")
     return s
 
-def require_admin(request: Request):
-    s = get_session(request)
+async def require_admin(request: Request):
+    s = await get_session(request)
     if not s:
         raise HTTPException(401, "Требуется авторизация")
     return s
 
-def require_complaint_reviewer(request: Request):
+async def require_complaint_reviewer(request: Request):
     """Требует права на рассмотрение жалоб на администраторов"""
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав на рассмотрение жалоб на администраторов")
     return s
@@ -572,7 +599,7 @@ class BugReportIn(BaseModel):
 
 # ─── AUTH ENDPOINTS ──────────────────────────────────────────────────────────
 
-def _create_admin_session(response: Response, admin: dict, ip: str) -> dict:
+async def _create_admin_session(response: Response, admin: dict, ip: str) -> dict:
     token = secrets.token_urlsafe(32)
     expires_dt = datetime.now() + SESSION_TTL
     SESSIONS[token] = {
@@ -582,8 +609,8 @@ def _create_admin_session(response: Response, admin: dict, ip: str) -> dict:
         "ip": ip,
     }
     try:
-        c = db()
-        c.execute(
+        c = await db()
+        await c.execute(
             """INSERT INTO admin_sessions (token, username, can_review_admin_complaints, expires_at, ip)
                VALUES (%s,%s,%s,%s,%s)
                ON CONFLICT (token) DO UPDATE SET
@@ -593,7 +620,7 @@ def _create_admin_session(response: Response, admin: dict, ip: str) -> dict:
                    ip=excluded.ip""",
             (token, admin["username"], int(admin["can_review_admin_complaints"]), expires_dt.isoformat(), ip)
         )
-        c.commit(); c.close()
+        await c.commit(); await c.close()
     except Exception as e:
         log.error(f"Ошибка сохранения сессии: {e}")
     response.set_cookie(
@@ -613,23 +640,23 @@ async def login(body: LoginIn, request: Request, response: Response):
     username = body.username.lower().lstrip("@")
 
     # Проверяем бан на сайте
-    ban = is_site_banned(username)
+    ban = await is_site_banned(username)
     if ban:
         expires = f" до {ban['expires_at']}" if ban.get('expires_at') else " (бессрочно)"
         raise HTTPException(403, f"Вы заблокированы на сайте{expires}. Причина: {ban.get('reason','')}")
 
-    admin = check_admin_password(username, body.password)
+    admin = await check_admin_password(username, body.password)
     if not admin:
         raise HTTPException(401, "Неверный логин или пароль")
 
     ip = get_client_ip(request)
-    tfa = get_tfa_record("admin", admin["username"])
+    tfa = await get_tfa_record("admin", admin["username"])
 
     # 2FA обязательна для администраторов. Если ещё не привязана — пускаем в
     # аккаунт, но помечаем это в ответе, чтобы фронтенд сразу открыл вкладку
     # «Профиль» и потребовал привязку.
     if not tfa or not tfa.get("enabled"):
-        result = _create_admin_session(response, admin, ip)
+        result = await _create_admin_session(response, admin, ip)
         result["tfa_setup_required"] = True
         return result
 
@@ -668,11 +695,11 @@ async def verify_2fa(body: dict, request: Request, response: Response):
 
     if d["subject_type"] == "admin":
         admin = {"username": d["username"], **d["extra"]}
-        return _create_admin_session(response, admin, ip)
+        return await _create_admin_session(response, admin, ip)
     else:
         session_token = secrets.token_urlsafe(32)
         session_data = {"username": d["username"], "tg_id": d["extra"].get("tg_id")}
-        save_user_session(session_token, session_data)
+        await save_user_session(session_token, session_data)
         response.set_cookie("vn_user_session", session_token, httponly=True, samesite="lax", max_age=86400)
         return {"ok": True, "confirmed": True, "username": d["username"], "tg_id": d["extra"].get("tg_id")}
 
@@ -680,17 +707,17 @@ async def verify_2fa(body: dict, request: Request, response: Response):
 async def logout(request: Request, response: Response):
     token = request.cookies.get("vn_session")
     if token:
-        _del_session(token)
+        await _del_session(token)
     response.delete_cookie("vn_session", path="/", samesite="lax", secure=False)
     return {"ok": True}
 
 @app.get("/api/auth/me")
 async def me(request: Request):
-    s = get_session(request)
+    s = await get_session(request)
     if not s:
         # Check user session
         token = request.cookies.get("vn_user_session")
-        u = get_user_session(token) if token else None
+        u = await get_user_session(token) if token else None
         if u:
             return {"admin": False, "user": True, "username": u["username"], "tg_id": u.get("tg_id")}
         # Check appeal token in cookie
@@ -701,7 +728,7 @@ async def me(request: Request):
                     "tg_id": a["tg_id"], "appeal_reason": a.get("reason",""),
                     "appeal_type": a.get("punishment_type","")}
         return {"admin": False, "user": False}
-    tfa = get_tfa_record("admin", s["username"])
+    tfa = await get_tfa_record("admin", s["username"])
     return {
         "admin": True,
         "username": s["username"],
@@ -725,7 +752,7 @@ async def poll_user_token(token: str, request: Request, response: Response):
     data = USER_TOKENS[token]
     if data["confirmed"]:
         del USER_TOKENS[token]
-        tfa = get_tfa_record("user", data["username"])
+        tfa = await get_tfa_record("user", data["username"])
         if tfa and tfa.get("enabled"):
             ip = get_client_ip(request)
             login_token = secrets.token_urlsafe(24)
@@ -742,7 +769,7 @@ async def poll_user_token(token: str, request: Request, response: Response):
             return {"confirmed": True, "tfa_required": True, "login_token": login_token}
         session_token = secrets.token_urlsafe(32)
         session_data = {"username": data["username"], "tg_id": data["tg_id"]}
-        save_user_session(session_token, session_data)
+        await save_user_session(session_token, session_data)
         response.set_cookie("vn_user_session", session_token, httponly=True, samesite="lax", max_age=86400)
         return {"confirmed": True, "username": data["username"], "tg_id": data["tg_id"]}
     return {"confirmed": False}
@@ -772,7 +799,7 @@ async def confirm_user_token(body: dict):
 async def user_logout(request: Request, response: Response):
     token = request.cookies.get("vn_user_session")
     if token:
-        del_user_session(token)
+        await del_user_session(token)
     response.delete_cookie("vn_user_session")
     return {"ok": True}
 
@@ -810,7 +837,7 @@ async def poll_appeal_token(token: str, response: Response):
             "appeal_reason": data.get("reason", ""),
             "appeal_type": data.get("punishment_type", "")
         }
-        save_user_session(session_token, session_data)
+        await save_user_session(session_token, session_data)
         response.set_cookie("vn_user_session", session_token, httponly=True, samesite="lax", max_age=86400)
         del APPEAL_TOKENS[token]
         return {"confirmed": True, "username": data["username"],
@@ -825,13 +852,13 @@ async def submit_complaint(request: Request, body: ComplaintIn):
     token = request.cookies.get("vn_user_session")
     tg_id = body.tg_id or 0
     username = body.username
-    u = get_user_session(token) if token else None
+    u = await get_user_session(token) if token else None
     if u:
         username = u["username"]
         tg_id = u.get("tg_id") or tg_id
 
-    conn = db()
-    cur = conn.execute("""
+    conn = await db()
+    cur = await conn.execute("""
         INSERT INTO admin_complaints
             (user_id, username, admin_username, description, complaint_text,
              evidence, status, complaint_type, submitter_tg_id, submitter_username, created_at)
@@ -841,59 +868,59 @@ async def submit_complaint(request: Request, body: ComplaintIn):
         username, body.admin_username, body.description, body.complaint_text,
         body.evidence or "", body.complaint_type, tg_id, username,
     ))
-    cid = cur.fetchone()["id"]
-    conn.commit()
-    c = one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
-    conn.close()
+    cid = (await cur.fetchone())["id"]
+    await conn.commit()
+    c = await one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
+    await conn.close()
     await notify_admins_new(c)
     return {"id": cid, "ok": True}
 
 @app.get("/api/my-complaints")
 async def my_complaints(request: Request):
     token = request.cookies.get("vn_user_session")
-    u = get_user_session(token) if token else None
+    u = await get_user_session(token) if token else None
     if not u:
         raise HTTPException(401, "Требуется авторизация")
     uname = u["username"].lower().lstrip("@")
-    conn = db()
-    data = rows(conn, """
+    conn = await db()
+    data = await rows(conn, """
         SELECT id, username, admin_username, complaint_type, description,
                complaint_text, status, admin_comment, created_at, handled_at
         FROM admin_complaints WHERE lower(ltrim(username,'@'))=%s
         ORDER BY created_at DESC
     """, (uname,))
-    conn.close()
+    await conn.close()
     return data
 
 # ─── ADMIN ENDPOINTS ─────────────────────────────────────────────────────────
 
 @app.get("/api/stats")
 async def get_stats(request: Request):
-    require_admin(request)
-    conn = db()
+    await require_admin(request)
+    conn = await db()
     today = datetime.now().strftime("%Y-%m-%d")
     result = {
-        "complaints_today":    one(conn,"SELECT COUNT(*) as c FROM admin_complaints WHERE date(created_at)=%s",(today,))["c"],
-        "pending":             one(conn,"SELECT COUNT(*) as c FROM admin_complaints WHERE status='pending'")["c"],
-        "active_mutes":        one(conn,"SELECT COUNT(*) as c FROM mutes WHERE is_active=TRUE")["c"],
-        "active_bans":         one(conn,"SELECT COUNT(*) as c FROM bans WHERE is_active=TRUE")["c"],
-        "total_users":         one(conn,"SELECT COUNT(*) as c FROM bot_users")["c"],
-        "pending_user_reports":one(conn,"SELECT COUNT(*) as c FROM user_reports WHERE status='pending'")["c"],
-        "chart": rows(conn,"""
+        "complaints_today":    (await one(conn,"SELECT COUNT(*) as c FROM admin_complaints WHERE date(created_at)=%s",(today,)))["c"],
+        "pending":             (await one(conn,"SELECT COUNT(*) as c FROM admin_complaints WHERE status='pending'"))["c"],
+        "active_mutes":        (await one(conn,"SELECT COUNT(*) as c FROM mutes WHERE is_active=TRUE"))["c"],
+        "active_bans":         (await one(conn,"SELECT COUNT(*) as c FROM bans WHERE is_active=TRUE"))["c"],
+        "total_users":         (await one(conn,"SELECT COUNT(*) as c FROM bot_users"))["c"],
+        "pending_user_reports":(await one(conn,"SELECT COUNT(*) as c FROM user_reports WHERE status='pending'"))["c"],
+        "chart": await rows(conn,"""
             SELECT date(created_at) as day, COUNT(*) as count
             FROM admin_complaints WHERE created_at >= CURRENT_DATE - INTERVAL '6 days'
             GROUP BY date(created_at) ORDER BY day
         """),
     }
-    conn.close()
+    await conn.close()
     return result
 
 @app.get("/api/complaints")
 async def get_complaints(request: Request, status: str = "all", q: str = ""):
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав на просмотр жалоб на администраторов")
-    conn = db()
+    conn = await db()
     sql = "SELECT * FROM admin_complaints"
     params, conds = [], []
     if status != "all":
@@ -904,35 +931,35 @@ async def get_complaints(request: Request, status: str = "all", q: str = ""):
     if conds:
         sql += " WHERE " + " AND ".join(conds)
     sql += " ORDER BY created_at DESC LIMIT 200"
-    data = rows(conn, sql, params)
-    conn.close()
+    data = await rows(conn, sql, params)
+    await conn.close()
     return data
 
 @app.get("/api/complaints/{cid}")
 async def get_complaint(request: Request, cid: int):
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав")
-    conn = db()
-    c = one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
-    conn.close()
+    conn = await db()
+    c = await one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
+    await conn.close()
     if not c: raise HTTPException(404, "Не найдено")
     return c
 
 @app.patch("/api/complaints/{cid}")
 async def review_complaint(request: Request, cid: int, body: ReviewIn):
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав")
     if body.status not in ("resolved","rejected","pending"):
         raise HTTPException(400, "Недопустимый статус")
-    conn = db()
-    conn.execute("""
+    conn = await db()
+    await conn.execute("""
         UPDATE admin_complaints SET status=%s,admin_comment=%s,handled_at=now() WHERE id=%s
     """, (body.status, body.comment, cid))
-    conn.commit()
-    c = one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
-    conn.close()
+    await conn.commit()
+    c = await one(conn, "SELECT * FROM admin_complaints WHERE id=%s", (cid,))
+    await conn.close()
     await notify_user_reply(c, body.comment)
     return c
 
@@ -940,28 +967,28 @@ async def review_complaint(request: Request, cid: int, body: ReviewIn):
 @app.post("/api/complaints/{cid}/punish")
 async def punish_from_complaint(request: Request, cid: int, body: PunishIn):
     """Выдать бан или варн пользователю из жалобы на администратора"""
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав")
 
-    conn = db()
+    conn = await db()
     # Site ban
     expires_at = None
     if body.expires_hours:
         expires_at = (datetime.now() + timedelta(hours=body.expires_hours)).isoformat()
 
-    conn.execute("""
+    await conn.execute("""
         INSERT INTO site_bans (username, tg_id, reason, issued_by, expires_at)
         VALUES (%s,%s,%s,%s,%s)
     """, (body.username.lower().lstrip("@"), body.tg_id or 0,
           body.reason, s["username"], expires_at))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     # Выгнать из активных сессий
     for tok, sess in list(USER_SESSIONS.items()):
         if sess.get("username","").lower() == body.username.lower().lstrip("@"):
-            del_user_session(tok)
+            await del_user_session(tok)
     for tok, sess in list(SESSIONS.items()):
         if sess.get("username","").lower() == body.username.lower().lstrip("@"):
             del SESSIONS[tok]
@@ -975,19 +1002,19 @@ async def punish_from_complaint(request: Request, cid: int, body: PunishIn):
 @app.post("/api/complaints/{cid}/warn")
 async def warn_from_complaint(request: Request, cid: int, body: PunishIn):
     """Выдать варн пользователю из жалобы"""
-    s = require_admin(request)
+    s = await require_admin(request)
     if not s.get("can_review_admin_complaints"):
         raise HTTPException(403, "Нет прав")
 
-    conn = db()
+    conn = await db()
     expires_at = (datetime.now() + timedelta(days=7)).isoformat()
-    conn.execute("""
+    await conn.execute("""
         INSERT INTO site_warns (username, tg_id, reason, issued_by, expires_at)
         VALUES (%s,%s,%s,%s,%s)
     """, (body.username.lower().lstrip("@"), body.tg_id or 0,
           body.reason, s["username"], expires_at))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     if body.tg_id:
         await tg_warn_user(body.tg_id, body.reason, s["username"])
@@ -1002,8 +1029,8 @@ async def submit_user_report(body: dict):
     secret = body.get("secret")
     if secret != BOT_TOKEN:
         raise HTTPException(403, "Forbidden")
-    conn = db()
-    cur = conn.execute("""
+    conn = await db()
+    cur = await conn.execute("""
         INSERT INTO user_reports
             (reporter_id, reporter_username, reported_id, reported_username,
              reason, message_text, message_photo, message_link, chat_id, created_at)
@@ -1016,40 +1043,40 @@ async def submit_user_report(body: dict):
         body.get("message_photo",""), body.get("message_link",""),
         body.get("chat_id",0),
     ))
-    rid = cur.fetchone()["id"]
-    conn.commit()
-    conn.close()
+    rid = (await cur.fetchone())["id"]
+    await conn.commit()
+    await conn.close()
     log.info(f"User report #{rid} от {body.get('reporter_username')} на {body.get('reported_username')}")
     return {"id": rid, "ok": True}
 
 @app.get("/api/user-reports")
 async def get_user_reports(request: Request, status: str = "all"):
-    require_admin(request)
-    conn = db()
+    await require_admin(request)
+    conn = await db()
     if status == "all":
-        data = rows(conn, "SELECT * FROM user_reports ORDER BY created_at DESC LIMIT 200")
+        data = await rows(conn, "SELECT * FROM user_reports ORDER BY created_at DESC LIMIT 200")
     else:
-        data = rows(conn, "SELECT * FROM user_reports WHERE status=%s ORDER BY created_at DESC LIMIT 200", (status,))
-    conn.close()
+        data = await rows(conn, "SELECT * FROM user_reports WHERE status=%s ORDER BY created_at DESC LIMIT 200", (status,))
+    await conn.close()
     return data
 
 @app.patch("/api/user-reports/{rid}")
 async def handle_user_report(request: Request, rid: int, body: UserReportActionIn):
     """Администратор принимает решение по /report жалобе"""
-    s = require_admin(request)
-    conn = db()
-    r = one(conn, "SELECT * FROM user_reports WHERE id=%s", (rid,))
+    s = await require_admin(request)
+    conn = await db()
+    r = await one(conn, "SELECT * FROM user_reports WHERE id=%s", (rid,))
     if not r:
-        conn.close()
+        await conn.close()
         raise HTTPException(404, "Не найдено")
 
     new_status = 'rejected' if body.action == 'dismiss' else 'resolved'
-    conn.execute("""
+    await conn.execute("""
         UPDATE user_reports SET status=%s, handled_by=%s, handled_action=%s, handled_at=now()
         WHERE id=%s
     """, (new_status, s["username"], body.action, rid))
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
 
     # Применяем наказание через бота
     reported_id  = r.get("reported_id", 0)
@@ -1126,6 +1153,17 @@ async def _bot_action(action: str, user_id: int, chat_id: int, reason: str, admi
                 })
         except Exception as e:
             log.error(f"Bot action error: {e}")
+            return
+    # Единый журнал наказаний (см. moderation_events в main.py)
+    expires_at = datetime.now() + timedelta(days=days) if action == "mute" else None
+    try:
+        async with db_session() as conn:
+            await conn.execute(
+                "INSERT INTO moderation_events (kind, user_id, chat_id, issued_by_name, reason, expires_at) "
+                "VALUES (%s,%s,%s,%s,%s,%s)",
+                (action, user_id, chat_id, admin, reason, expires_at))
+    except Exception as e:
+        log.error(f"Moderation event error: {e}")
 
 async def tg_send_chat(chat_id: int, text: str):
     if not BOT_TOKEN:
@@ -1153,9 +1191,9 @@ async def add_site_admin(body: dict):
     password = body.get("password", gen_password())
     pw_hash  = hashlib.sha256(password.encode()).hexdigest()
 
-    conn = db()
+    conn = await db()
     try:
-        conn.execute("""
+        await conn.execute("""
             INSERT INTO site_admins (tg_id, username, password_hash, added_by, can_review_admin_complaints)
             VALUES (%s,%s,%s,%s,%s)
             ON CONFLICT(tg_id) DO UPDATE SET
@@ -1163,11 +1201,11 @@ async def add_site_admin(body: dict):
                 can_review_admin_complaints=excluded.can_review_admin_complaints,
                 is_active=1
         """, (tg_id, username, pw_hash, added_by, can_review))
-        conn.commit()
+        await conn.commit()
     except Exception as e:
-        conn.close()
+        await conn.close()
         raise HTTPException(500, str(e))
-    conn.close()
+    await conn.close()
 
     return {"ok": True, "username": username, "password": password, "can_review_admin_complaints": bool(can_review)}
 
@@ -1179,20 +1217,20 @@ async def grant_complaint_review(body: dict):
         raise HTTPException(403, "Forbidden")
     username = body.get("username", "").lower().lstrip("@")
     tg_id    = body.get("tg_id", 0)
-    conn = db()
+    conn = await db()
     # Ищем сначала по username, потом по tg_id (если username не задан или не найден)
-    existing = one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
+    existing = await one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
     if not existing and tg_id:
-        existing = one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
+        existing = await one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
     if not existing:
-        conn.close()
+        await conn.close()
         raise HTTPException(404, "Admin not found")
-    conn.execute(
+    await conn.execute(
         "UPDATE site_admins SET can_review_admin_complaints=1 WHERE id=%s",
         (existing["id"],)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     log.info(f"Granted admin complaint review to {existing['username']} (tg_id={existing.get('tg_id')})")
     return {"ok": True}
 
@@ -1204,19 +1242,19 @@ async def revoke_complaint_review(body: dict):
         raise HTTPException(403, "Forbidden")
     username = body.get("username", "").lower().lstrip("@")
     tg_id    = body.get("tg_id", 0)
-    conn = db()
-    existing = one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
+    conn = await db()
+    existing = await one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
     if not existing and tg_id:
-        existing = one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
+        existing = await one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
     if not existing:
-        conn.close()
+        await conn.close()
         raise HTTPException(404, "Admin not found")
-    conn.execute(
+    await conn.execute(
         "UPDATE site_admins SET can_review_admin_complaints=0 WHERE id=%s",
         (existing["id"],)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     log.info(f"Revoked admin complaint review from {existing['username']} (tg_id={existing.get('tg_id')})")
     return {"ok": True}
 
@@ -1228,86 +1266,92 @@ async def deactivate_site_admin(body: dict):
         raise HTTPException(403, "Forbidden")
     username = body.get("username", "").lower().lstrip("@")
     tg_id    = body.get("tg_id", 0)
-    conn = db()
-    existing = one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
+    conn = await db()
+    existing = await one(conn, "SELECT * FROM site_admins WHERE lower(username)=%s AND is_active=1", (username,)) if username else None
     if not existing and tg_id:
-        existing = one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
+        existing = await one(conn, "SELECT * FROM site_admins WHERE tg_id=%s AND is_active=1", (tg_id,))
     if not existing:
-        conn.close()
+        await conn.close()
         # Не ошибка: у пользователя могло не быть аккаунта на сайте вовсе
         return {"ok": True, "found": False}
-    conn.execute(
+    await conn.execute(
         "UPDATE site_admins SET is_active=0, password_hash='' WHERE id=%s",
         (existing["id"],)
     )
-    conn.commit()
-    conn.close()
+    await conn.commit()
+    await conn.close()
     log.info(f"Deactivated site account for {existing['username']} (tg_id={existing.get('tg_id')})")
     return {"ok": True, "found": True}
 
 @app.get("/api/site-admins")
 async def get_site_admins(request: Request):
-    require_admin(request)
-    conn = db()
-    data = rows(conn, "SELECT id, tg_id, username, added_by, added_at, can_review_admin_complaints, is_active FROM site_admins ORDER BY added_at DESC")
-    conn.close()
+    await require_admin(request)
+    conn = await db()
+    data = await rows(conn, "SELECT id, tg_id, username, added_by, added_at, can_review_admin_complaints, is_active FROM site_admins ORDER BY added_at DESC")
+    await conn.close()
     return data
 
 # ─── OTHER ADMIN ENDPOINTS ───────────────────────────────────────────────────
 
 @app.get("/api/users")
 async def get_users(request: Request, q: str = ""):
-    require_admin(request)
-    conn = db()
+    await require_admin(request)
+    conn = await db()
     if q:
-        data = rows(conn,
+        data = await rows(conn,
             "SELECT * FROM bot_users WHERE username LIKE %s OR first_name LIKE %s ORDER BY last_seen DESC LIMIT 100",
             (f"%{q}%",f"%{q}%"))
     else:
-        data = rows(conn,"SELECT * FROM bot_users ORDER BY last_seen DESC LIMIT 100")
+        data = await rows(conn,"SELECT * FROM bot_users ORDER BY last_seen DESC LIMIT 100")
     for u in data:
         uid = u["user_id"]
         try:
-            u["warns"]     = (one(conn,"SELECT COUNT(*) as c FROM warns WHERE user_id=%s AND expires_at>now()",(uid,)) or {}).get("c", 0)
-            u["muted"]     = ((one(conn,"SELECT COUNT(*) as c FROM mutes WHERE user_id=%s AND is_active=TRUE",(uid,)) or {}).get("c", 0)) > 0
-            u["banned"]    = ((one(conn,"SELECT COUNT(*) as c FROM bans WHERE user_id=%s AND is_active=TRUE",(uid,)) or {}).get("c", 0)) > 0
-            u["site_banned"] = ((one(conn,"SELECT COUNT(*) as c FROM site_bans WHERE lower(username)=%s AND is_active=1 AND (expires_at IS NULL OR expires_at>now())",(u.get("username","").lower(),)) or {}).get("c", 0)) > 0
+            u["warns"]     = (await one(conn,"SELECT COUNT(*) as c FROM warns WHERE user_id=%s AND expires_at>now()",(uid,)) or {}).get("c", 0)
+            u["muted"]     = ((await one(conn,"SELECT COUNT(*) as c FROM mutes WHERE user_id=%s AND is_active=TRUE",(uid,)) or {}).get("c", 0)) > 0
+            u["banned"]    = ((await one(conn,"SELECT COUNT(*) as c FROM bans WHERE user_id=%s AND is_active=TRUE",(uid,)) or {}).get("c", 0)) > 0
+            u["site_banned"] = ((await one(conn,"SELECT COUNT(*) as c FROM site_bans WHERE lower(username)=%s AND is_active=1 AND (expires_at IS NULL OR expires_at>now())",(u.get("username","").lower(),)) or {}).get("c", 0)) > 0
         except Exception:
             u["warns"] = 0; u["muted"] = False; u["banned"] = False; u["site_banned"] = False
-    conn.close()
+    await conn.close()
     return data
 
 @app.get("/api/logs")
-async def get_logs(request: Request, kind: str = "all"):
-    require_admin(request)
-    conn = db()
-    result = []
-    if kind in ("all","warn"):
-        result += rows(conn,"SELECT 'warn' as kind,issued_at as ts,issued_by,user_id,reason,NULL as expires_at FROM warns ORDER BY issued_at DESC LIMIT 50")
-    if kind in ("all","mute"):
-        result += rows(conn,"SELECT 'mute' as kind,issued_at as ts,issued_by,user_id,reason,expires_at FROM mutes ORDER BY issued_at DESC LIMIT 50")
-    if kind in ("all","ban"):
-        result += rows(conn,"SELECT 'ban' as kind,issued_at as ts,issued_by,user_id,reason,expires_at FROM bans ORDER BY issued_at DESC LIMIT 50")
-    conn.close()
-    result.sort(key=lambda x: x.get("ts") or "", reverse=True)
-    return result[:200]
+async def get_logs(request: Request, kind: str = "all", before: str = "", before_id: int = 0, limit: int = 200):
+    """Журнал наказаний из moderation_events, от новых к старым.
+    Следующая страница: before=<ts последней строки>&before_id=<её id>."""
+    await require_admin(request)
+    where, params = [], []
+    if kind != "all":
+        where.append("kind=%s")
+        params.append(kind)
+    if before:
+        try:
+            params += [datetime.fromisoformat(before), before_id]
+        except ValueError:
+            raise HTTPException(400, "Некорректный параметр before")
+        where.append("(created_at,id) < (%s,%s)")
+    sql = ("SELECT id, kind, created_at AS ts, COALESCE(issued_by::text, issued_by_name) AS issued_by, "
+           "user_id, reason, expires_at FROM moderation_events "
+           + (f"WHERE {' AND '.join(where)} " if where else "") +
+           "ORDER BY created_at DESC, id DESC LIMIT %s")
+    conn = await db()
+    data = await rows(conn, sql, (*params, max(1, min(limit, 200))))
+    await conn.close()
+    return data
 
 
 # ─── AI-ПОМОЩНИК ──────────────────────────────────────────────────────────────
 
-def get_punishment_history_sync(tg_id: int) -> list:
+async def get_punishment_history(tg_id: int) -> list:
     """Последние наказания пользователя по Telegram ID — для tool-вызова AI."""
-    conn = db()
-    data = rows(conn, """
-        SELECT 'warn' AS kind, reason, issued_at, NULL AS expires_at FROM warns WHERE user_id=%s
-        UNION ALL
-        SELECT 'mute' AS kind, reason, issued_at, expires_at FROM mutes WHERE user_id=%s
-        UNION ALL
-        SELECT 'ban' AS kind, reason, issued_at, expires_at FROM bans WHERE user_id=%s
-        ORDER BY issued_at DESC
+    conn = await db()
+    data = await rows(conn, """
+        SELECT kind, reason, created_at AS issued_at, expires_at FROM moderation_events
+        WHERE user_id=%s AND kind IN ('warn','mute','ban')
+        ORDER BY created_at DESC, id DESC
         LIMIT 10
-    """, (tg_id, tg_id, tg_id))
-    conn.close()
+    """, (tg_id,))
+    await conn.close()
     for r in data:
         if r.get("issued_at"):
             r["issued_at"] = str(r["issued_at"])
@@ -1375,7 +1419,7 @@ async def ai_ask(body: AiAskIn):
                     try:
                         args = json.loads(tc["function"]["arguments"])
                         tg_id = int(args.get("tg_id"))
-                        result = get_punishment_history_sync(tg_id)
+                        result = await get_punishment_history(tg_id)
                     except Exception as e:
                         result = {"error": str(e)}
                     messages.append({
@@ -1398,19 +1442,19 @@ async def submit_bug(request: Request, body: BugReportIn):
         raise HTTPException(400, "Укажите заголовок бага")
 
     token = request.cookies.get("vn_user_session")
-    u = get_user_session(token) if token else None
+    u = await get_user_session(token) if token else None
     username = u["username"] if u else "аноним"
     tg_id = (u.get("tg_id") if u else 0) or 0
 
-    conn = db()
-    cur = conn.execute("""
+    conn = await db()
+    cur = await conn.execute("""
         INSERT INTO bug_reports (title, description, reporter_username, reporter_tg_id, status, created_at)
         VALUES (%s,%s,%s,%s,'new',now())
         RETURNING id
     """, (title, body.description or "", username, tg_id))
-    bid = cur.fetchone()["id"]
-    conn.commit()
-    conn.close()
+    bid = (await cur.fetchone())["id"]
+    await conn.commit()
+    await conn.close()
 
     text = (
         f"🐞 <b>Новый баг-репорт #{bid}</b>\n\n"
@@ -1425,13 +1469,13 @@ async def submit_bug(request: Request, body: BugReportIn):
 
 @app.get("/api/bugs")
 async def get_bugs(request: Request, status: str = "all"):
-    require_admin(request)
-    conn = db()
+    await require_admin(request)
+    conn = await db()
     if status == "all":
-        data = rows(conn, "SELECT * FROM bug_reports ORDER BY created_at DESC LIMIT 200")
+        data = await rows(conn, "SELECT * FROM bug_reports ORDER BY created_at DESC LIMIT 200")
     else:
-        data = rows(conn, "SELECT * FROM bug_reports WHERE status=%s ORDER BY created_at DESC LIMIT 200", (status,))
-    conn.close()
+        data = await rows(conn, "SELECT * FROM bug_reports WHERE status=%s ORDER BY created_at DESC LIMIT 200", (status,))
+    await conn.close()
     return data
 
 @app.get("/api/broadcast/next")
@@ -1447,37 +1491,37 @@ async def broadcast_next():
 async def user_auth_check(username: str):
     if not username:
         raise HTTPException(400, "username required")
-    conn = db()
-    u = one(conn,"SELECT * FROM bot_users WHERE lower(ltrim(username,'@'))=%s",(username.lower().lstrip('@'),))
-    conn.close()
+    conn = await db()
+    u = await one(conn,"SELECT * FROM bot_users WHERE lower(ltrim(username,'@'))=%s",(username.lower().lstrip('@'),))
+    await conn.close()
     if not u:
         return {"ok": False, "reason": "not_found"}
     return {"ok": True, "username": u["username"], "first_name": u.get("first_name","")}
 
 # ─── ПРОФИЛЬ / 2FA ────────────────────────────────────────────────────────────
 
-def _current_subject(request: Request):
+async def _current_subject(request: Request):
     """Возвращает (subject_type, username, tg_id) для админа или обычного
     пользователя по текущей сессии, либо None."""
-    s = get_session(request)
+    s = await get_session(request)
     if s:
         return "admin", s["username"], None
     token = request.cookies.get("vn_user_session")
-    u = get_user_session(token) if token else None
+    u = await get_user_session(token) if token else None
     if u:
         return "user", u["username"], u.get("tg_id")
     return None
 
 @app.get("/api/profile/me")
 async def profile_me(request: Request):
-    subj = _current_subject(request)
+    subj = await _current_subject(request)
     if not subj:
         raise HTTPException(401, "Требуется авторизация")
     subject_type, username, tg_id = subj
-    tfa = get_tfa_record(subject_type, username)
+    tfa = await get_tfa_record(subject_type, username)
     if not tg_id and tfa:
         tg_id = tfa.get("tg_id")
-    history = get_punishment_history_sync(tg_id) if tg_id else []
+    history = await get_punishment_history(tg_id) if tg_id else []
     return {
         "subject_type": subject_type,
         "username": username,
@@ -1491,7 +1535,7 @@ async def profile_me(request: Request):
 async def tfa_start(request: Request):
     """Начать привязку 2FA — генерируем токен для входа в бота, как при
     обычном логине пользователей."""
-    subj = _current_subject(request)
+    subj = await _current_subject(request)
     if not subj:
         raise HTTPException(401, "Требуется авторизация")
     subject_type, username, _ = subj
@@ -1511,7 +1555,7 @@ async def tfa_poll(token: str):
     if not d:
         raise HTTPException(404, "Token not found")
     if d["confirmed"]:
-        save_tfa_binding(d["subject_type"], d["subject_username"], d["tg_id"], d["tg_username"])
+        await save_tfa_binding(d["subject_type"], d["subject_username"], d["tg_id"], d["tg_username"])
         del TFA_BIND_TOKENS[token]
         return {"confirmed": True, "tg_id": d["tg_id"], "tg_username": d["tg_username"]}
     return {"confirmed": False}
@@ -1532,16 +1576,16 @@ async def tfa_confirm(body: dict):
 
 @app.post("/api/profile/tfa/disable")
 async def tfa_disable(request: Request):
-    subj = _current_subject(request)
+    subj = await _current_subject(request)
     if not subj:
         raise HTTPException(401, "Требуется авторизация")
     subject_type, username, _ = subj
     if subject_type == "admin":
         raise HTTPException(403, "2FA обязательна для администраторов и не может быть отключена")
-    conn = db()
-    conn.execute("UPDATE two_factor_auth SET enabled=0 WHERE subject_type='user' AND lower(username)=%s",
+    conn = await db()
+    await conn.execute("UPDATE two_factor_auth SET enabled=0 WHERE subject_type='user' AND lower(username)=%s",
                  (username.lower().lstrip("@"),))
-    conn.commit(); conn.close()
+    await conn.commit(); await conn.close()
     return {"ok": True}
 
 # ─── PRODUCTS API ─────────────────────────────────────────────────────────────
@@ -1556,11 +1600,17 @@ PRODUCT_CATEGORIES = [
 ]
 
 
-def _ensure_products_table():
+_PRODUCTS_TABLE_READY = False
+
+async def _ensure_products_table():
     """Таблицы товаров создаются миграцией (migrate_to_postgres.py).
-    Здесь только подстраховка на случай, если её ещё не прогнали."""
-    with db() as conn:
-        conn.execute("""
+    Здесь только подстраховка на случай, если её ещё не прогнали.
+    DDL выполняется один раз за процесс, а не на каждый запрос."""
+    global _PRODUCTS_TABLE_READY
+    if _PRODUCTS_TABLE_READY:
+        return
+    async with db_session() as conn:
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS shop_products (
                 id SERIAL PRIMARY KEY,
                 category TEXT NOT NULL,
@@ -1572,7 +1622,7 @@ def _ensure_products_table():
                 is_active INTEGER DEFAULT 1
             )
         """)
-        conn.execute("""
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS shop_product_photos (
                 id SERIAL PRIMARY KEY,
                 product_id INTEGER NOT NULL REFERENCES shop_products(id),
@@ -1580,6 +1630,7 @@ def _ensure_products_table():
                 sort_order INTEGER DEFAULT 0
             )
         """)
+    _PRODUCTS_TABLE_READY = True
 
 
 @app.get("/api/products")
@@ -1588,29 +1639,34 @@ async def get_products(category: str = "", response: Response = None):
     if response is not None:
         response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate"
         response.headers["Pragma"] = "no-cache"
-    _ensure_products_table()
-    with db() as conn:
+    await _ensure_products_table()
+    async with db_session() as conn:
         if category:
-            result = rows(conn,
+            result = await rows(conn,
                 "SELECT id, category, name, description, photo_file_id, added_at "
                 "FROM shop_products WHERE is_active=1 AND category=%s ORDER BY id DESC",
                 (category,)
             )
         else:
-            result = rows(conn,
+            result = await rows(conn,
                 "SELECT id, category, name, description, photo_file_id, added_at "
                 "FROM shop_products WHERE is_active=1 ORDER BY id DESC"
             )
     # Подгружаем фото из shop_product_photos для каждого товара
-    with db() as conn:
+    # (одним запросом на все товары, а не по запросу на каждый)
+    async with db_session() as conn:
+        photo_rows = await rows(conn,
+            "SELECT product_id, file_id FROM shop_product_photos "
+            "WHERE product_id = ANY(%s) ORDER BY product_id, sort_order",
+            ([p["id"] for p in result],)
+        )
+        photos_by_product: dict = {}
+        for row in photo_rows:
+            photos_by_product.setdefault(row["product_id"], []).append(row["file_id"])
         for p in result:
-            photos = conn.execute(
-                "SELECT file_id FROM shop_product_photos WHERE product_id=%s ORDER BY sort_order",
-                (p["id"],)
-            ).fetchall()
-            p["photos"] = [row["file_id"] for row in photos]
-            # Категории с количеством
-        cat_counts = rows(conn,
+            p["photos"] = photos_by_product.get(p["id"], [])
+        # Категории с количеством
+        cat_counts = await rows(conn,
             "SELECT category, COUNT(*) as count FROM shop_products WHERE is_active=1 GROUP BY category"
         )
     counts = {r["category"]: r["count"] for r in cat_counts}
@@ -1621,9 +1677,9 @@ async def get_products(category: str = "", response: Response = None):
 @app.get("/api/product-photo/{product_id}")
 async def get_product_photo(product_id: int):
     """Прокси для фото товара из Telegram"""
-    _ensure_products_table()
-    with db() as conn:
-        row = one(conn, "SELECT photo_file_id FROM shop_products WHERE id=%s AND is_active=1", (product_id,))
+    await _ensure_products_table()
+    async with db_session() as conn:
+        row = await one(conn, "SELECT photo_file_id FROM shop_products WHERE id=%s AND is_active=1", (product_id,))
     if not row:
         raise HTTPException(status_code=404, detail="Not found")
     file_id = row["photo_file_id"]
@@ -1645,15 +1701,15 @@ async def get_product_photo(product_id: int):
 @app.get("/api/product-photo/{product_id}/{photo_index}")
 async def get_product_photo_by_index(product_id: int, photo_index: int):
     """Прокси для фото товара по индексу из shop_product_photos"""
-    _ensure_products_table()
-    with db() as conn:
-        row = conn.execute(
+    await _ensure_products_table()
+    async with db_session() as conn:
+        row = await one(conn,
             "SELECT file_id FROM shop_product_photos WHERE product_id=%s ORDER BY sort_order LIMIT 1 OFFSET %s",
             (product_id, photo_index)
-        ).fetchone()
+        )
         if not row:
             # Фолбэк: старое поле photo_file_id (для товаров без записей в shop_product_photos)
-            fallback = one(conn, "SELECT photo_file_id FROM shop_products WHERE id=%s AND is_active=1", (product_id,))
+            fallback = await one(conn, "SELECT photo_file_id FROM shop_products WHERE id=%s AND is_active=1", (product_id,))
             if not fallback or not fallback["photo_file_id"]:
                 raise HTTPException(status_code=404, detail="Not found")
             file_id = fallback["photo_file_id"]
@@ -1678,9 +1734,9 @@ async def get_categories(response: Response):
     """Получить список категорий"""
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate"
     response.headers["Pragma"] = "no-cache"
-    _ensure_products_table()
-    with db() as conn:
-        result = rows(conn,
+    await _ensure_products_table()
+    async with db_session() as conn:
+        result = await rows(conn,
             "SELECT category, COUNT(*) as count FROM shop_products WHERE is_active=1 GROUP BY category"
         )
     counts = {r["category"]: r["count"] for r in result}